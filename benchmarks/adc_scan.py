@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Time per OD reading tick against the number of channels, read back to back (one ADC at a time, as AnalogIn does) or
+interleaved across the ADCs (morbidostat.utils.adc_scanner). Channels are spread over up to 4 simulated ADS1115s
+(utils/simulated_ads1115.py) sharing one bus, with conversions of 1/data_rate and I2C transactions of `--i2c-time`.
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/adc_scan.py --data-rate 128 --conversions 4
+"""
+import threading
+import time
+
+import click
+
+from morbidostat.utils.adc_scanner import InterleavedScanner
+from morbidostat.utils.simulated_ads1115 import SimulatedADS1115
+
+ADDRESSES = [0x48, 0x49, 0x4A, 0x4B]
+
+
+def setup(n_channels, data_rate, i2c_time):
+    # fill the chips round robin, as one would wire them to keep the scan short.
+    bus = threading.Lock()
+    n_adcs = min(len(ADDRESSES), n_channels)
+    adcs = {
+        address: SimulatedADS1115(
+            {pin: 0.3 for pin in range(4)}, data_rate=data_rate, address=address, bus=bus, i2c_time=i2c_time
+        )
+        for address in ADDRESSES[:n_adcs]
+    }
+    channels = {f"{i}": (ADDRESSES[i % n_adcs], i // n_adcs) for i in range(n_channels)}
+    return adcs, channels
+
+
+def back_to_back(adcs, channels, conversions):
+    for (address, adc) in adcs.items():
+        own_channels = {label: channel for (label, channel) in channels.items() if channel[0] == address}
+        InterleavedScanner({address: adc}, own_channels).scan(conversions)
+
+
+def best_time(f, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option("--data-rate", default=128)
+@click.option("--conversions", default=1, help="conversions per channel per tick")
+@click.option("--i2c-time", default=0.0002, help="seconds per I2C transaction (3 bytes at 100kHz is about 0.3ms)")
+@click.option("--repeats", default=3)
+def benchmark(data_rate, conversions, i2c_time, repeats):
+    click.echo(f"{'channels':>8} {'ADCs':>5} {'back to back (ms)':>18} {'interleaved (ms)':>17} {'speedup':>8}")
+    for n_channels in [1, 2, 4, 8, 12, 16]:
+        adcs, channels = setup(n_channels, data_rate, i2c_time)
+        sequential = best_time(lambda: back_to_back(adcs, channels, conversions), repeats)
+        interleaved = best_time(lambda: InterleavedScanner(adcs, channels).scan(conversions), repeats)
+        speedup = sequential / interleaved
+        click.echo(f"{n_channels:>8} {len(adcs):>5} {sequential * 1000:>18.1f} {interleaved * 1000:>17.1f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+CPU per observation of the fleet's growth rate filters, as the number of units N grows:
+
+- one ExtendedKalmanFilter per unit, each updated on its own
+- an ExtendedKalmanFilterBank, updating all N units in one call
+- an ExtendedKalmanFilterBank of N units, updating 4 of them per call
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/ekf_bank.py --sensors 2
+"""
+import time
+
+import click
+import numpy as np
+
+from morbidostat.utils.streaming_calculations import ExtendedKalmanFilter, ExtendedKalmanFilterBank
+
+
+def parameters(n_sensors):
+    return (
+        np.append(np.ones(n_sensors), 1.0),
+        np.diag([1e-5] * n_sensors + [1e-8]),
+        np.diag([1e-8] * n_sensors + [1e-14]),
+        np.diag([1e-4] * n_sensors),
+    )
+
+
+def per_observation(update, observations):
+    start = time.perf_counter()
+    for batch in observations:
+        update(batch)
+    return (time.perf_counter() - start) / observations[:, :, 0].size
+
+
+@click.command()
+@click.option("--sensors", default=2, show_default=True)
+@click.option("--observations", default=20000, show_default=True, help="per case, roughly")
+def benchmark(sensors, observations):
+    rng = np.random.default_rng(0)
+    click.echo(f"{'units':>6} {'a filter each':>14} {'bank, all':>11} {'bank, 4 units':>14}   (µs per observation)")
+    for n_units in [1, 4, 16, 64, 256]:
+        steps = max(observations // n_units, 20)
+        readings = 1 + rng.normal(0, 0.01, (steps, n_units, sensors))
+        keys = list(range(n_units))
+
+        filters = [ExtendedKalmanFilter(*parameters(sensors)) for _ in keys]
+
+        def separately(batch):
+            for (ekf, observation) in zip(filters, batch):
+                ekf.update(observation)
+
+        bank = ExtendedKalmanFilterBank(sensors)
+        for key in keys:
+            bank.add(key, *parameters(sensors))
+        subset = keys[-4:]
+        subset_readings = 1 + rng.normal(0, 0.01, (max(observations // 4, 20), len(subset), sensors))
+
+        click.echo(
+            f"{n_units:>6} {per_observation(separately, readings) * 1e6:>14.1f} "
+            f"{per_observation(lambda batch: bank.update(keys, batch), readings) * 1e6:>11.1f} "
+            f"{per_observation(lambda batch: bank.update(subset, batch), subset_readings) * 1e6:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
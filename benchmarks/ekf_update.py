@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Per-update latency of `ExtendedKalmanFilter.update`, against the dense update it replaced (a Jacobian built with
+np.zeros and fancy indexing, twice per prediction, products with H = [I | 0] and an explicit inverse), for 2 to
+16 sensors.
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/ekf_update.py
+"""
+import time
+
+import click
+import numpy as np
+
+from morbidostat.utils import streaming_calculations
+from morbidostat.utils.streaming_calculations import ExtendedKalmanFilter
+
+
+class DenseExtendedKalmanFilter(ExtendedKalmanFilter):
+    def update(self, observation):
+        observation = np.asarray(observation)
+        self.update_counters()
+        state_prediction, covariance_prediction = self.predict()
+        residual_state = observation - state_prediction[:-1]
+        H = self._jacobian_observation()
+        residual_covariance = H @ covariance_prediction @ H.T + self.observation_noise_covariance
+        kalman_gain = covariance_prediction @ H.T @ np.linalg.inv(residual_covariance)
+        self.state_ = state_prediction + kalman_gain @ residual_state
+        self.covariance_ = (np.eye(self.dim) - kalman_gain @ H) @ covariance_prediction
+
+
+def create(cls, n_sensors):
+    return cls(
+        np.append(np.ones(n_sensors), 1.0),
+        np.diag([1e-5] * n_sensors + [1e-8]),
+        np.diag([1e-8] * n_sensors + [1e-14]),
+        np.diag([1e-4] * n_sensors),
+    )
+
+
+def per_update(ekf, observations):
+    start = time.perf_counter()
+    for observation in observations:
+        ekf.update(observation)
+    return (time.perf_counter() - start) / len(observations)
+
+
+@click.command()
+@click.option("--updates", default=5000, show_default=True)
+def benchmark(updates):
+    rng = np.random.default_rng(0)
+    lapack = streaming_calculations.dpotrf is not None
+    click.echo(f"{'sensors':>7} {'dense':>10} {'structured':>12} {'speedup':>8}   (Cholesky by {'LAPACK' if lapack else 'LU'})")
+    for n_sensors in [2, 4, 8, 16]:
+        observations = 1 + rng.normal(0, 0.01, (updates, n_sensors))
+        dense = per_update(create(DenseExtendedKalmanFilter, n_sensors), observations)
+        structured = per_update(create(ExtendedKalmanFilter, n_sensors), observations)
+        click.echo(f"{n_sensors:>7} {dense * 1e6:>8.1f}µs {structured * 1e6:>10.1f}µs {dense / structured:>7.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
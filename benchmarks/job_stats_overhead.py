@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+What collecting a job's runtime metrics (`$stats`, see background_jobs/utils/job_stats.py) costs the growth rate
+calculator:
+
+1. recording: the work the callback wrapper adds per message (two clock reads and `CallbackStats.record`).
+2. as a share of the calculator's od_raw_batched handler, called directly, and of the process's CPU time per
+   od_raw_batched message published to it, until it has been handled and its results sent (receiving,
+   dispatching, the handler, publishing). Against the in-process broker (the default here), the latter also
+   counts the broker's work.
+3. a snapshot, as a share of `[job_stats] publish_interval`.
+
+The recording cost is timed on its own, since it is smaller than the run to run noise of timing the whole handler.
+
+>>> HOSTNAME=localhost TESTING=1 MORBIDOSTAT_BROKER=in_process python benchmarks/job_stats_overhead.py
+"""
+import json
+import time
+
+import click
+from paho.mqtt.client import MQTTMessage
+
+from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from morbidostat.background_jobs.utils.job_stats import CallbackStats
+from morbidostat.config import config
+from morbidostat.pubsub import publish, settle
+from morbidostat.whoami import unit, experiment
+
+READING = json.dumps({"135/A": 0.778586260567034, "90/A": 0.20944389172032837})
+TOPIC = f"morbidostat/{unit}/{experiment}/od_raw_batched"
+
+
+def od_raw_batched_message():
+    message = MQTTMessage(topic=TOPIC.encode())
+    message.payload = READING.encode()
+    message.timestamp = time.monotonic()
+    return message
+
+
+def recording_time(n):
+    stats, message, monotonic = CallbackStats(), od_raw_batched_message(), time.monotonic
+    start_loop = time.perf_counter()
+    for _ in range(n):
+        start = monotonic()
+        stats.record(message, start, monotonic())
+    return (time.perf_counter() - start_loop) / n
+
+
+def handler_time(calc, n):
+    callback, message = calc._wrap_callback(calc.update_state_from_observation), od_raw_batched_message()
+    start = time.perf_counter()
+    for _ in range(n):
+        callback(message)
+    return (time.perf_counter() - start) / n
+
+
+def end_to_end_cpu_time(n):
+    settle()
+    start = time.process_time()
+    for _ in range(n):
+        publish(TOPIC, READING)
+    settle()
+    return (time.process_time() - start) / n
+
+
+@click.command()
+@click.option("--n", default=5000, help="messages per run")
+@click.option("--repeats", default=5, help="best of")
+def benchmark(n, repeats):
+    publish(TOPIC, READING, retain=True)
+    settle()
+
+    recording = min(recording_time(n) for _ in range(repeats))
+    calc = GrowthRateCalculator(unit=unit, experiment=experiment, ignore_cache=True)
+    handler = min(handler_time(calc, n) for _ in range(repeats))
+    end_to_end = min(end_to_end_cpu_time(n) for _ in range(repeats))
+
+    start = time.perf_counter()
+    for _ in range(100):
+        calc.stats.snapshot()
+    snapshot = (time.perf_counter() - start) / 100
+    calc.set_state(calc.DISCONNECTED)
+    interval = float(config["job_stats"]["publish_interval"])
+
+    click.echo(f"recording:  {recording * 1e6:8.2f} µs per message")
+    click.echo(f"handler:    {handler * 1e6:8.2f} µs per message, recording is {100 * recording / handler:.2f}% of it")
+    click.echo(f"end to end: {end_to_end * 1e6:8.2f} µs CPU per message, recording is {100 * recording / end_to_end:.2f}% of it")
+    click.echo(f"snapshot:   {snapshot * 1e6:8.2f} µs, {100 * snapshot / interval:.5f}% of a {interval:g}s interval")
+
+
+if __name__ == "__main__":
+    benchmark()
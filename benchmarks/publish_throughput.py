@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Messages per second of the old per-message `paho.mqtt.publish.single` path vs the pooled `morbidostat.pubsub.publish`.
+
+Requires a broker, ex: a local mosquitto, or run against the in-process broker:
+
+>>> python benchmarks/publish_throughput.py --hostname localhost --n 2000
+>>> MORBIDOSTAT_BROKER=in_process python benchmarks/publish_throughput.py --n 2000
+"""
+import time
+
+import click
+from paho.mqtt import publish as mqtt_publish
+
+from morbidostat import pubsub
+
+
+def single_connection_per_message(topic, n, hostname, qos):
+    host, port = pubsub.broker_address(hostname)
+    for i in range(n):
+        mqtt_publish.single(topic, payload=i, hostname=host, port=port, qos=qos)
+
+
+def pooled_connection(topic, n, hostname, qos):
+    for i in range(n):
+        pubsub.publish(topic, i, hostname=hostname, qos=qos)
+    # flush anything still buffered so the comparison is fair.
+    pubsub.get_publish_client(hostname).disconnect()
+    pubsub._publish_clients.pop(hostname, None)
+
+
+def run(func, topic, n, hostname, qos):
+    start = time.perf_counter()
+    func(topic, n, hostname, qos)
+    return n / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--hostname", default="localhost")
+@click.option("--n", default=1000, help="messages to send per run")
+@click.option("--qos", default=0, type=click.IntRange(0, 2))
+def benchmark(hostname, n, qos):
+    topic = "morbidostat/_benchmark/_benchmark/publish_throughput"
+
+    before = run(single_connection_per_message, topic, n, hostname, qos)
+    after = run(pooled_connection, topic, n, hostname, qos)
+
+    click.echo(f"qos={qos}, n={n}")
+    click.echo(f"publish.single:  {before:10.1f} msg/s")
+    click.echo(f"pubsub.publish:  {after:10.1f} msg/s")
+    click.echo(f"speedup:         {after / before:10.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Time to replay and smooth a unit's growth rates over a long experiment: a database with `--days` of readings at two
+angles, every 5 seconds, with an io event every 20 minutes, is loaded, filtered, smoothed and written back.
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/replay_growth_rates.py --days 14
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+
+from morbidostat.actions.replay_growth_rates import load_recordings, rts_smooth, run_filter, write_smoothed
+
+CREATE_TABLES = os.path.join(os.path.dirname(__file__), "..", "sql", "create_tables.sql")
+
+
+def create_database(path, days):
+    rng = np.random.default_rng(0)
+    times = 1612345678.0 + 5.0 * np.arange(int(days * 17280))
+    # a turbidostat-like sawtooth: growth at 0.3/h, diluted by 10% every 20 minutes.
+    od = 0.5 * np.exp(0.3 * ((times - times[0]) % 1200) / 3600)
+    labels = [datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="milliseconds") for t in times]
+    rows = [
+        (label, "1", float(value), "benchmark", angle)
+        for (angle, scale) in [("135A", 1.0), ("90A", 0.4)]
+        for (label, value) in zip(labels, scale * od * (1 + rng.normal(0, 0.005, len(times))))
+    ]
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript(open(CREATE_TABLES).read())
+        connection.executemany("INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)", rows)
+        connection.executemany(
+            "INSERT INTO io_events VALUES (?, 'benchmark', 'add_media', 1.0, '1')", [(label,) for label in labels[240::240]]
+        )
+    connection.close()
+
+
+@click.command()
+@click.option("--days", default=14.0, show_default=True)
+def benchmark(days):
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "observations.sqlite")
+        create_database(database, days)
+
+        start = time.perf_counter()
+        (recording,) = load_recordings("benchmark", database=database)
+        loaded = time.perf_counter()
+        history = run_filter(recording)
+        filtered = time.perf_counter()
+        states, _ = rts_smooth(history, covariances=False)
+        smoothed = time.perf_counter()
+        write_smoothed(recording, states, history.samples_per_second, database=database)
+        written = time.perf_counter()
+
+    n = len(recording.timestamps)
+    click.echo(f"{days:g} days, {n} readings of {len(recording.angles)} angles, {len(recording.io_event_steps)} io events")
+    for (step, seconds) in [
+        ("load and align", loaded - start),
+        ("filter", filtered - loaded),
+        ("smooth", smoothed - filtered),
+        ("write back", written - smoothed),
+    ]:
+        click.echo(f"{step:>15}: {seconds:6.2f}s ({seconds / n * 1e6:5.1f}µs per reading)")
+
+
+if __name__ == "__main__":
+    benchmark()
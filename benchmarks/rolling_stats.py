@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+The cost of a rolling window update and a read of its statistics, per channel, for:
+
+- recompute: a list, `pop(0)` and the `statistics` module (how MovingStats used to work)
+- MovingStats: running sums and monotonic queues, one channel per instance
+- RollingMeanVar, RollingQuantiles: NumPy ring buffers, for one channel or all `--channels` at once
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/rolling_stats.py --window 20 --channels 4
+"""
+import random
+import statistics
+import time
+
+import click
+
+from morbidostat.utils.streaming_calculations import MovingStats, RollingMeanVar, RollingQuantiles
+
+
+class Recompute:
+    def __init__(self, window):
+        self.values = [None] * window
+
+    def update(self, value):
+        self.values.pop(0)
+        self.values.append(value)
+
+    def read(self):
+        return statistics.mean(self.values), statistics.stdev(self.values), statistics.median(self.values)
+
+
+def per_update(update, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        update()
+    return (time.perf_counter() - start) / n
+
+
+@click.command()
+@click.option("--window", default=20, show_default=True)
+@click.option("--channels", default=4, show_default=True)
+@click.option("--updates", default=20000, show_default=True)
+def benchmark(window, channels, updates):
+    rows = [[random.gauss(1, 0.01) for _ in range(channels)] for _ in range(1024)]
+    values = [row[0] for row in rows]
+
+    def scalar(stats, read):
+        i = iter(range(10 ** 9))
+
+        def update():
+            stats.update(values[next(i) % 1024])
+            read(stats)
+
+        return update
+
+    def vectorized(stats, read):
+        i = iter(range(10 ** 9))
+
+        def update():
+            stats.update(rows[next(i) % 1024])
+            read(stats)
+
+        return update
+
+    recompute = Recompute(window)
+    for value in values[:window]:
+        recompute.update(value)
+
+    cases = {
+        "recompute (mean, std, median)": (scalar(recompute, Recompute.read), 1),
+        "MovingStats (mean, std)": (scalar(MovingStats(window), lambda s: (s.mean, s.std)), 1),
+        "RollingMeanVar (mean, std)": (scalar(RollingMeanVar(window), lambda s: (s.mean, s.std)), 1),
+        "RollingQuantiles (median)": (scalar(RollingQuantiles(window), lambda s: s.median), 1),
+        f"RollingMeanVar x{channels} (mean, std)": (
+            vectorized(RollingMeanVar(window, channels=channels), lambda s: (s.mean, s.std)),
+            channels,
+        ),
+        f"RollingQuantiles x{channels} (median)": (
+            vectorized(RollingQuantiles(window, channels=channels), lambda s: s.median),
+            channels,
+        ),
+    }
+    for (name, (update, n_channels)) in cases.items():
+        click.echo(f"{name:>36}: {per_update(update, updates) / n_channels * 1e6:7.2f}µs per channel per update")
+
+
+if __name__ == "__main__":
+    benchmark()
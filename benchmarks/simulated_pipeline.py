@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Load test the worker's pipeline on simulated hardware (morbidostat/utils/simulated_hardware.py): od_reading,
+growth_rate_calculating and a turbidostat, hosted in one process by a WorkerHost, as on a worker. The culture grows
+`--speedup` times faster than the wall clock, so the turbidostat has something to dilute. Reports the rates the jobs
+kept up, the process's CPU use, each job's `$stats`, and what happened to the culture.
+
+>>> HOSTNAME=localhost TESTING=1 MORBIDOSTAT_BROKER=in_process python benchmarks/simulated_pipeline.py --samples-per-second 20
+"""
+import json
+import os
+import time
+
+import click
+
+os.environ["MORBIDOSTAT_HARDWARE"] = "simulated"
+
+from morbidostat import hardware
+from morbidostat.config import config
+from morbidostat.pubsub import subscribe_and_callback, settle
+from morbidostat.whoami import unit, experiment
+
+
+@click.command()
+@click.option("--seconds", default=60, help="how long to run the pipeline")
+@click.option("--samples-per-second", default=10.0, help="OD readings per second")
+@click.option("--channels", default="135,0;90,0x49:0", help="';' separated --od-angle-channel values")
+@click.option("--speedup", default=60.0, help="culture hours per wall clock hour")
+@click.option("--initial-od", default=0.5)
+@click.option("--target-od", default=0.25, help="the turbidostat's target, in volts of the 135 sensor (nothing normalizes here)")
+def benchmark(seconds, samples_per_second, channels, speedup, initial_od, target_od):
+    # before the jobs read them
+    config["od_sampling"]["samples_per_second"] = str(samples_per_second)
+    config["simulation"]["speedup"] = str(speedup)
+    config["simulation"]["initial_od"] = str(initial_od)
+    from morbidostat.background_jobs.worker_host import WorkerHost
+
+    counts = {"od_raw_batched": 0, "growth_rate": 0, "io_events": 0}
+
+    def count(message):
+        counts[message.topic.split("/")[-1]] += 1
+
+    subscribe_and_callback(count, [f"morbidostat/{unit}/{experiment}/{topic}" for topic in counts])
+    culture = hardware.simulated_culture()
+
+    host = WorkerHost(unit=unit, experiment=experiment)
+    start, cpu_start = time.monotonic(), time.process_time()
+    host.start_job("od_reading", od_angle_channel=channels.split(";"), sampling_rate=1 / samples_per_second)
+    host.start_job("growth_rate_calculating", ignore_cache=True)
+    # duration is in minutes: check the OD every second
+    host.start_job("io_controlling", mode="turbidostat", duration=1 / 60, target_od=target_od, volume=0.5)
+
+    ods = []
+    while time.monotonic() - start < seconds:
+        time.sleep(1)
+        ods.append(culture.od)
+
+    elapsed, cpu = time.monotonic() - start, time.process_time() - cpu_start
+    stats = {name: hosted.job.stats.snapshot() for (name, hosted) in host.hosted_jobs.items()}
+    host.set_state(host.DISCONNECTED)
+    settle()
+
+    click.echo(f"ran {elapsed:.1f}s, {100 * cpu / elapsed:.1f}% of a CPU")
+    for (topic, n) in counts.items():
+        click.echo(f"{topic:>16}: {n:6d} messages, {n / elapsed:8.2f}/s")
+    for (name, snapshot) in stats.items():
+        callbacks = {callback: (s["count"], s["mean_ms"], s["max_ms"]) for (callback, s) in snapshot["callbacks"].items()}
+        click.echo(f"{name}: tasks {json.dumps(snapshot['tasks'])}")
+        click.echo(f"{' ' * len(name)}  callbacks (count, mean ms, max ms) {json.dumps(callbacks)}")
+    click.echo(f"culture OD: start {ods[0]:.3f}, max {max(ods):.3f}, end {ods[-1]:.3f}; pumped {hardware.GPIO.pumped_ml} mL")
+
+
+if __name__ == "__main__":
+    benchmark()
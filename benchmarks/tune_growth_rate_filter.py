@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Time to score candidates of the growth rate filter's parameters, on `--units` units with `--days` of readings each (two
+angles every 5 seconds, an io event every 20 minutes), with 1 and with `--processes` processes. Loading and aligning the
+readings, which the search does once, is timed separately: it's what each candidate would cost on top otherwise.
+
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/tune_growth_rate_filter.py --days 2 --units 2 --processes 4
+"""
+import os
+import sqlite3
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from morbidostat.actions.replay_growth_rates import load_recordings
+from morbidostat.actions.tune_growth_rate_filter import RANGES, create_candidates, search
+
+CREATE_TABLES = os.path.join(os.path.dirname(__file__), "..", "sql", "create_tables.sql")
+
+
+def create_database(path, days, units):
+    rng = np.random.default_rng(0)
+    times = 1612345678.0 + 5.0 * np.arange(int(days * 17280))
+    od = 0.5 * np.exp(0.3 * ((times - times[0]) % 1200) / 3600)
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript(open(CREATE_TABLES).read())
+        for unit in map(str, range(1, units + 1)):
+            connection.executemany(
+                "INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)",
+                [
+                    (float(t), unit, float(value), "benchmark", angle)
+                    for (angle, scale) in [("135A", 1.0), ("90A", 0.4)]
+                    for (t, value) in zip(times, scale * od * (1 + rng.normal(0, 0.01, len(times))))
+                ],
+            )
+            connection.executemany(
+                "INSERT INTO io_events VALUES (?, 'benchmark', 'add_media', 1.0, ?)", [(float(t), unit) for t in times[240::240]]
+            )
+    connection.close()
+
+
+@click.command()
+@click.option("--days", default=2.0, show_default=True)
+@click.option("--units", default=2, show_default=True)
+@click.option("--candidates", "n_candidates", default=8, show_default=True)
+@click.option("--processes", default=os.cpu_count(), show_default=True)
+def benchmark(days, units, n_candidates, processes):
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "observations.sqlite")
+        create_database(database, days, units)
+        start = time.perf_counter()
+        recordings = load_recordings("benchmark", database=database)
+        loading = time.perf_counter() - start
+
+    candidates = create_candidates("random", n_candidates - 1, RANGES)
+    n = sum(len(recording.timestamps) for recording in recordings)
+    click.echo(f"{len(candidates)} candidates, on {units} units of {days:g} days: {n} readings of 2 angles")
+    click.echo(f"{'load and align':>20}: {loading:6.2f}s, once")
+    for n_processes in sorted({1, processes}):
+        start = time.perf_counter()
+        search(recordings, candidates, processes=n_processes)
+        seconds = (time.perf_counter() - start) / len(candidates)
+        click.echo(f"{n_processes:>10} processes: {seconds:6.2f}s per candidate ({seconds / n * 1e6:5.1f}µs per reading)")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Encode/decode cost and payload size of `od_raw_batched` messages, JSON vs `morbidostat.utils.wire_format`.
+
+Decoding includes getting the values into a numpy array in channel order, which is what the growth rate
+calculator needs.
+
+>>> python benchmarks/wire_format.py --channels 4 --n 20000
+"""
+import json
+import timeit
+
+import click
+import numpy as np
+
+from morbidostat.utils import wire_format
+
+
+def json_decode(payload, channels):
+    d = json.loads(payload)
+    return np.array([float(d[c]) for c in channels])
+
+
+@click.command()
+@click.option("--channels", default=4, help="number of od channels in a batch")
+@click.option("--n", default=20000, help="messages to encode/decode per run")
+def benchmark(channels, n):
+    labels = [f"{angle}/{letter}" for angle in ("135", "90", "45") for letter in "ABCD"][:channels]
+    values = np.random.uniform(0, 2.5, size=len(labels))
+    raw_signals = dict(zip(labels, values.tolist()))
+
+    json_payload = json.dumps(raw_signals)
+    rows = [("json", len(json_payload), timeit.timeit(lambda: json.dumps(raw_signals), number=n), json_payload, None)]
+
+    for dtype in wire_format.DTYPE_CODES:
+        schema, schema_payload = wire_format.create_schema(labels, dtype=dtype)
+        decoder = wire_format.Decoder()
+        decoder.add_schema(schema_payload)
+        payload = wire_format.encode(schema, list(raw_signals.values()))
+        encode_time = timeit.timeit(lambda: wire_format.encode(schema, list(raw_signals.values())), number=n)
+        rows.append((dtype, len(payload), encode_time, payload, decoder))
+
+    click.echo(f"{len(labels)} channels, n={n}")
+    click.echo(f"{'format':>8} {'bytes':>6} {'encode µs':>10} {'decode µs':>10}")
+    for (name, size, encode_time, payload, decoder) in rows:
+        if decoder is None:
+            decode_time = timeit.timeit(lambda: json_decode(payload, labels), number=n)
+        else:
+            decode_time = timeit.timeit(lambda: decoder.decode(payload)[2], number=n)
+        click.echo(f"{name:>8} {size:>6} {1e6 * encode_time / n:>10.2f} {1e6 * decode_time / n:>10.2f}")
+
+
+if __name__ == "__main__":
+    benchmark()
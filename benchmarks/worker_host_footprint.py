@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Memory (RSS) and start up time of running jobs as separate processes (how `mb <job>` runs them) vs in one
+`worker_host` process. Start up time is until every job has published `$state` = ready.
+
+Requires a broker that both this process and the jobs connect to, ex: a local mosquitto. Run it on a worker, or
+anywhere with `--fake-rpi` (fake GPIO from the `fake_rpi` package, like the tests use):
+
+>>> python benchmarks/worker_host_footprint.py --job stirring --job growth_rate_calculating --job io_controlling
+>>> HOSTNAME=localhost TESTING=1 python benchmarks/worker_host_footprint.py --fake-rpi
+
+A retained `od_raw_batched` reading is published first, so growth_rate_calculating can start without od_reading.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import click
+
+from morbidostat.pubsub import publish, subscribe_and_callback, settle
+from morbidostat.whoami import unit, experiment
+
+FAKE_RPI = """
+import sys, fake_rpi
+sys.modules["RPi"] = fake_rpi.RPi
+sys.modules["RPi.GPIO"] = fake_rpi.RPi.GPIO
+sys.modules["smbus"] = fake_rpi.smbus
+fake_rpi.toggle_print(False)
+"""
+
+
+def launch(module, args, fake_rpi):
+    code = f"import runpy, sys; sys.argv = ['{module}'] + {args!r}; runpy.run_module('{module}', run_name='__main__')"
+    if fake_rpi:
+        code = FAKE_RPI + code
+    return subprocess.Popen([sys.executable, "-u", "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+def listen_for_ready(jobs):
+    ready = {}  # job -> time it published ready
+    done = threading.Event()
+
+    def on_state(message):
+        job = message.topic.split("/")[3]
+        # skip retained states, left over from previous runs.
+        if not message.retain and job in jobs and message.payload == b"ready" and job not in ready:
+            ready[job] = time.perf_counter()
+            if len(ready) == len(jobs):
+                done.set()
+
+    subscription = subscribe_and_callback(on_state, f"morbidostat/{unit}/{experiment}/+/$state")
+    settle()
+    return subscription, ready, done
+
+
+def stop(processes):
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run(jobs, launcher, fake_rpi, timeout):
+    subscription, ready, done = listen_for_ready(jobs)
+    start = time.perf_counter()
+    processes = launcher(jobs, fake_rpi)
+    finished = done.wait(timeout)
+    subscription.cancel()
+    time.sleep(1)  # let memory settle
+    rss = sum(rss_mb(process.pid) for process in processes)
+    stop(processes)
+    if not finished:
+        raise click.ClickException(f"Only {sorted(ready)} became ready within {timeout}s.")
+    return rss, max(ready.values()) - start
+
+
+def separate_processes(jobs, fake_rpi):
+    return [launch(f"morbidostat.background_jobs.{job}", [], fake_rpi) for job in jobs]
+
+
+def one_host(jobs, fake_rpi):
+    args = [arg for job in jobs for arg in ("--job", job)]
+    return [launch("morbidostat.background_jobs.worker_host", args, fake_rpi)]
+
+
+@click.command()
+@click.option(
+    "--job", "jobs", multiple=True, default=["stirring", "growth_rate_calculating", "io_controlling"], show_default=True
+)
+@click.option("--fake-rpi", is_flag=True, help="use fake_rpi's GPIO, to run off a Raspberry Pi")
+@click.option("--timeout", default=60.0)
+def benchmark(jobs, fake_rpi, timeout):
+    publish(f"morbidostat/{unit}/{experiment}/od_raw_batched", json.dumps({"135/A": 0.05, "90/A": 0.03}), retain=True)
+
+    separate_rss, separate_time = run(jobs, separate_processes, fake_rpi, timeout)
+    host_rss, host_time = run(jobs, one_host, fake_rpi, timeout)
+
+    click.echo(f"jobs: {', '.join(jobs)}")
+    click.echo(f"separate processes:  {separate_rss:7.1f} MB RSS, all ready after {separate_time:5.2f}s")
+    click.echo(f"worker_host:         {host_rss:7.1f} MB RSS, all ready after {host_time:5.2f}s")
+
+
+if __name__ == "__main__":
+    benchmark()
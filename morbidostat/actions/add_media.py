@@ -3,14 +3,13 @@
 import time
 from json import loads
 import click
-import RPi.GPIO as GPIO
 from morbidostat.utils import pump_ml_to_duration, pump_duration_to_ml
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.config import config
+from morbidostat import hardware
 from morbidostat.pubsub import publish, QOS
 
-GPIO.setmode(GPIO.BCM)
-
 
 def add_media(ml=None, duration=None, duty_cycle=33, verbose=0):
     assert 0 <= duty_cycle <= 100
@@ -26,6 +25,7 @@ def add_media(ml=None, duration=None, duty_cycle=33, verbose=0):
         ml = pump_duration_to_ml(duration, duty_cycle, **loads(config["pump_calibration"][f"media{unit}_ml_calibration"]))
     assert duration >= 0
 
+    experiment = whoami.experiment
     publish(
         f"morbidostat/{unit}/{experiment}/io_events",
         '{"volume_change": %0.4f, "event": "add_media"}' % ml,
@@ -33,6 +33,7 @@ def add_media(ml=None, duration=None, duty_cycle=33, verbose=0):
         qos=QOS.EXACTLY_ONCE,
     )
 
+    GPIO = hardware.get_gpio()
     try:
 
         MEDIA_PIN = int(config["rpi_pins"]["media"])
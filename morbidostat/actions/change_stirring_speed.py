@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
 import click
 
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.pubsub import publish
 
 
 def change_stirring_speed(duty_cycle, unit, verbose=0):
     assert 0 <= duty_cycle <= 100
 
-    publish(f"morbidostat/{unit}/{experiment}/stirring/duty_cycle/set", duty_cycle, verbose=verbose)
+    publish(f"morbidostat/{unit}/{whoami.experiment}/stirring/duty_cycle/set", duty_cycle, verbose=verbose)
     return
 
 
@@ -6,11 +6,10 @@ import threading
 
 import click
 from click import echo as click_echo
-import busio
-import RPi.GPIO as GPIO
 
 from morbidostat.config import config
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.pubsub import publish
 from morbidostat.actions.remove_waste import remove_waste
 from morbidostat.actions.add_alt_media import add_alt_media
@@ -41,6 +40,7 @@ class StoppableThread(threading.Thread):
 
 
 def clean_tubes(duration, verbose=0):
+    experiment = whoami.experiment
     try:
         # start waste pump, poll for kill signal every N seconds
         waste_thead = StoppableThread(target=remove_waste, kwargs={"duration": 2.25 * duration, "duty_cycle": 100})
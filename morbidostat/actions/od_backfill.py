@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Republish raw OD readings that the leader missed (ex: while it or the broker was down), from the ring buffer this
+worker keeps them in (`[od_sampling] ring_buffer`, written by od_reading).
+
+> mb od_backfill --minutes 90
+> mb od_backfill --start 1612345678 --end 1612349278
+
+The readings are sent in chunks of `--chunk-size`, QoS 1, as JSON, to
+
+    morbidostat/<unit>/<experiment>/od_raw_backfill
+
+ex: {"timestamps": [1612345678.1, 1612345683.1, ...], "135/A": [0.0311, 0.0312, ...], "90/A": [...]}
+
+and not to od_raw_batched, whose listeners take every message as the latest reading. On the leader,
+`mb od_backfill_writing` writes them to the observation database.
+"""
+import json
+import os
+import time
+
+import click
+
+from morbidostat.config import config
+from morbidostat.pubsub import publish, flush, QOS
+from morbidostat.utils.ring_buffer import ReadingRingBuffer
+from morbidostat.whoami import unit
+from morbidostat import whoami
+
+
+def encode_chunk(channels, timestamps, values):
+    chunk = {"timestamps": [round(float(t), 3) for t in timestamps]}
+    for (i, channel) in enumerate(channels):
+        chunk[channel] = [round(float(v), 6) for v in values[:, i]]
+    return json.dumps(chunk)
+
+
+def od_backfill(start, end=None, chunk_size=500, experiment=None, path=None, verbose=0):
+    """
+    Republish the readings from `start` up to `end` (unix times, default: now). Returns how many were sent.
+    """
+    experiment = experiment or whoami.experiment
+    path = path or os.path.expanduser(config["od_sampling"]["ring_buffer"])
+
+    sent = 0
+    with ReadingRingBuffer(path) as buffer:
+        first, stop = buffer.search(start), buffer.count if end is None else buffer.search(end)
+        for chunk_start in range(first, stop, chunk_size):
+            timestamps, values = buffer.read(chunk_start, min(chunk_start + chunk_size, stop))
+            payload = encode_chunk(buffer.channels, timestamps, values)
+            # encoding copies out of the file, so the chunk is whole unless od_reading overwrote it meanwhile.
+            if not buffer.is_current(chunk_start):
+                raise click.ClickException("od_reading overwrote the readings being sent: use a later --start.")
+            publish(f"morbidostat/{unit}/{experiment}/od_raw_backfill", payload, verbose=verbose, qos=QOS.AT_LEAST_ONCE)
+            sent += len(timestamps)
+    flush()
+    return sent
+
+
+@click.command()
+@click.option("--start", type=float, help="unix time of the first reading to send")
+@click.option("--end", type=float, default=None, help="unix time to stop at (default: now)")
+@click.option("--minutes", type=float, help="send the last this many minutes, instead of --start")
+@click.option("--chunk-size", default=500, show_default=True, help="readings per message")
+@click.option("--verbose", "-v", count=True, help="print to std out")
+def click_od_backfill(start, end, minutes, chunk_size, verbose):
+    if (start is None) == (minutes is None):
+        raise click.UsageError("give one of --start or --minutes.")
+    if minutes is not None:
+        start = time.time() - 60 * minutes
+    sent = od_backfill(start, end, chunk_size=chunk_size, verbose=verbose)
+    click.echo(f"Republished {sent} readings.")
+
+
+if __name__ == "__main__":
+    click_od_backfill()
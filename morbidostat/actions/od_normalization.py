@@ -5,15 +5,16 @@ TODO: how do I handle a gain that is too small? Ex: an OD is 0.9, but the OD rea
 """
 import time
 import json
-from collections import defaultdict
-from statistics import median, variance
 import click
 import threading
 from click import echo, style
 
 from morbidostat.config import config
+from morbidostat import hardware
 from morbidostat.utils import log_start, log_stop
-from morbidostat.whoami import unit, experiment, hostname
+from morbidostat.utils.streaming_calculations import RollingMeanVar, RollingQuantiles
+from morbidostat import whoami
+from morbidostat.whoami import unit, hostname
 from morbidostat import pubsub
 from morbidostat.background_jobs.od_reading import od_reading
 from morbidostat.background_jobs.stirring import Stirrer
@@ -21,7 +22,11 @@ from morbidostat.background_jobs.stirring import Stirrer
 
 def stirring(duty_cycle=int(config["stirring"][f"duty_cycle{unit}"]), duration=None, verbose=0):
     # if this look familiar, it's because it is. I can't use `signal` in threads, so I just cp'ed this here.
-    publish(f"morbidostat/{unit}/{experiment}/log", f"[stirring]: start stirring with duty cycle={duty_cycle}", verbose=verbose)
+    GPIO = hardware.get_gpio()
+    experiment = whoami.experiment
+    pubsub.publish(
+        f"morbidostat/{unit}/{experiment}/log", f"[stirring]: start stirring with duty cycle={duty_cycle}", verbose=verbose
+    )
 
     try:
         stirrer = Stirrer(duty_cycle, unit, experiment)
@@ -30,7 +35,7 @@ def stirring(duty_cycle=int(config["stirring"][f"duty_cycle{unit}"]), duration=N
 
     except Exception as e:
         GPIO.cleanup()
-        publish(f"morbidostat/{unit}/{experiment}/error_log", f"[stirring] failed with {str(e)}", verbose=verbose)
+        pubsub.publish(f"morbidostat/{unit}/{experiment}/error_log", f"[stirring] failed with {str(e)}", verbose=verbose)
         raise e
     finally:
         GPIO.cleanup()
@@ -51,16 +56,16 @@ def bold(msg):
     return style(msg, bold=True)
 
 
-@log_start(unit, experiment)
-@log_stop(unit, experiment)
+@log_start(unit)
+@log_stop(unit)
 def od_normalization(od_angle_channel, verbose):
+    experiment = whoami.experiment
     echo()
     echo(bold(f"This task will compute statistics from {hostname}."))
 
     echo(bold("Starting stirring"))
     stirring_thread = start_stirring_in_background_thread(verbose)
     time.sleep(0.5)
-    readings = defaultdict(list)
     sampling_rate = 0.5
     N_samples = 50
 
@@ -68,24 +73,25 @@ def od_normalization(od_angle_channel, verbose):
 
         with click.progressbar(length=N_samples) as bar:
             for count, batched_reading in enumerate(od_reading(od_angle_channel, verbose, sampling_rate)):
-                for (sensor, reading) in batched_reading.items():
-                    readings[sensor].append(reading)
+                if count == 0:
+                    sensors = list(batched_reading)
+                    # all the readings, of all the sensors at once
+                    moments = RollingMeanVar(N_samples + 1, channels=len(sensors), min_periods=2)
+                    quantiles = RollingQuantiles(N_samples + 1, channels=len(sensors), min_periods=1)
+                readings = [batched_reading[sensor] for sensor in sensors]
+                moments.update(readings)
+                quantiles.update(readings)
 
                 bar.update(1)
                 if count == N_samples:
                     break
 
-        variances = {}
-        medians = {}
-        for sensor, reading_series in readings.items():
-            # measure the variance and publish. The variance will be used in downstream jobs.
-            var = variance(reading_series)
-            echo(green(f"variance of {sensor} = {var}"))
-            variances[sensor] = var
-            # measure the median and publish. The median will be used to normalize the readings in downstream jobs
-            med = median(reading_series)
-            echo(green(f"median of {sensor} = {med}"))
-            medians[sensor] = med
+        # the variance will be used in downstream jobs, and the median to normalize the readings.
+        variances = dict(zip(sensors, moments.variance.tolist()))
+        medians = dict(zip(sensors, quantiles.median.tolist()))
+        for sensor in sensors:
+            echo(green(f"variance of {sensor} = {variances[sensor]}"))
+            echo(green(f"median of {sensor} = {medians[sensor]}"))
 
         pubsub.publish(
             f"morbidostat/{unit}/{experiment}/od_normalization/variance",
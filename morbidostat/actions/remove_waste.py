@@ -4,15 +4,14 @@ import time
 from json import loads
 
 import click
-import RPi.GPIO as GPIO
 
 from morbidostat.utils import pump_ml_to_duration, pump_duration_to_ml
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.config import config
+from morbidostat import hardware
 from morbidostat.pubsub import publish, QOS
 
-GPIO.setmode(GPIO.BCM)
-
 
 def remove_waste(ml=None, duration=None, duty_cycle=33, verbose=0):
     assert 0 <= duty_cycle <= 100
@@ -29,6 +28,7 @@ def remove_waste(ml=None, duration=None, duty_cycle=33, verbose=0):
         assert duration >= 0
         ml = pump_duration_to_ml(duration, duty_cycle, **loads(config["pump_calibration"][f"waste{unit}_ml_calibration"]))
 
+    experiment = whoami.experiment
     publish(
         f"morbidostat/{unit}/{experiment}/io_events",
         '{"volume_change": -%0.4f, "event": "remove_waste"}' % ml,
@@ -36,6 +36,7 @@ def remove_waste(ml=None, duration=None, duty_cycle=33, verbose=0):
         qos=QOS.EXACTLY_ONCE,
     )
 
+    GPIO = hardware.get_gpio()
     try:
 
         WASTE_PIN = int(config["rpi_pins"]["waste"])
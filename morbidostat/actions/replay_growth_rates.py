@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Replay an experiment's raw OD readings and io events, from the observation database, through the growth rate
+calculator's Kalman filter, and optionally smooth the estimates with a Rauch-Tung-Striebel smoother, which uses the
+readings after each point as well as before it.
+
+> mb replay_growth_rates --experiment Trial-24 --unit 1 --unit 3
+
+The smoothed series are written back to the `od_readings_smoothed` and `growth_rates_smoothed` tables (see
+sql/create_tables.sql), replacing earlier replays of the same units.
+
+The readings of a unit's angles were recorded as separate rows, with slightly different timestamps. The rows of
+each angle are matched to the nearest reading of the first angle (in the filter's order), and readings with an angle
+missing are skipped, as growth_rate_calculating only updates on complete batches. The readings are normalized
+by the median and variance of their first `--normalization-samples`, as od_normalization does before an experiment.
+
+The filter is sequential, but everything around it is vectorized: parsing and aligning the readings, and the
+smoother's backward pass, which is an associative scan over all the time steps at once.
+"""
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+
+import click
+import numpy as np
+
+from morbidostat.utils import growth_rate_model
+from morbidostat.config import config
+from morbidostat.utils.streaming_calculations import ExtendedKalmanFilter
+
+# a unit's readings: (T,) unix times and the timestamps as recorded, (T, n_angles) readings, and the steps that
+# follow an io event.
+Recording = namedtuple(
+    "Recording", ["experiment", "unit", "angles", "timestamps", "timestamp_labels", "readings", "io_event_steps"]
+)
+
+# the filter's estimates at each step, before (predicted_) and after the reading, and F, the Jacobian of the
+# prediction into that step.
+FilterHistory = namedtuple(
+    "FilterHistory", ["states", "covariances", "predicted_states", "predicted_covariances", "jacobians", "samples_per_second"]
+)
+
+
+def parse_timestamps(labels):
+    """
+    ISO 8601 timestamps (as recorded from MQTT), or unix times, as unix times.
+    """
+    try:
+        return np.asarray(labels, dtype=float)
+    except ValueError:
+        return np.array([datetime.fromisoformat(label.replace("Z", "+00:00")).timestamp() for label in labels])
+
+
+def nearest(times, targets, tolerance):
+    """
+    The index in `times` (sorted) of the time nearest each target, or -1 if none is within `tolerance`.
+    """
+    right = np.clip(np.searchsorted(times, targets), 0, len(times) - 1)
+    left = np.maximum(right - 1, 0)
+    index = np.where(np.abs(times[left] - targets) <= np.abs(times[right] - targets), left, right)
+    return np.where(np.abs(times[index] - targets) <= tolerance, index, -1)
+
+
+def load_recordings(experiment, units=None, database=None):
+    """
+    The recordings of `units` (default: all the units with readings) in `experiment`.
+    """
+    connection = sqlite3.connect(database or config["data"]["observation_database"])
+    try:
+        readings = connection.execute(
+            "SELECT morbidostat_unit, angle, timestamp, od_reading_v FROM od_readings_raw WHERE experiment = ?", (experiment,)
+        ).fetchall()
+        io_events = connection.execute(
+            "SELECT morbidostat_unit, timestamp FROM io_events WHERE experiment = ?", (experiment,)
+        ).fetchall()
+    finally:
+        connection.close()
+    if not readings:
+        return []
+
+    unit_column, angle_column, label_column, value_column = (np.array(column) for column in zip(*readings))
+    time_column = parse_timestamps(label_column)
+    value_column = value_column.astype(float)
+    event_units = np.array([row[0] for row in io_events])
+    event_times = parse_timestamps([row[1] for row in io_events]) if io_events else np.empty(0)
+
+    recordings = []
+    for unit in sorted(set(unit_column.tolist())) if units is None else units:
+        rows = unit_column == str(unit)
+        angles = list(growth_rate_model.sorted_observations(dict.fromkeys(angle_column[rows].tolist())))
+        if not angles:
+            continue
+
+        series = {}
+        for angle in angles:
+            in_angle = rows & (angle_column == angle)
+            order = np.argsort(time_column[in_angle], kind="stable")
+            series[angle] = (time_column[in_angle][order], value_column[in_angle][order], label_column[in_angle][order])
+
+        # the first angle's readings are the steps. The others are matched to them within half a sampling interval.
+        timestamps, values, labels = series[angles[0]]
+        tolerance = np.median(np.diff(timestamps)) / 2 if len(timestamps) > 1 else 0.0
+        matched = [values]
+        for angle in angles[1:]:
+            index = nearest(series[angle][0], timestamps, tolerance)
+            matched.append(np.where(index >= 0, series[angle][1][index], np.nan))
+        readings = np.column_stack(matched)
+        complete = ~np.isnan(readings).any(axis=1)
+        timestamps, labels, readings = timestamps[complete], labels[complete], readings[complete]
+
+        # an event bumps the variance from the next reading on.
+        io_event_steps = np.unique(np.searchsorted(timestamps, event_times[event_units == str(unit)], side="right"))
+        io_event_steps = io_event_steps[(io_event_steps > 0) & (io_event_steps < len(timestamps))]
+
+        recordings.append(Recording(experiment, str(unit), angles, timestamps, labels, readings, io_event_steps))
+    return recordings
+
+
+def normalize(recording, normalization_samples=51):
+    """
+    The readings divided by their medians, and the filter's covariances (see growth_rate_model.create_covariances).
+    """
+    angles, readings = recording.angles, recording.readings
+    medians = np.median(readings[:normalization_samples], axis=0)
+    if min(normalization_samples, readings.shape[0]) > 1:
+        variances = readings[:normalization_samples].var(axis=0, ddof=1)
+    else:
+        variances = np.full(len(angles), 1e-5)
+    return readings / medians, dict(zip(angles, medians)), dict(zip(angles, variances))
+
+
+def run_filter(recording, normalization_samples=51, kalman_parameters=None):
+    """
+    Replay `recording` through the filter that growth_rate_calculating runs, from a growth rate of 0. Returns a
+    FilterHistory. Step 0 is the first reading, the filter's initial state. `kalman_parameters` defaults to the config's.
+    """
+    kalman_parameters = kalman_parameters or growth_rate_model.read_kalman_parameters()
+    T, d = recording.readings.shape[0], len(recording.angles) + 1
+    samples_per_second = 1 / np.median(np.diff(recording.timestamps))
+
+    observations, medians, variances = normalize(recording, normalization_samples)
+    initial_state = np.append(observations[0], 1.0)
+    ekf = ExtendedKalmanFilter(
+        initial_state, *growth_rate_model.create_covariances(recording.angles, medians, variances, kalman_parameters)
+    )
+
+    states, covariances = np.empty((T, d)), np.empty((T, d, d))
+    predicted_states, predicted_covariances, jacobians = np.empty((T, d)), np.empty((T, d, d)), np.empty((T, d, d))
+    states[0], covariances[0], jacobians[0] = ekf.state_, ekf.covariance_, np.eye(d)
+    predicted_states[0], predicted_covariances[0] = states[0], covariances[0]
+
+    # as GrowthRateCalculator.update_ekf_variance_after_io_event, for two minutes.
+    n_steps_after_io_event = round(2 * 60 * samples_per_second)
+    io_event_steps = set(recording.io_event_steps.tolist())
+    for t in range(1, T):
+        if t in io_event_steps:
+            ekf.scale_OD_variance_for_next_n_steps(kalman_parameters["io_event_variance_factor"], n_steps_after_io_event)
+        ekf.update(observations[t])
+        states[t], covariances[t] = ekf.state_, ekf.covariance_
+        predicted_states[t], predicted_covariances[t] = ekf.predicted_state_, ekf.predicted_covariance_
+        jacobians[t] = ekf.jacobian_
+
+    return FilterHistory(states, covariances, predicted_states, predicted_covariances, jacobians, samples_per_second)
+
+
+def rts_smooth(history, covariances=True):
+    """
+    The Rauch-Tung-Striebel smoothed (states, covariances), or (states, None). Going back from the last step,
+
+        x_s[t] = x[t] + C[t] (x_s[t+1] - x_pred[t+1]),    P_s[t] = P[t] + C[t] (P_s[t+1] - P_pred[t+1]) C[t]^T
+
+    with gains C[t] = P[t] F[t+1]^T P_pred[t+1]^-1, which don't depend on the smoothed values, so they're solved for
+    all at once. The recursion is then affine, x_s[t] = b[t] + C[t] x_s[t+1] (and likewise for P_s), and the
+    composition of affine maps is associative, so rather than T sequential steps it's computed as a scan: log2(T)
+    rounds, each composing every step's map with the one `offset` steps later. The covariances take most of the time.
+    """
+    x, P, F = history.states, history.covariances, history.jacobians
+    x_pred, P_pred = history.predicted_states, history.predicted_covariances
+    if x.shape[0] < 2:
+        return x.copy(), P.copy() if covariances else None
+
+    def transpose(A):
+        return A.transpose(0, 2, 1)
+
+    # the covariances are symmetric, so C[t]^T = P_pred[t+1]^-1 F[t+1] P[t]
+    C = transpose(np.linalg.solve(P_pred[1:], F[1:] @ P[:-1]))
+    b = x[:-1] - (C @ x_pred[1:, :, None])[..., 0]
+    A = P[:-1] - C @ P_pred[1:] @ transpose(C) if covariances else None
+
+    n, offset = C.shape[0], 1
+    while offset < n:
+        head, tail = slice(0, n - offset), slice(offset, n)
+        b[head] += (C[head] @ b[tail, :, None])[..., 0]
+        if covariances:
+            A[head] += C[head] @ A[tail] @ transpose(C[head])
+        C[head] = C[head] @ C[tail]
+        offset *= 2
+
+    smoothed_states = np.empty_like(x)
+    smoothed_states[-1], smoothed_states[:-1] = x[-1], b + (C @ x[-1])
+    if not covariances:
+        return smoothed_states, None
+    smoothed_covariances = np.empty_like(P)
+    smoothed_covariances[-1], smoothed_covariances[:-1] = P[-1], A + C @ P[-1] @ transpose(C)
+    return smoothed_states, smoothed_covariances
+
+
+def growth_rates(states, samples_per_second):
+    # the filter's rate is per sample: as growth_rate_calculating publishes it, per hour.
+    return np.log(states[:, -1]) * 60 * 60 * samples_per_second
+
+
+def write_smoothed(recording, states, samples_per_second, database=None):
+    """
+    Replace the unit's rows in `od_readings_smoothed` and `growth_rates_smoothed` with `states`.
+    """
+    experiment, unit, labels = recording.experiment, recording.unit, recording.timestamp_labels.tolist()
+    connection = sqlite3.connect(database or config["data"]["observation_database"])
+    try:
+        with connection:
+            for table in ("od_readings_smoothed", "growth_rates_smoothed"):
+                connection.execute(f"DELETE FROM {table} WHERE experiment = ? AND morbidostat_unit = ?", (experiment, unit))
+            for (i, angle) in enumerate(recording.angles):
+                connection.executemany(
+                    "INSERT INTO od_readings_smoothed (timestamp, morbidostat_unit, od_reading_v, experiment, angle) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    zip(labels, [unit] * len(labels), states[:, i].tolist(), [experiment] * len(labels), [angle] * len(labels)),
+                )
+            connection.executemany(
+                "INSERT INTO growth_rates_smoothed (timestamp, experiment, rate, morbidostat_unit) VALUES (?, ?, ?, ?)",
+                zip(labels, [experiment] * len(labels), growth_rates(states, samples_per_second).tolist(), [unit] * len(labels)),
+            )
+    finally:
+        connection.close()
+
+
+def replay_growth_rates(experiment, units=None, smooth=True, normalization_samples=51, database=None, verbose=0):
+    """
+    Replay (and smooth, and write back) the growth rates of `units` in `experiment`. Returns {unit: growth rates}.
+    """
+    results = {}
+    for recording in load_recordings(experiment, units, database=database):
+        history = run_filter(recording, normalization_samples)
+        states = rts_smooth(history, covariances=False)[0] if smooth else history.states
+        if smooth:
+            write_smoothed(recording, states, history.samples_per_second, database=database)
+        results[recording.unit] = rates = growth_rates(states, history.samples_per_second)
+        if verbose:
+            click.echo(f"{recording.unit}: {len(recording.timestamps)} readings, last growth rate {rates[-1]:.4f}")
+    return results
+
+
+@click.command()
+@click.option("--experiment", required=True, help="the experiment to replay")
+@click.option("--unit", "units", multiple=True, help="a unit to replay. Can be invoked multiple times (default: all)")
+@click.option("--smooth/--no-smooth", default=True, show_default=True, help="smooth, and write the smoothed series back")
+@click.option("--normalization-samples", default=51, show_default=True, help="readings to normalize by")
+@click.option("--verbose", "-v", count=True, help="print to std out")
+def click_replay_growth_rates(experiment, units, smooth, normalization_samples, verbose):
+    replay_growth_rates(
+        experiment, units or None, smooth=smooth, normalization_samples=normalization_samples, verbose=verbose + 1
+    )
+
+
+if __name__ == "__main__":
+    click_replay_growth_rates()
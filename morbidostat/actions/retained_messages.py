@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk operations on the retained messages in the broker, all over one connection:
+
+> mb retained_messages prune --topics "morbidostat/+/old_experiment/#"
+> mb retained_messages dump --topics "morbidostat/#" --output retained.snapshot
+> mb retained_messages restore --input retained.snapshot
+
+A snapshot is a gzipped stream of records, each a (topic length, payload length) header followed by the topic
+and the payload.
+"""
+import gzip
+import struct
+import time
+
+import click
+
+from morbidostat.config import leader_hostname
+from morbidostat.pubsub import RetainedMessagesClient, prune_retained_messages
+
+SNAPSHOT_MAGIC = b"MBRETAIN1\n"
+RECORD_HEADER = struct.Struct("<HI")
+
+
+def write_snapshot(path, messages):
+    count = 0
+    with gzip.open(path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        for message in messages:
+            topic = message.topic.encode("utf-8")
+            f.write(RECORD_HEADER.pack(len(topic), len(message.payload)))
+            f.write(topic)
+            f.write(message.payload)
+            count += 1
+    return count
+
+
+def read_snapshot(path):
+    """
+    Yields (topic, payload) pairs.
+    """
+    with gzip.open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a retained message snapshot.")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            topic_length, payload_length = RECORD_HEADER.unpack(header)
+            yield f.read(topic_length).decode("utf-8"), f.read(payload_length)
+
+
+def prune(topics, hostname=leader_hostname, batch_size=500):
+    return prune_retained_messages(topics, hostname=hostname, batch_size=batch_size)
+
+
+def dump(topics, output, hostname=leader_hostname):
+    with RetainedMessagesClient(hostname) as client:
+        return write_snapshot(output, client.stream(topics))
+
+
+def restore(input_, hostname=leader_hostname, batch_size=500):
+    with RetainedMessagesClient(hostname, batch_size=batch_size) as client:
+        return client.publish_retained(read_snapshot(input_))
+
+
+def report(verb, func, *args, **kwargs):
+    start = time.perf_counter()
+    count = func(*args, **kwargs)
+    click.echo(f"{verb} {count} retained topics in {time.perf_counter() - start:.2f}s.")
+    return count
+
+
+@click.group()
+def click_retained_messages():
+    pass
+
+
+@click_retained_messages.command(name="prune")
+@click.option("--topics", multiple=True, default=["morbidostat/#"], show_default=True, help="topic filter(s) to clear")
+@click.option("--hostname", default=leader_hostname, show_default=True)
+@click.option("--batch-size", default=500, show_default=True, help="clears sent before waiting for acks")
+def click_prune(topics, hostname, batch_size):
+    report("Cleared", prune, list(topics), hostname=hostname, batch_size=batch_size)
+
+
+@click_retained_messages.command(name="dump")
+@click.option("--topics", multiple=True, default=["morbidostat/#"], show_default=True, help="topic filter(s) to dump")
+@click.option("--output", required=True, type=click.Path(dir_okay=False, writable=True))
+@click.option("--hostname", default=leader_hostname, show_default=True)
+def click_dump(topics, output, hostname):
+    report("Dumped", dump, list(topics), output, hostname=hostname)
+
+
+@click_retained_messages.command(name="restore")
+@click.option("--input", "input_", required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--hostname", default=leader_hostname, show_default=True)
+@click.option("--batch-size", default=500, show_default=True, help="messages sent before waiting for acks")
+def click_restore(input_, hostname, batch_size):
+    report("Restored", restore, input_, hostname=hostname, batch_size=batch_size)
+
+
+if __name__ == "__main__":
+    click_retained_messages()
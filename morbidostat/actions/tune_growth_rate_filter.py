@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Search for the growth rate filter's noise parameters (KALMAN_PARAMETERS, in utils/growth_rate_model) on recorded
+experiments, and write the best as a [growth_rate_kalman] config section.
+
+> mb tune_growth_rate_filter --experiment Trial-24 --experiment Trial-25 --search random --candidates 200 --output tuned.ini
+
+Each candidate replays the units' readings through the filter, as replay_growth_rates does, and is scored by:
+
+- the log-likelihood of the readings under the filter's one-step-ahead predictions, per reading. The innovation
+  y[t] - x_pred[t] is Gaussian, with covariance S[t] = P_pred[t] + R (the ODs' block of P_pred). A filter that's too
+  sure of itself, too vague, or slow to follow the culture scores lower.
+- the lag after dilutions: the minutes until the growth rate is back within `--lag-tolerance` (per hour) of its value
+  before each io event, as a dilution doesn't change the growth rate.
+
+The best candidate has the highest likelihood of those with a mean lag within `--max-lag` minutes.
+
+The readings are loaded and aligned once. The pool's processes are spawned, and get them once, when they
+start, and keep them between candidates.
+"""
+import itertools
+import multiprocessing
+from collections import namedtuple
+
+import click
+import numpy as np
+
+from morbidostat.actions.replay_growth_rates import growth_rates, load_recordings, normalize, run_filter
+from morbidostat.utils import growth_rate_model
+
+# the parameters are searched on a log scale, between these.
+RANGES = {
+    "rate_process_variance": (1e-16, 1e-12),
+    "od_process_variance": (1e-10, 1e-6),
+    "observation_noise_factor": (0.5, 50.0),
+    "io_event_variance_factor": (1e2, 1e6),
+}
+
+# the default `n` of create_candidates: random candidates, or values of each parameter on a grid, which has n**4 points.
+DEFAULT_CANDIDATES = {"random": 100, "grid": 5}
+MAX_CANDIDATES = 10000
+
+# log_likelihood is per reading, and lag_minutes is the mean over the io events (nan if there were none).
+Score = namedtuple("Score", ["kalman_parameters", "log_likelihood", "lag_minutes"])
+
+# each of the pool's processes keeps the recordings, and how to score them, here.
+_worker = {}
+
+
+def init_worker(recordings, normalization_samples, lag_tolerance, lag_window):
+    _worker.update(
+        recordings=recordings, normalization_samples=normalization_samples, lag_tolerance=lag_tolerance, lag_window=lag_window
+    )
+
+
+def create_candidates(search, n=None, ranges=RANGES, seed=0):
+    """
+    Grid search: all the combinations of `n` values of each parameter. Random search: `n` sets of values, each drawn
+    uniformly on a log scale. The config's parameters are always the first candidate. Raises ValueError for more than
+    MAX_CANDIDATES.
+    """
+    n = n or DEFAULT_CANDIDATES[search]
+    names = list(ranges)
+    log_ranges = [np.log10(ranges[name]) for name in names]
+    if search == "grid":
+        n_points = int(np.prod([1 if low == high else n for (low, high) in log_ranges]))
+        if n_points > MAX_CANDIDATES:
+            raise ValueError(
+                f"A grid of {n} values of each of {len(names)} parameters is {n_points} candidates, more than "
+                f"{MAX_CANDIDATES}. Use fewer values, fix some parameters with equal bounds, or a random search."
+            )
+        points = itertools.product(*[np.unique(np.logspace(low, high, n)) for (low, high) in log_ranges])
+    else:
+        if n > MAX_CANDIDATES:
+            raise ValueError(f"{n} candidates is more than {MAX_CANDIDATES}.")
+        rng = np.random.default_rng(seed)
+        points = 10 ** np.column_stack([rng.uniform(low, high, n) for (low, high) in log_ranges])
+    return [growth_rate_model.read_kalman_parameters()] + [dict(zip(names, map(float, point))) for point in points]
+
+
+def log_likelihood(recording, history, normalization_samples, kalman_parameters):
+    """
+    The sum of the log-likelihoods of the readings after the first, under the filter's one-step-ahead predictions.
+    """
+    m = len(recording.angles)
+    observations, medians, variances = normalize(recording, normalization_samples)
+    R = growth_rate_model.create_covariances(recording.angles, medians, variances, kalman_parameters)[2]
+
+    innovations = observations[1:] - history.predicted_states[1:, :m]
+    S = history.predicted_covariances[1:, :m, :m] + R
+    _, log_determinants = np.linalg.slogdet(S)
+    mahalanobis = np.einsum("ti,ti->t", innovations, np.linalg.solve(S, innovations[..., None])[..., 0])
+    return -0.5 * (len(S) * m * np.log(2 * np.pi) + log_determinants.sum() + mahalanobis.sum())
+
+
+def lags_after_io_events(recording, history, tolerance, window):
+    """
+    For each io event, the steps until the growth rate is back within `tolerance` of its value before the event, and
+    stays there for the rest of the `window` steps after it (or until the next event).
+    """
+    rates = growth_rates(history.states, history.samples_per_second)
+    starts = recording.io_event_steps
+    ends = np.minimum(np.append(starts[1:], len(rates)), starts + window)
+    lags = np.zeros(len(starts))
+    for (i, (start, end)) in enumerate(zip(starts, ends)):
+        outside = np.flatnonzero(np.abs(rates[start:end] - rates[start - 1]) > tolerance)
+        lags[i] = outside[-1] + 1 if len(outside) else 0
+    return lags
+
+
+def score(kalman_parameters):
+    """
+    The candidate's Score on the process's recordings (see init_worker).
+    """
+    normalization_samples, tolerance = _worker["normalization_samples"], _worker["lag_tolerance"]
+    total_log_likelihood, n_readings, lags = 0.0, 0, []
+    try:
+        for recording in _worker["recordings"]:
+            history = run_filter(recording, normalization_samples, kalman_parameters)
+            minutes_per_step = 1 / history.samples_per_second / 60
+            total_log_likelihood += log_likelihood(recording, history, normalization_samples, kalman_parameters)
+            n_readings += len(recording.timestamps) - 1
+            window = round(_worker["lag_window"] / minutes_per_step)
+            lags.extend(lags_after_io_events(recording, history, tolerance, window) * minutes_per_step)
+    except np.linalg.LinAlgError:
+        # the filter diverged
+        return Score(kalman_parameters, -np.inf, np.nan)
+
+    per_reading = total_log_likelihood / max(n_readings, 1)
+    return Score(kalman_parameters, per_reading if np.isfinite(per_reading) else -np.inf, np.mean(lags) if lags else np.nan)
+
+
+def search(recordings, candidates, processes=None, normalization_samples=51, lag_tolerance=0.02, lag_window=60):
+    """
+    The Score of each candidate, computed on a pool of `processes` (default: one per CPU). With one, in this process.
+    """
+    options = (recordings, normalization_samples, lag_tolerance, lag_window)
+    if processes == 1:
+        init_worker(*options)
+        return [score(candidate) for candidate in candidates]
+
+    # not forked: this process's threads (MQTT clients, the broker in tests) may hold locks that a fork would copy locked.
+    with multiprocessing.get_context("spawn").Pool(processes, initializer=init_worker, initargs=options) as pool:
+        return pool.map(score, candidates, chunksize=1)
+
+
+def best(scores, max_lag=None):
+    """
+    The most likely of the scores with a lag within `max_lag` minutes, or, if there are none, the one with the least lag.
+    """
+    within = [s for s in scores if max_lag is None or not s.lag_minutes > max_lag]
+    if not within:
+        return min(scores, key=lambda s: s.lag_minutes)
+    return max(within, key=lambda s: s.log_likelihood)
+
+
+def config_section(kalman_parameters, experiments):
+    lines = ["[growth_rate_kalman]", f"# tuned on {', '.join(experiments)} with `mb tune_growth_rate_filter`"]
+    lines += [f"{name}={value:.3g}" for (name, value) in kalman_parameters.items()]
+    return "\n".join(lines) + "\n"
+
+
+def tune_growth_rate_filter(
+    experiments,
+    units=None,
+    search_type="random",
+    n_candidates=None,
+    ranges=RANGES,
+    seed=0,
+    processes=None,
+    normalization_samples=51,
+    lag_tolerance=0.02,
+    lag_window=60,
+    max_lag=None,
+    output=None,
+    database=None,
+    verbose=0,
+):
+    """
+    Score the candidates on the units' recordings in `experiments`, and write the best as a config section to
+    `output` (default: std out). `n_candidates` is as create_candidates's `n`. Returns the best Score.
+    """
+    recordings = [recording for experiment in experiments for recording in load_recordings(experiment, units, database=database)]
+    if not recordings:
+        raise ValueError(f"No readings in {', '.join(experiments)}.")
+
+    candidates = create_candidates(search_type, n_candidates, ranges, seed)
+    if verbose:
+        n_readings = sum(len(recording.timestamps) for recording in recordings)
+        click.echo(f"Scoring {len(candidates)} candidates on {len(recordings)} units, {n_readings} readings.")
+
+    scores = search(recordings, candidates, processes, normalization_samples, lag_tolerance, lag_window)
+    winner = best(scores, max_lag)
+    if verbose:
+        click.echo(f"current: log-likelihood {scores[0].log_likelihood:.3f}, lag {scores[0].lag_minutes:.1f} minutes")
+        click.echo(f"best: log-likelihood {winner.log_likelihood:.3f}, lag {winner.lag_minutes:.1f} minutes")
+
+    section = config_section(winner.kalman_parameters, experiments)
+    if output:
+        with open(output, "w") as f:
+            f.write(section)
+    else:
+        click.echo(section)
+    return winner
+
+
+@click.command()
+@click.option(
+    "--experiment", "experiments", required=True, multiple=True, help="a recorded experiment. Can be invoked multiple times"
+)
+@click.option("--unit", "units", multiple=True, help="a unit to replay. Can be invoked multiple times (default: all)")
+@click.option("--search", "search_type", type=click.Choice(["random", "grid"]), default="random", show_default=True)
+@click.option(
+    "--candidates",
+    "n_candidates",
+    type=int,
+    help=f"random: candidates (default {DEFAULT_CANDIDATES['random']}). "
+    f"grid: values per parameter (default {DEFAULT_CANDIDATES['grid']})",
+)
+@click.option(
+    "--range",
+    "ranges",
+    multiple=True,
+    type=(click.Choice(list(RANGES)), float, float),
+    help="a parameter's range, ex: --range rate_process_variance 1e-15 1e-13. Equal bounds fix it",
+)
+@click.option("--seed", default=0, show_default=True)
+@click.option("--processes", type=int, help="default: one per CPU")
+@click.option("--normalization-samples", default=51, show_default=True, help="readings to normalize by")
+@click.option("--lag-tolerance", default=0.02, show_default=True, help="per hour")
+@click.option("--lag-window", default=60, show_default=True, help="minutes after an io event to measure the lag in")
+@click.option("--max-lag", type=float, help="minutes. Default: no limit")
+@click.option("--output", type=click.Path(), help="a file to write the config section to (default: std out)")
+@click.option("--verbose", "-v", count=True, help="print to std out")
+def click_tune_growth_rate_filter(
+    experiments,
+    units,
+    search_type,
+    n_candidates,
+    ranges,
+    seed,
+    processes,
+    normalization_samples,
+    lag_tolerance,
+    lag_window,
+    max_lag,
+    output,
+    verbose,
+):
+    tune_growth_rate_filter(
+        experiments,
+        units or None,
+        search_type=search_type,
+        n_candidates=n_candidates,
+        ranges={**RANGES, **{name: (low, high) for (name, low, high) in ranges}},
+        seed=seed,
+        processes=processes,
+        normalization_samples=normalization_samples,
+        lag_tolerance=lag_tolerance,
+        lag_window=lag_window,
+        max_lag=max_lag,
+        output=output,
+        verbose=verbose + 1,
+    )
+
+
+if __name__ == "__main__":
+    click_tune_growth_rate_filter()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio flavour of `morbidostat.pubsub`. It shares the process's publish queue and subscriber connection, and
+hands incoming messages to the event loop, so coroutines never block on the network.
+
+    async with async_pubsub.subscribe_iter("morbidostat/+/exp/growth_rate") as messages:
+        async for message in messages:
+            ...
+
+"""
+import asyncio
+import time
+
+from morbidostat import pubsub
+from morbidostat.pubsub import QOS
+from morbidostat.config import leader_hostname
+
+
+async def publish(topic, message, hostname=leader_hostname, verbose=0, **mqtt_kwargs):
+    # pubsub.publish only puts the message on a queue, so it's safe to call from the loop.
+    pubsub.publish(topic, message, hostname=hostname, verbose=verbose, **mqtt_kwargs)
+
+
+async def flush(hostname=leader_hostname, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, pubsub.flush, hostname, timeout)
+
+
+# put on an AsyncSubscription's queue after its last message.
+_END = object()
+
+
+class AsyncSubscription:
+    """
+    An async iterator over messages on `topics`. Iteration ends after `max_msgs` messages, after `timeout`
+    seconds, or when `cancel` is called.
+    """
+
+    def __init__(self, topics, hostname=leader_hostname, qos=QOS.AT_MOST_ONCE, timeout=None, max_msgs=None, loop=None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._delivered = 0
+        self._finished = False
+        self.max_msgs = max_msgs
+        self.subscription = pubsub.get_subscribe_client(hostname).add(
+            pubsub.Subscription(self._put, pubsub._as_list(topics), qos=qos, timeout=timeout, max_msgs=max_msgs)
+        )
+
+    def _put(self, message):
+        # called from paho's network thread. The subscription has already finished when the last message gets here,
+        # so the end of the iteration is queued behind it, rather than read from `subscription.is_alive()`.
+        self._delivered += 1
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        if self.max_msgs is not None and self._delivered >= self.max_msgs:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, _END)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+
+        try:
+            message = self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            deadline = self.subscription.deadline
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                message = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                self.cancel()
+                message = _END
+
+        if message is _END:
+            self._finished = True
+            raise StopAsyncIteration
+        return message
+
+    def cancel(self):
+        # messages already received are still iterated over. Can be called from any thread.
+        if self.subscription.is_alive():
+            self.subscription.cancel()
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, _END)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.cancel()
+
+
+def subscribe_iter(topics, hostname=leader_hostname, qos=QOS.AT_MOST_ONCE, timeout=None, max_msgs=None):
+    return AsyncSubscription(topics, hostname=hostname, qos=qos, timeout=timeout, max_msgs=max_msgs)
+
+
+async def subscribe(topics, hostname=leader_hostname, qos=QOS.AT_MOST_ONCE, timeout=None):
+    """
+    Wait for one message on `topics`. Returns None if nothing arrived within `timeout` seconds.
+    """
+    async with subscribe_iter(topics, hostname=hostname, qos=qos, timeout=timeout, max_msgs=1) as messages:
+        async for message in messages:
+            return message
+    return None
+
+
+async def get_retained(topics, hostname=leader_hostname, timeout=3.0):
+    """
+    Returns a dict of topic -> retained payload (None if there is none). See `pubsub.get_retained`.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, pubsub.get_retained, topics, hostname, timeout)
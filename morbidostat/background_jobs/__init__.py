@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import copy
+import functools
+import inspect
+import json
+import os
 import signal
+import threading
+import time
 from typing import Optional, Union
 import sys
 import atexit
@@ -7,11 +16,16 @@ from collections import namedtuple
 
 from morbidostat.pubsub import subscribe_and_callback
 from morbidostat import utils
-from morbidostat.pubsub import publish, QOS
-from morbidostat.whoami import UNIVERSAL_IDENTIFIER
-from morbidostat.config import leader_hostname
+from morbidostat.pubsub import publish, publish_many, QOS, broker_address
+from morbidostat.whoami import UNIVERSAL_IDENTIFIER, latest_experiment, is_testing
+from morbidostat.config import leader_hostname, config
+from morbidostat.background_jobs.utils.job_stats import JobStats
+from morbidostat.utils.sampling_profiler import SamplingProfiler
+from morbidostat.utils import timing
 import paho.mqtt.client as mqtt
 
+_UNPUBLISHED = object()
+
 
 def split_topic_for_setting(topic):
     SetAttrSplitTopic = namedtuple("SetAttrSplitTopic", ["unit", "experiment", "job_name", "attr"])
@@ -38,6 +52,17 @@ class BackgroundJob:
         4. If the job exits otherwise (kill -9 or power loss), the state is `lost`, and a last-will saying so is broadcast.
     2. Attributes are broadcast under $properties, and each has $settable set to True. This isn't used at the moment.
 
+    An attribute is only published when its value changes. Changes made while handling one message (or inside
+    `with self.batched_attr_updates():`) are published together when the handler returns.
+
+    A job started in the latest experiment follows `morbidostat/latest_experiment`: when it changes, the job moves its
+    topics to the new experiment (see `set_experiment`), keeping its in-memory state.
+
+    Runtime metrics (callback latencies, messages in and out, drift of the periodic task, memory, CPU) are collected
+    in `self.stats`, and published to `morbidostat/<unit>/<experiment>/<job_name>/$stats`, see `utils/job_stats.py`.
+    A running job can be profiled for N seconds with `morbidostat/<unit>/<experiment>/<job_name>/$profile/set` N, see
+    `profile`.
+
     """
 
     # Homie device lifecycle
@@ -50,6 +75,12 @@ class BackgroundJob:
     editable_settings = []
 
     def __init__(self, job_name: str, verbose: int = 0, experiment: Optional[str] = None, unit: Optional[str] = None) -> None:
+        self._published_attrs = {}  # attr -> the value we last published
+        self._subscriptions = []
+        self._attr_batch = threading.local()
+        self.stats = JobStats()
+        self._stats_stopped = threading.Event()
+        self._profiler = None
         self.job_name = job_name
         self.experiment = experiment
         self.verbose = verbose
@@ -61,18 +92,24 @@ class BackgroundJob:
 
     def init(self):
         self.state = self.INIT
+        self.set_up_exit_handlers()
+        self.send_will_to_leader()
+        self.declare_settable_properties_to_broker()
+        self.start_general_passive_listeners()
+        self.follow_latest_experiment()
+        self.start_publishing_stats()
 
+    def set_up_exit_handlers(self):
         def disconnect_gracefully(*args):
-            self.set_state("disconnected")
+            if self.state != self.DISCONNECTED:
+                self.set_state(self.DISCONNECTED)
 
-        signal.signal(signal.SIGTERM, disconnect_gracefully)
-        signal.signal(signal.SIGINT, disconnect_gracefully)
+        # jobs started by a worker host run outside the main thread, and the host handles the signals for them.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, disconnect_gracefully)
+            signal.signal(signal.SIGINT, disconnect_gracefully)
         atexit.register(disconnect_gracefully)
 
-        self.send_will_to_leader()
-        self.declare_settable_properties_to_broker()
-        self.start_general_passive_listeners()
-
     def ready(self):
         self.state = self.READY
 
@@ -81,24 +118,71 @@ class BackgroundJob:
 
     def disconnected(self):
         self.state = self.DISCONNECTED
+        latest_experiment.remove_callback(self.set_experiment)
+        self._stats_stopped.set()
+        self.publish_stats()
+        if self._profiler is not None:
+            self._profiler.stop()
+        for subscription in self._subscriptions:
+            subscription.cancel()
         self._client.disconnect()
+        self._client.loop_stop()
+
+    def follow_latest_experiment(self):
+        if self.experiment is not None and self.experiment == latest_experiment.value:
+            latest_experiment.add_callback(self.set_experiment)
+            if not is_testing():
+                latest_experiment.watch()
+
+    def set_experiment(self, experiment):
+        """
+        Move the job to `experiment`: its attributes, listeners and last will are re-scoped to the new experiment's
+        topics. Nothing else is reset, so (ex:) a warmed up filter carries on. Subclasses with other per-experiment
+        topics or state extend this.
+        """
+        if experiment == self.experiment:
+            return
 
-    def declare_settable_properties_to_broker(self):
-        # this follows some of the Homie convention: https://homieiot.github.io/specification/
         publish(
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/$properties",
-            ",".join(self.editable_settings),
+            f"morbidostat/{self.unit}/{self.experiment}/log",
+            f"[{self.job_name}] Moving to experiment {experiment}.",
             verbose=self.verbose,
+        )
+        # to the old experiment, the job has stopped.
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/$state",
+            self.DISCONNECTED,
+            verbose=self.verbose,
+            retain=True,
             qos=QOS.AT_LEAST_ONCE,
         )
+        for subscription in self._subscriptions:
+            subscription.cancel()
+        self._subscriptions = []
+        self._client.disconnect()
+        self._client.loop_stop()
 
-        for setting in self.editable_settings:
-            publish(
-                f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/{setting}/$settable",
-                True,
-                verbose=self.verbose,
-                qos=QOS.AT_LEAST_ONCE,
-            )
+        self.experiment = experiment
+        self._published_attrs = {}
+        self.send_will_to_leader()
+        self.declare_settable_properties_to_broker()
+        with self.batched_attr_updates():
+            # as in __setattr__, settings a job hasn't set (ex: a turbidostat's target_growth_rate) aren't published.
+            for attr in self.editable_settings:
+                if hasattr(self, attr):
+                    self.publish_attr(attr)
+        self.start_general_passive_listeners()
+        self.start_passive_listeners()
+
+    def declare_settable_properties_to_broker(self):
+        # this follows some of the Homie convention: https://homieiot.github.io/specification/
+        prefix = f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}"
+        publish_many(
+            [(f"{prefix}/$properties", ",".join(self.editable_settings))]
+            + [(f"{prefix}/{setting}/$settable", True) for setting in self.editable_settings],
+            verbose=self.verbose,
+            qos=QOS.AT_LEAST_ONCE,
+        )
 
     def set_state(self, new_state):
         if hasattr(self, "state"):
@@ -119,6 +203,9 @@ class BackgroundJob:
         if attr == "$state":
             return self.set_state(new_value)
 
+        if attr == "$profile":
+            return self.profile(float(new_value))
+
         if attr not in self.editable_settings:
             return
 
@@ -138,27 +225,162 @@ class BackgroundJob:
         )
 
     def publish_attr(self, attr: str) -> None:
-        if attr == "state":
-            attr_name = "$state"
+        value = getattr(self, attr)
+        previous = self._published_attrs.get(attr, _UNPUBLISHED)
+        if type(previous) is type(value) and previous == value:
+            return
+
+        pending = getattr(self._attr_batch, "pending", None)
+        if pending is not None:
+            pending[attr] = value
         else:
-            attr_name = attr
+            self._publish_attrs({attr: value})
+
+    def _publish_attrs(self, values):
+        # copies, so that a dict or list changed in place compares unequal to what was published, and is republished.
+        # They're published as JSON.
+        self._published_attrs.update(copy.deepcopy(values))
+        # the values are retained, so a duplicate delivery is harmless: QoS 1 saves the QoS 2 handshake.
+        publish_many(
+            [
+                (
+                    f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/{'$state' if attr == 'state' else attr}",
+                    json.dumps(value) if isinstance(value, (dict, list)) else value,
+                )
+                for (attr, value) in values.items()
+            ],
+            verbose=self.verbose,
+            retain=True,
+            qos=QOS.AT_LEAST_ONCE,
+        )
+
+    @contextlib.contextmanager
+    def batched_attr_updates(self):
+        """
+        Hold attribute changes made in this thread, and publish the latest value of each when the block exits.
+        """
+        if getattr(self._attr_batch, "pending", None) is not None:
+            # already batching, the outer block publishes.
+            yield
+            return
+
+        self._attr_batch.pending = {}
+        try:
+            yield
+        finally:
+            pending, self._attr_batch.pending = self._attr_batch.pending, None
+            if pending:
+                self._publish_attrs(pending)
+
+    def _wrap_callback(self, callback):
+        # batch the attribute changes a message causes, and time the callback for $stats.
+        name = getattr(callback, "__name__", type(callback).__name__)
+        stats, monotonic = self.stats.callback(name), time.monotonic
+
+        @functools.wraps(callback)
+        def wrapped_callback(message, *args, **kwargs):
+            start = monotonic()
+            try:
+                with self.batched_attr_updates():
+                    return callback(message, *args, **kwargs)
+            finally:
+                stats.record(message, start, monotonic())
+
+        return wrapped_callback
+
+    def subscribe_and_callback(self, callback, topics, **kwargs):
+        """
+        Jobs register their listeners through this method (rather than `pubsub.subscribe_and_callback`), so that
+        subclasses like `AsyncBackgroundJob` can change where callbacks run.
+        """
+        subscription = subscribe_and_callback(self._wrap_callback(callback), topics, **kwargs)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def start_publishing_stats(self):
+        interval = float(config["job_stats"]["publish_interval"])
+        if interval <= 0:
+            return
+
+        def publish_stats_forever():
+            while not self._stats_stopped.wait(interval):
+                self.publish_stats()
 
+        threading.Thread(target=publish_stats_forever, name=f"{self.job_name}_stats", daemon=True).start()
+
+    def publish_stats(self):
         publish(
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/{attr_name}",
-            getattr(self, attr),
+            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/$stats",
+            json.dumps(self.stats.snapshot()),
             verbose=self.verbose,
             retain=True,
-            qos=QOS.EXACTLY_ONCE,
+            qos=QOS.AT_LEAST_ONCE,
+        )
+
+    def profile(self, seconds):
+        """
+        Sample the process's threads for `seconds` (0 stops a running profile early), then publish the collapsed
+        stacks, retained, to `morbidostat/<unit>/<experiment>/<job_name>/$profile`, and write them to
+        `[job_stats] profile_directory`. Render with ex: `flamegraph.pl profile.collapsed > profile.svg`.
+        """
+        if self._profiler is not None and not self._profiler.finished.is_set():
+            if seconds <= 0:
+                # the profile so far is published as usual.
+                self._profiler.stop()
+            return
+        if seconds <= 0:
+            return
+
+        self._profiler = SamplingProfiler(float(config["job_stats"]["profile_samples_per_second"]))
+        threading.Thread(
+            target=self._profile, args=(self._profiler, seconds), name=f"{self.job_name}_profile", daemon=True
+        ).start()
+
+    def _profile(self, profiler, seconds):
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/log",
+            f"[{self.job_name}] Profiling for {seconds:g}s.",
+            verbose=self.verbose,
         )
+        profiler.run(seconds)
+        collapsed = profiler.collapsed()
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/$profile",
+            collapsed,
+            verbose=self.verbose,
+            retain=True,
+            qos=QOS.AT_LEAST_ONCE,
+        )
+
+        directory = os.path.expanduser(config["job_stats"]["profile_directory"])
+        path = os.path.join(directory, f"{self.job_name}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                f.write(collapsed + "\n")
+            os.replace(path + ".tmp", path)
+        except OSError:
+            path = None
+
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/log",
+            f"[{self.job_name}] Profiled {profiler.samples} samples over {profiler.duration:.1f}s, sampling used "
+            f"{100 * profiler.overhead:.2f}% of a CPU. Published to $profile{f', written to {path}' if path else ''}.",
+            verbose=self.verbose,
+        )
+
+    def start_passive_listeners(self) -> None:
+        # jobs subscribe to what they need here; it's called again if the job moves to another experiment.
+        pass
 
     def start_general_passive_listeners(self) -> None:
 
-        subscribe_and_callback(
+        self.subscribe_and_callback(
             self.set_attr_from_message, f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/+/set", qos=QOS.EXACTLY_ONCE
         )
 
         # everyone listens to $unit (TODO: even leader?)
-        subscribe_and_callback(
+        self.subscribe_and_callback(
             self.set_attr_from_message,
             f"morbidostat/{UNIVERSAL_IDENTIFIER}/{self.experiment}/{self.job_name}/+/set",
             qos=QOS.EXACTLY_ONCE,
@@ -171,11 +393,165 @@ class BackgroundJob:
             "qos": QOS.EXACTLY_ONCE,
             "retain": True,
         }
+        # the will is part of CONNECT, and the broker only sends it if this connection is lost, so it's set first and
+        # the connection is kept alive.
         self._client = mqtt.Client()
-        self._client.connect(leader_hostname)
         self._client.will_set(**last_will)
+        self._client.connect(*broker_address(leader_hostname))
+        self._client.loop_start()
 
     def __setattr__(self, name: str, value: Union[int, str]) -> None:
         super(BackgroundJob, self).__setattr__(name, value)
         if (name in self.editable_settings) and hasattr(self, name):
             self.publish_attr(name)
+
+
+class AsyncBackgroundJob(BackgroundJob):
+    """
+    A BackgroundJob whose listeners and periodic tasks run as coroutines on one asyncio event loop, instead
+    of on pubsub's dispatch thread and `utils.timing.every`. Callbacks can be plain functions (which should return
+    quickly) or coroutine functions.
+
+    Can be used as a base class, or mixed into an existing job to run it on a shared loop:
+
+        class AsyncGrowthRateCalculator(AsyncBackgroundJob, GrowthRateCalculator):
+            pass
+
+        async def main():
+            calc = await AsyncGrowthRateCalculator.create(unit=unit, experiment=experiment)
+            await calc.run_forever()
+
+    """
+
+    def __init__(self, *args, loop=None, **kwargs):
+        self.loop = loop or asyncio.get_running_loop()
+        self.tasks = []
+        self._stopped = self.loop.create_future()
+        super(AsyncBackgroundJob, self).__init__(*args, **kwargs)
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """
+        Construct the job in a worker thread, so any blocking start up (ex: waiting on a first reading) doesn't stall the loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, *args, loop=loop, **kwargs))
+
+    def set_up_exit_handlers(self):
+        # the loop has one handler per signal, so it disconnects every job running on the loop.
+        jobs = _async_jobs.setdefault(self.loop, [])
+        jobs.append(self)
+
+        def disconnect_all():
+            for job in jobs:
+                if job.state != job.DISCONNECTED:
+                    job.set_state(job.DISCONNECTED)
+
+        def add_signal_handlers():
+            self.loop.add_signal_handler(signal.SIGTERM, disconnect_all)
+            self.loop.add_signal_handler(signal.SIGINT, disconnect_all)
+
+        self.loop.call_soon_threadsafe(add_signal_handlers)
+        atexit.register(lambda: self.state != self.DISCONNECTED and self.set_state(self.DISCONNECTED))
+
+    def _spawn(self, coroutine):
+        # may be called from the loop, or from the thread running `create`.
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        self.tasks.append(future)
+        return future
+
+    async def _run_callback(self, callback, stats, message=None):
+        start = time.monotonic()
+        try:
+            # an awaited callback can interleave with others on the loop, so only its synchronous part is batched.
+            with self.batched_attr_updates():
+                result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/error_log",
+                f"[{self.job_name}] failed with {str(e)}",
+                verbose=self.verbose,
+            )
+        finally:
+            # for coroutines, this includes the time spent awaiting.
+            stats.record(message, start, time.monotonic())
+
+    def subscribe_and_callback(self, callback, topics, **kwargs):
+        from morbidostat.async_pubsub import AsyncSubscription
+
+        # subscribe immediately so that retained messages aren't missed, and consume on the loop.
+        messages = AsyncSubscription(topics, loop=self.loop, **kwargs)
+        stats = self.stats.callback(getattr(callback, "__name__", type(callback).__name__))
+
+        async def listen():
+            async for message in messages:
+                await self._run_callback(functools.partial(callback, message), stats, message)
+
+        self._spawn(listen())
+        self._subscriptions.append(messages.subscription)
+        return messages.subscription
+
+    def every(self, delay, task, *args, clock=None, **kwargs):
+        """
+        Run `task` now and then every `delay` seconds on the loop. Like `utils.timing.every`, `task` is passed
+        `counter`, the number of the run (from 1), and runs are due on the Scheduler's schedule (`timing.catch_up`):
+        a late run doesn't push back the next ones, and runs more than a period behind are skipped.
+
+        clock: a `utils.timing` clock, MonotonicClock by default. With a VirtualClock, the loop doesn't wait between runs.
+        """
+        clock = clock or timing.MonotonicClock()
+        name = getattr(task, "__name__", type(task).__name__)
+        stats, task_stats = self.stats.callback(name), self.stats.task(name)
+
+        async def periodic():
+            due = clock.now()
+            counter = 0
+            while True:
+                await clock.sleep(max(0.0, due - clock.now()))
+                start = clock.now()
+                due, jitter, skipped = timing.catch_up(due, start, delay)
+                if self.state == self.READY:
+                    counter += 1
+                    self.stats.record_tick(jitter, skipped)
+                    await self._run_callback(functools.partial(task, *args, counter=counter, **kwargs), stats)
+                    duration = clock.now() - start
+                    task_stats.record(jitter, duration, overrun=duration > delay, skipped=skipped)
+                due += delay
+
+        return self._spawn(periodic())
+
+    def disconnected(self):
+        super(AsyncBackgroundJob, self).disconnected()
+        for task in self.tasks:
+            task.cancel()
+
+        def stop():
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+        def remove_signal_handlers():
+            # unless a job was started on the loop since.
+            if self.loop not in _async_jobs:
+                self.loop.remove_signal_handler(signal.SIGTERM)
+                self.loop.remove_signal_handler(signal.SIGINT)
+
+        # the loop's entry (and its signal handlers) goes with its last job, so a finished loop isn't kept.
+        jobs = _async_jobs.get(self.loop, [])
+        if self in jobs:
+            jobs.remove(self)
+        last = not jobs and _async_jobs.pop(self.loop, None) is not None
+
+        # at exit, the loop may be gone already.
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(stop)
+            if last:
+                self.loop.call_soon_threadsafe(remove_signal_handlers)
+
+    async def run_forever(self):
+        await self._stopped
+
+
+# loop -> the jobs running on it, which its signal handlers disconnect.
+_async_jobs = {}
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Run od_reading, growth_rate_calculating and io_controlling as coroutines on one asyncio event loop, in one process.
+Their listeners and periodic tasks are scheduled by the loop (see AsyncBackgroundJob), rather than each having
+pubsub's dispatch thread and a `utils.timing.every` loop of their own.
+
+>>> mb async_jobs --job od_reading --job growth_rate_calculating --job io_controlling --mode silent
+
+Each job is an AsyncBackgroundJob flavour of the usual class, and can be run on a loop of your own:
+
+    async def main():
+        await asyncio.gather(od_reading(), growth_rate_calculating())
+
+The growth rate filter's updates are short, and run on the loop. The readings wait on the ADCs, and the control
+algorithms on readings and on the pumps, so they're run in the loop's executor.
+"""
+import asyncio
+import functools
+
+import click
+
+from morbidostat import whoami
+from morbidostat.config import config
+from morbidostat.background_jobs import AsyncBackgroundJob
+from morbidostat.background_jobs.od_reading import ODReader, create_od_reader
+from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from morbidostat.background_jobs.io_controlling import ALGORITHMS, create_controller
+
+
+class AsyncODReader(AsyncBackgroundJob, ODReader):
+    async def take_reading(self, counter=None):
+        # a reading waits on the ADCs' conversions (and sleeps after an I2C error), so it's taken in the loop's executor.
+        return await self.loop.run_in_executor(None, functools.partial(ODReader.take_reading, self, counter=counter))
+
+
+class AsyncGrowthRateCalculator(AsyncBackgroundJob, GrowthRateCalculator):
+    pass
+
+
+ASYNC_ALGORITHMS = {
+    mode: type(f"Async{algorithm.__name__}", (AsyncBackgroundJob, algorithm), {}) for (mode, algorithm) in ALGORITHMS.items()
+}
+
+
+async def od_reading(od_angle_channel=None, sampling_rate=None, verbose=0):
+    loop = asyncio.get_running_loop()
+    od_angle_channel = od_angle_channel or list(config["od_config"].values())
+    sampling_rate = sampling_rate or 1 / float(config["od_sampling"]["samples_per_second"])
+
+    # setting up the ADCs, and looking up the experiment, can block.
+    reader = await loop.run_in_executor(
+        None, functools.partial(create_od_reader, od_angle_channel, verbose, job_class=AsyncODReader, loop=loop)
+    )
+    reader.every(sampling_rate, reader.take_reading)
+    await reader.run_forever()
+
+
+async def growth_rate_calculating(ignore_cache=False, verbose=0):
+    loop = asyncio.get_running_loop()
+    experiment = await loop.run_in_executor(None, whoami.get_latest_experiment_name)
+
+    # waits for a first reading.
+    calculator = await AsyncGrowthRateCalculator.create(
+        ignore_cache=ignore_cache, unit=whoami.unit, experiment=experiment, verbose=verbose
+    )
+    await calculator.run_forever()
+
+
+async def io_controlling(mode="silent", duration=60, skip_first_run=False, verbose=0, **kwargs):
+    loop = asyncio.get_running_loop()
+    controller = await loop.run_in_executor(
+        None,
+        functools.partial(
+            create_controller,
+            mode=mode,
+            duration=duration,
+            verbose=verbose,
+            job_class=ASYNC_ALGORITHMS[mode],
+            loop=loop,
+            **kwargs,
+        ),
+    )
+
+    async def run(counter=None):
+        return await loop.run_in_executor(None, functools.partial(controller.run, counter=counter))
+
+    if skip_first_run:
+        await asyncio.wait([controller._stopped], timeout=duration * 60)
+    if controller.state != controller.DISCONNECTED:
+        controller.every(duration * 60, run)
+    await controller.run_forever()
+
+
+# job name -> coroutine function running it until it's disconnected.
+ASYNC_JOBS = {"od_reading": od_reading, "growth_rate_calculating": growth_rate_calculating, "io_controlling": io_controlling}
+
+
+async def async_jobs(jobs):
+    """
+    Run `jobs`, a dict of job name (a key of ASYNC_JOBS) -> its kwargs, until they are all disconnected.
+    """
+    await asyncio.gather(*[ASYNC_JOBS[name](**kwargs) for (name, kwargs) in jobs.items()])
+
+
+@click.command()
+@click.option(
+    "--job", "jobs", multiple=True, type=click.Choice(list(ASYNC_JOBS)), help="a job to run. Can be invoked multiple times."
+)
+@click.option("--mode", default="silent", help="io_controlling: turbidostat, morbidostat, silent, etc.")
+@click.option("--target-od", default=None, type=float)
+@click.option("--target-growth-rate", default=None, type=float, help="used in PIDMorbidostat only")
+@click.option("--duration", default=60, help="io_controlling: time, in minutes, between every monitor check")
+@click.option("--volume", default=None, help="the volume to exchange, mL", type=float)
+@click.option("--sensor", default="135/A")
+@click.option("--skip-first-run", is_flag=True, help="wait <duration>min before io_controlling's first run.")
+@click.option("--verbose", "-v", count=True, help="print to std. out")
+def click_async_jobs(jobs, mode, target_od, target_growth_rate, duration, volume, sensor, skip_first_run, verbose):
+    kwargs = {name: {"verbose": verbose} for name in jobs}
+    if "io_controlling" in kwargs:
+        kwargs["io_controlling"].update(
+            mode=mode,
+            target_od=target_od,
+            target_growth_rate=target_growth_rate,
+            duration=duration,
+            volume=volume,
+            sensor=sensor,
+            skip_first_run=skip_first_run,
+        )
+    asyncio.run(async_jobs(kwargs))
+
+
+if __name__ == "__main__":
+    click_async_jobs()
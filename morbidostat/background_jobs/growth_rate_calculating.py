@@ -10,9 +10,12 @@ import numpy as np
 import click
 
 from morbidostat.utils.streaming_calculations import ExtendedKalmanFilter
-from morbidostat.pubsub import publish, subscribe, subscribe_and_callback
-from morbidostat.utils import log_start, log_stop
-from morbidostat.whoami import unit, experiment
+from morbidostat.utils import growth_rate_model
+from morbidostat.utils.growth_rate_model import KALMAN_PARAMETERS
+from morbidostat.pubsub import publish, subscribe, get_retained, set_publish_policy
+from morbidostat.utils import log_start, log_stop, wire_format
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.config import config, leader_hostname
 from morbidostat.background_jobs import BackgroundJob
 
@@ -30,11 +33,17 @@ class GrowthRateCalculator(BackgroundJob):
         self.ekf = None
         self.od_normalization_factors = defaultdict(lambda: 1)
         self.od_variances = defaultdict(lambda: 1e-5)
+        self.kalman_parameters = self.read_kalman_parameters()
         self.samples_per_minute = 60 * float(config["od_sampling"]["samples_per_second"])
+        self.batched_wire_format = config["od_sampling"].get("batched_wire_format", "json")
+        self.decoder = wire_format.Decoder()
+        self._binary_layouts = {}
+        self.set_publish_policies()
+        self.load_cached_values()
         self.start_passive_listeners()
 
-        time.sleep(3.0)
         self.ekf, self.angles = self.initialize_extended_kalman_filter()
+        self.publish_filtered_schema()
 
     @property
     def state_(self):
@@ -42,43 +51,64 @@ class GrowthRateCalculator(BackgroundJob):
 
     def initialize_extended_kalman_filter(self):
         message = subscribe(f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched")
-        angles_and_initial_points = self.scale_raw_observations(self.json_to_sorted_dict(message.payload))
+        angles_and_initial_points = self.scale_raw_observations(
+            self.sorted_observations(self.decoder.decode_to_dict(message.payload))
+        )
 
         # growth rate in MQTT is hourly, convert back to multiplicative
         initial_rate = self.exp_rate_to_multiplicative_rate(self.initial_growth_rate)
         initial_state = np.array([*angles_and_initial_points.values(), initial_rate])
 
-        d = initial_state.shape[0]
+        initial_covariance, process_noise_covariance, observation_noise_covariance = self.create_covariances(
+            angles_and_initial_points.keys(), self.od_normalization_factors, self.od_variances, self.kalman_parameters
+        )
 
-        # empirically selected
-        initial_covariance = np.block(
-            [[1e-5 * np.ones((d - 1, d - 1)), 1e-8 * np.ones((d - 1, 1))], [1e-8 * np.ones((1, d - 1)), 1e-8]]
+        return (
+            ExtendedKalmanFilter(initial_state, initial_covariance, process_noise_covariance, observation_noise_covariance),
+            list(angles_and_initial_points.keys()),
         )
-        OD_process_covariance = self.create_OD_covariance(angles_and_initial_points.keys())
 
-        rate_process_variance = 1e-14
-        process_noise_covariance = np.block(
-            [[OD_process_covariance, 0 * np.ones((d - 1, 1))], [0 * np.ones((1, d - 1)), rate_process_variance]]
+    def set_publish_policies(self):
+        # we publish on every raw sample, which is more than consumers need at high sampling rates.
+        max_rate = float(config["pubsub"]["max_stream_rate"])
+        set_publish_policy(f"morbidostat/{self.unit}/{self.experiment}/od_filtered/#", max_rate=max_rate)
+        set_publish_policy(f"morbidostat/{self.unit}/{self.experiment}/od_filtered_batched", max_rate=max_rate)
+        # io_controlling won't act on a growth rate older than 5 minutes, so send one at least every minute.
+        set_publish_policy(
+            f"morbidostat/{self.unit}/{self.experiment}/growth_rate", max_rate=max_rate, deadband=1e-5, max_interval=60
         )
-        observation_noise_covariance = self.create_obs_noise_covariance(angles_and_initial_points.keys())
 
-        return (
-            ExtendedKalmanFilter(initial_state, initial_covariance, process_noise_covariance, observation_noise_covariance),
-            angles_and_initial_points.keys(),
+    def publish_filtered_schema(self):
+        if self.batched_wire_format == "json":
+            return
+
+        self.filtered_schema, schema_payload = wire_format.create_schema(self.angles, dtype=self.batched_wire_format)
+        publish(
+            wire_format.schema_topic(f"morbidostat/{self.unit}/{self.experiment}/od_filtered_batched"),
+            schema_payload,
+            verbose=self.verbose,
+            retain=True,
         )
 
-    def create_obs_noise_covariance(self, angles):
-        # 5 is a fudge factor
-        return 5 * np.diag([self.od_variances[angle] / self.od_normalization_factors[angle] ** 2 for angle in angles])
+    def load_cached_values(self):
+        growth_rate_topic = f"morbidostat/{self.unit}/{self.experiment}/growth_rate"
+        median_topic = f"morbidostat/{self.unit}/{self.experiment}/od_normalization/median"
+        variance_topic = f"morbidostat/{self.unit}/{self.experiment}/od_normalization/variance"
+        schema_topic = wire_format.schema_topic(f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched")
+
+        retained = get_retained([growth_rate_topic, median_topic, variance_topic, schema_topic])
 
-    def set_initial_growth_rate(self, message):
-        self.initial_growth_rate = float(message.payload)
+        if retained[growth_rate_topic] is not None and not self.ignore_cache:
+            self.initial_growth_rate = float(retained[growth_rate_topic])
 
-    def set_od_normalization_factors(self, message):
-        self.od_normalization_factors = self.json_to_sorted_dict(message.payload)
+        if retained[median_topic] is not None:
+            self.od_normalization_factors = self.json_to_sorted_dict(retained[median_topic])
 
-    def set_od_variances(self, message):
-        self.od_variances = self.json_to_sorted_dict(message.payload)
+        if retained[variance_topic] is not None:
+            self.od_variances = self.json_to_sorted_dict(retained[variance_topic])
+
+        if retained[schema_topic] is not None:
+            self.decoder.add_schema(retained[schema_topic])
 
     def multiplicative_rate_to_exp_rate(self, mrate):
         return np.log(mrate) * 60 * self.samples_per_minute
@@ -87,11 +117,47 @@ class GrowthRateCalculator(BackgroundJob):
         return np.exp(erate / 60 / self.samples_per_minute)
 
     def update_ekf_variance_after_io_event(self, message):
-        self.ekf.scale_OD_variance_for_next_n_steps(2e4, 2 * self.samples_per_minute)
+        self.ekf.scale_OD_variance_for_next_n_steps(
+            self.kalman_parameters["io_event_variance_factor"], 2 * self.samples_per_minute
+        )
 
     def scale_raw_observations(self, observations):
         return {angle: observations[angle] / self.od_normalization_factors[angle] for angle in observations.keys()}
 
+    def scaled_observations_from_payload(self, payload):
+        """
+        Returns the scaled observations as an array, in the order of self.angles.
+        """
+        if wire_format.is_binary(payload):
+            schema, _, values = self.decoder.decode(payload)
+            index, normalization_factors = self.binary_layout(schema)
+            return values[index] / normalization_factors
+
+        scaled_observations = self.scale_raw_observations(self.json_to_sorted_dict(payload))
+        return np.array(list(scaled_observations.values()))
+
+    def binary_layout(self, schema):
+        # where each of self.angles is in a binary payload, computed once per schema.
+        if schema.id not in self._binary_layouts:
+            index = np.array([schema.channels.index(angle) for angle in self.angles])
+            normalization_factors = np.array([self.od_normalization_factors[angle] for angle in self.angles])
+            self._binary_layouts[schema.id] = (index, normalization_factors)
+        return self._binary_layouts[schema.id]
+
+    def add_schema(self, message):
+        self.decoder.add_schema(message.payload)
+
+    def publish_filtered(self):
+        for i, angle_label in enumerate(self.angles):
+            publish(f"morbidostat/{self.unit}/{self.experiment}/od_filtered/{angle_label}", self.state_[i], verbose=self.verbose)
+
+        if self.batched_wire_format != "json":
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/od_filtered_batched",
+                wire_format.encode(self.filtered_schema, self.state_[: len(self.angles)]),
+                verbose=self.verbose,
+            )
+
     def update_state_from_observation(self, message):
         if self.state != self.READY:
             return
@@ -101,9 +167,7 @@ class GrowthRateCalculator(BackgroundJob):
             return
 
         try:
-            observations = self.json_to_sorted_dict(message.payload)
-            scaled_observations = self.scale_raw_observations(observations)
-            self.ekf.update(list(scaled_observations.values()))
+            self.ekf.update(self.scaled_observations_from_payload(message.payload))
 
             publish(
                 f"morbidostat/{self.unit}/{self.experiment}/growth_rate",
@@ -112,11 +176,7 @@ class GrowthRateCalculator(BackgroundJob):
                 retain=True,
             )
 
-            for i, angle_label in enumerate(self.angles):
-                publish(
-                    f"morbidostat/{self.unit}/{self.experiment}/od_filtered/{angle_label}", self.state_[i], verbose=self.verbose
-                )
-
+            self.publish_filtered()
             return
 
         except Exception as e:
@@ -126,50 +186,44 @@ class GrowthRateCalculator(BackgroundJob):
                 verbose=self.verbose,
             )
 
-    def start_passive_listeners(self):
-        # initialize states
-        if not self.ignore_cache:
-            subscribe_and_callback(
-                self.set_initial_growth_rate, f"morbidostat/{self.unit}/{self.experiment}/growth_rate", timeout=3, max_msgs=1
-            )
+    def set_experiment(self, experiment):
+        # the filter carries on as it is: only the topics change.
+        super(GrowthRateCalculator, self).set_experiment(experiment)
+        self.set_publish_policies()
+        self.publish_filtered_schema()
 
-        subscribe_and_callback(
-            self.set_od_normalization_factors,
-            f"morbidostat/{self.unit}/{self.experiment}/od_normalization/median",
-            timeout=3,
-            max_msgs=1,
+    def start_passive_listeners(self):
+        # process incoming data
+        self.subscribe_and_callback(
+            self.add_schema, wire_format.schema_topic(f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched")
         )
-
-        subscribe_and_callback(
-            self.set_od_variances, f"morbidostat/{self.unit}/{self.experiment}/od_normalization/variance", timeout=3, max_msgs=1
+        self.subscribe_and_callback(
+            self.update_state_from_observation, f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched"
+        )
+        self.subscribe_and_callback(
+            self.update_ekf_variance_after_io_event, f"morbidostat/{self.unit}/{self.experiment}/io_events"
+        )
+        # a channel's reading can step when its ADC gain changes (each gain has its own error), like after a pump runs.
+        self.subscribe_and_callback(
+            self.update_ekf_variance_after_io_event, f"morbidostat/{self.unit}/{self.experiment}/od_gain_events"
         )
-
-        # process incoming data
-        subscribe_and_callback(self.update_state_from_observation, f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched")
-        subscribe_and_callback(self.update_ekf_variance_after_io_event, f"morbidostat/{self.unit}/{self.experiment}/io_events")
 
     @staticmethod
     def json_to_sorted_dict(json_dict):
         d = json.loads(json_dict)
-        return {k: float(d[k]) for k in sorted(d, reverse=True) if not k.startswith("180")}
-
-    @staticmethod
-    def create_OD_covariance(angles):
-        d = len(angles)
-        variances = {"135": 1e-8, "90": 1e-8, "45": 1e-8}
+        return GrowthRateCalculator.sorted_observations({k: float(v) for k, v in d.items()})
 
-        OD_covariance = 0 * np.ones((d, d))
-        for i, a in enumerate(angles):
-            for k in variances:
-                if a.startswith(k):
-                    OD_covariance[i, i] = variances[k]
-        return OD_covariance
+    # the filter's model is in utils/growth_rate_model.py, which offline tools can import without the job.
+    sorted_observations = staticmethod(growth_rate_model.sorted_observations)
+    read_kalman_parameters = staticmethod(growth_rate_model.read_kalman_parameters)
+    create_covariances = staticmethod(growth_rate_model.create_covariances)
+    create_OD_covariance = staticmethod(growth_rate_model.create_OD_covariance)
 
 
-@log_start(unit, experiment)
-@log_stop(unit, experiment)
+@log_start(unit)
+@log_stop(unit)
 def growth_rate_calculating(verbose, ignore_cache):
-    calculator = GrowthRateCalculator(verbose=verbose, ignore_cache=ignore_cache, unit=unit, experiment=experiment)
+    calculator = GrowthRateCalculator(verbose=verbose, ignore_cache=ignore_cache, unit=unit, experiment=whoami.experiment)
     while True:
         signal.pause()
 
@@ -14,11 +14,12 @@ import numpy as np
 from morbidostat.actions.add_media import add_media
 from morbidostat.actions.remove_waste import remove_waste
 from morbidostat.actions.add_alt_media import add_alt_media
-from morbidostat.pubsub import publish, subscribe_and_callback
+from morbidostat.pubsub import publish
 from morbidostat.utils import log_start, log_stop
 from morbidostat.utils.timing import every
 from morbidostat.utils.streaming_calculations import PID
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.background_jobs.subjobs.alt_media_calculating import AltMediaCalculator
 from morbidostat.background_jobs.subjobs.throughput_calculating import ThroughputCalculator
 from morbidostat.background_jobs.utils import events
@@ -129,9 +130,14 @@ class ControlAlgorithm(BackgroundJob):
     def most_stale_time(self):
         return min(self.latest_od_timestamp, self.latest_growth_rate_timestamp)
 
+    def set_experiment(self, experiment):
+        super(ControlAlgorithm, self).set_experiment(experiment)
+        if getattr(self, "pid", None) is not None:
+            self.pid.set_experiment(experiment)
+
     def start_passive_listeners(self):
-        subscribe_and_callback(self.set_OD, f"morbidostat/{self.unit}/{self.experiment}/od_filtered/{self.sensor}")
-        subscribe_and_callback(self.set_growth_rate, f"morbidostat/{self.unit}/{self.experiment}/growth_rate")
+        self.subscribe_and_callback(self.set_OD, f"morbidostat/{self.unit}/{self.experiment}/od_filtered/{self.sensor}")
+        self.subscribe_and_callback(self.set_growth_rate, f"morbidostat/{self.unit}/{self.experiment}/growth_rate")
 
 
 ######################
@@ -185,7 +191,17 @@ class PIDTurbidostat(ControlAlgorithm):
         self.volume = volume
         self.verbose = verbose
         self.duration = duration
-        self.pid = PID(-2, -0.15, -0, setpoint=self.target_od, output_limits=(0, 1), sample_time=None, verbose=self.verbose)
+        self.pid = PID(
+            -2,
+            -0.15,
+            -0,
+            setpoint=self.target_od,
+            output_limits=(0, 1),
+            sample_time=None,
+            unit=self.unit,
+            experiment=self.experiment,
+            verbose=self.verbose,
+        )
 
     def execute(self, *args, **kwargs) -> events.Event:
         if self.latest_od <= self.min_od:
@@ -239,7 +255,15 @@ class PIDMorbidostat(ControlAlgorithm):
         self.duration = duration
 
         self.pid = PID(
-            -0.5, -0.0001, -0.25, setpoint=self.target_growth_rate, output_limits=(0, 1), sample_time=None, verbose=self.verbose
+            -0.5,
+            -0.0001,
+            -0.25,
+            setpoint=self.target_growth_rate,
+            output_limits=(0, 1),
+            sample_time=None,
+            unit=self.unit,
+            experiment=self.experiment,
+            verbose=self.verbose,
         )
 
         if volume is not None:
@@ -335,19 +359,33 @@ class Morbidostat(ControlAlgorithm):
             )
 
 
-@log_start(unit, experiment)
-@log_stop(unit, experiment)
-def io_controlling(mode=None, duration=None, verbose=0, sensor="135/A", skip_first_run=False, **kwargs) -> Iterator[events.Event]:
+ALGORITHMS = {
+    "silent": Silent,
+    "morbidostat": Morbidostat,
+    "turbidostat": Turbidostat,
+    "pid_turbidostat": PIDTurbidostat,
+    "pid_morbidostat": PIDMorbidostat,
+}
+
+
+def create_controller(mode=None, duration=None, verbose=0, sensor="135/A", job_class=None, **kwargs) -> ControlAlgorithm:
+    # job_class: a subclass of the mode's algorithm to create instead, ex: an AsyncBackgroundJob flavour of it.
+    assert mode in ALGORITHMS.keys()
+
+    kwargs["verbose"] = verbose
+    kwargs["duration"] = duration
+    kwargs["unit"] = unit
+    kwargs["experiment"] = whoami.experiment
+    kwargs["sensor"] = sensor
 
-    algorithms = {
-        "silent": Silent,
-        "morbidostat": Morbidostat,
-        "turbidostat": Turbidostat,
-        "pid_turbidostat": PIDTurbidostat,
-        "pid_morbidostat": PIDMorbidostat,
-    }
+    return (job_class or ALGORITHMS[mode])(**kwargs)
 
-    assert mode in algorithms.keys()
+
+@log_start(unit)
+@log_stop(unit)
+def io_controlling(mode=None, duration=None, verbose=0, sensor="135/A", skip_first_run=False, **kwargs) -> Iterator[events.Event]:
+    assert mode in ALGORITHMS.keys()
+    experiment = whoami.experiment
 
     publish(
         f"morbidostat/{unit}/{experiment}/log",
@@ -359,19 +397,13 @@ def io_controlling(mode=None, duration=None, verbose=0, sensor="135/A", skip_fir
         publish(f"morbidostat/{unit}/{experiment}/log", f"[{JOB_NAME}]: skipping first run", verbose=verbose)
         time.sleep(duration * 60)
 
-    kwargs["verbose"] = verbose
-    kwargs["duration"] = duration
-    kwargs["unit"] = unit
-    kwargs["experiment"] = experiment
-    kwargs["sensor"] = sensor
-
-    algo = algorithms[mode](**kwargs)
+    algo = create_controller(mode=mode, duration=duration, verbose=verbose, sensor=sensor, **kwargs)
 
     def _gen():
         try:
-            yield from every(duration * 60, algo.run)
+            yield from every(duration * 60, algo.run, stats=algo.stats)
         except Exception as e:
-            publish(f"morbidostat/{unit}/{experiment}/error_log", f"[{JOB_NAME}]: failed {str(e)}", verbose=verbose)
+            publish(f"morbidostat/{unit}/{algo.experiment}/error_log", f"[{JOB_NAME}]: failed {str(e)}", verbose=verbose)
             raise e
 
     return _gen()
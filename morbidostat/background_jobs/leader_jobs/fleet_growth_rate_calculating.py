@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+This job runs on the leader, and computes the growth rates of every unit in the experiment, so the workers only need
+to run od_reading (and not growth_rate_calculating). It publishes to the same topics as growth_rate_calculating:
+
+    morbidostat/<unit>/<experiment>/growth_rate
+    morbidostat/<unit>/<experiment>/od_filtered/<angle>
+    morbidostat/<unit>/<experiment>/od_filtered_batched
+
+The units' filters are rows of `ExtendedKalmanFilterBank`s, one bank per number of sensors. Readings from
+`morbidostat/+/<experiment>/od_raw_batched` are queued as they arrive (with io events, in order), and every
+`--batch-interval` seconds all the units with a new reading are updated together, in one batched update per bank.
+
+A unit joins with its first reading (usually the retained one), which is its filter's initial state, as when
+growth_rate_calculating starts. It leaves when its od_reading disconnects (or is lost), and rejoins if its channels
+change.
+"""
+import os
+import threading
+from collections import defaultdict, deque
+
+import click
+import numpy as np
+
+from morbidostat.background_jobs import BackgroundJob
+from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from morbidostat.config import config
+from morbidostat.pubsub import publish, get_retained, set_publish_policy
+from morbidostat.utils import log_start, log_stop, wire_format
+from morbidostat.utils.streaming_calculations import ExtendedKalmanFilterBank
+from morbidostat.utils.timing import every
+from morbidostat import whoami
+from morbidostat.whoami import unit
+
+JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
+# queued between a unit's readings, where an io event (or a gain change) arrived.
+IO_EVENT = object()
+
+
+class FleetUnit:
+    """
+    What the leader knows about a unit's sensors: their order in its filter, and how to scale its readings.
+    """
+
+    def __init__(self, name, angles, od_normalization_factors, bank):
+        self.name = name
+        self.angles = angles
+        self.normalization_factors = np.array([od_normalization_factors[angle] for angle in angles])
+        self.bank = bank
+        self.filtered_schema = None
+        self._binary_layouts = {}
+
+    def scaled_observations(self, decoder, payload):
+        """
+        The scaled observations as an array, in the order of self.angles. Raises KeyError if the unit's channels
+        have changed.
+        """
+        if wire_format.is_binary(payload):
+            schema, _, values = decoder.decode(payload)
+            if schema.id not in self._binary_layouts:
+                if not set(self.angles) <= set(schema.channels):
+                    raise KeyError(schema.channels)
+                self._binary_layouts[schema.id] = np.array([schema.channels.index(angle) for angle in self.angles])
+            return values[self._binary_layouts[schema.id]] / self.normalization_factors
+
+        observations = GrowthRateCalculator.json_to_sorted_dict(payload)
+        if list(observations) != self.angles:
+            raise KeyError(list(observations))
+        return np.fromiter(observations.values(), dtype=float, count=len(self.angles)) / self.normalization_factors
+
+
+class FleetGrowthRateCalculator(BackgroundJob):
+
+    editable_settings = []
+
+    def __init__(self, ignore_cache=False, unit=None, experiment=None, verbose=0):
+        super(FleetGrowthRateCalculator, self).__init__(job_name=JOB_NAME, verbose=verbose, unit=unit, experiment=experiment)
+        self.ignore_cache = ignore_cache
+        self.kalman_parameters = GrowthRateCalculator.read_kalman_parameters()
+        self.samples_per_minute = 60 * float(config["od_sampling"]["samples_per_second"])
+        self.batched_wire_format = config["od_sampling"].get("batched_wire_format", "json")
+        self.decoder = wire_format.Decoder()
+        self.banks = {}  # number of sensors -> ExtendedKalmanFilterBank
+        self.units = {}  # unit -> FleetUnit
+        self.pending = defaultdict(list)  # unit -> its readings (and IO_EVENTs) since the last update
+        # the listeners queue readings and change units; update_pending reads them, on another thread.
+        self._lock = threading.Lock()
+        self.set_publish_policies()
+        self.start_passive_listeners()
+
+    def set_publish_policies(self):
+        # as growth_rate_calculating, for all the units.
+        max_rate = float(config["pubsub"]["max_stream_rate"])
+        set_publish_policy(f"morbidostat/+/{self.experiment}/od_filtered/#", max_rate=max_rate)
+        set_publish_policy(f"morbidostat/+/{self.experiment}/od_filtered_batched", max_rate=max_rate)
+        set_publish_policy(f"morbidostat/+/{self.experiment}/growth_rate", max_rate=max_rate, deadband=1e-5, max_interval=60)
+
+    def multiplicative_rate_to_exp_rate(self, mrate):
+        return np.log(mrate) * 60 * self.samples_per_minute
+
+    def exp_rate_to_multiplicative_rate(self, erate):
+        return np.exp(erate / 60 / self.samples_per_minute)
+
+    def queue_reading(self, message):
+        with self._lock:
+            self.pending[message.topic.split("/")[1]].append(message.payload)
+
+    def update_pending(self):
+        """
+        Update every unit with a new reading. If a unit has several, they're applied in order, a batch for each, and
+        so are its io events, between them.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, defaultdict(list)
+        # fetched without the lock, which the listeners wait on, since the replies arrive on the listeners' thread.
+        retained = {name: self.get_retained_values(name) for name in pending if name not in self.units}
+
+        with self._lock:
+            queues = {name: deque(messages) for (name, messages) in pending.items()}
+            while queues:
+                payloads = {}
+                for (name, queue) in list(queues.items()):
+                    while queue and queue[0] is IO_EVENT:
+                        queue.popleft()
+                        self.update_ekf_variance(name)
+                    if queue:
+                        payloads[name] = queue.popleft()
+                    else:
+                        del queues[name]
+                self.update_units(payloads, retained)
+
+    def update_units(self, payloads, retained):
+        batches = defaultdict(lambda: ([], []))  # bank -> (units, observations)
+        for (name, payload) in payloads.items():
+            try:
+                if name not in self.units:
+                    if name in retained and not self.pending.get(name):
+                        self.join(name, payload, *retained[name])
+                    else:
+                        # it left since the fetch: join with the next update, in order.
+                        self.pending[name].append(payload)
+                    continue
+                fleet_unit = self.units[name]
+                try:
+                    observations = fleet_unit.scaled_observations(self.decoder, payload)
+                except KeyError:
+                    # its channels changed: start again, from this reading, with the next update.
+                    self.leave(name)
+                    self.pending[name].append(payload)
+                    continue
+            except Exception as e:
+                self.log_error(name, e)
+                continue
+            names, batch = batches[fleet_unit.bank]
+            names.append(name)
+            batch.append(observations)
+
+        for (bank, (names, batch)) in batches.items():
+            self.publish_filtered(self.update_bank(bank, names, np.array(batch)))
+
+    def update_bank(self, bank, names, observations):
+        """
+        Returns the names that were updated. A unit whose filter fails (ex: its covariance is no longer positive
+        definite, or its state isn't finite) is logged and leaves, and rejoins from its next reading, as a new filter.
+        """
+        try:
+            bank.update(names, observations)
+        except Exception:
+            # the batch fails as a whole: update its units one at a time, to find which.
+            for (name, observation) in zip(names, observations):
+                try:
+                    bank.update([name], observation[None])
+                except Exception as e:
+                    self.log_error(name, e)
+                    self.leave(name)
+
+        for name in names:
+            if name in bank and not np.isfinite(bank.state(name)).all():
+                self.log_error(name, "with a state that isn't finite")
+                self.leave(name)
+        return [name for name in names if name in bank]
+
+    def get_retained_values(self, name):
+        """
+        The unit's last growth rate, and its sensors' normalization factors and variances.
+        """
+        growth_rate_topic = f"morbidostat/{name}/{self.experiment}/growth_rate"
+        median_topic = f"morbidostat/{name}/{self.experiment}/od_normalization/median"
+        variance_topic = f"morbidostat/{name}/{self.experiment}/od_normalization/variance"
+        retained = get_retained([growth_rate_topic, median_topic, variance_topic])
+
+        initial_growth_rate = 0.0
+        if retained[growth_rate_topic] is not None and not self.ignore_cache:
+            initial_growth_rate = float(retained[growth_rate_topic])
+        od_normalization_factors, od_variances = defaultdict(lambda: 1), defaultdict(lambda: 1e-5)
+        if retained[median_topic] is not None:
+            od_normalization_factors = GrowthRateCalculator.json_to_sorted_dict(retained[median_topic])
+        if retained[variance_topic] is not None:
+            od_variances = GrowthRateCalculator.json_to_sorted_dict(retained[variance_topic])
+        return initial_growth_rate, od_normalization_factors, od_variances
+
+    def join(self, name, payload, initial_growth_rate, od_normalization_factors, od_variances):
+        angles_and_initial_points = GrowthRateCalculator.sorted_observations(self.decoder.decode_to_dict(payload))
+        angles = list(angles_and_initial_points)
+        if len(angles) not in self.banks:
+            self.banks[len(angles)] = ExtendedKalmanFilterBank(len(angles))
+        fleet_unit = FleetUnit(name, angles, od_normalization_factors, self.banks[len(angles)])
+
+        initial_state = np.append(
+            np.fromiter(angles_and_initial_points.values(), dtype=float, count=len(angles)) / fleet_unit.normalization_factors,
+            self.exp_rate_to_multiplicative_rate(initial_growth_rate),
+        )
+        covariances = GrowthRateCalculator.create_covariances(
+            angles, od_normalization_factors, od_variances, self.kalman_parameters
+        )
+        fleet_unit.bank.add(name, initial_state, *covariances)
+        self.units[name] = fleet_unit
+        self.publish_filtered_schema(fleet_unit)
+
+    def leave(self, name):
+        fleet_unit = self.units.pop(name, None)
+        if fleet_unit is not None:
+            fleet_unit.bank.remove(name)
+
+    def on_od_reading_state(self, message):
+        if message.payload.decode() in (self.DISCONNECTED, self.LOST):
+            with self._lock:
+                self.leave(message.topic.split("/")[1])
+
+    def queue_io_event(self, message):
+        with self._lock:
+            self.pending[message.topic.split("/")[1]].append(IO_EVENT)
+
+    def update_ekf_variance(self, name):
+        if name in self.units:
+            self.units[name].bank.scale_OD_variance_for_next_n_steps(
+                name, self.kalman_parameters["io_event_variance_factor"], 2 * self.samples_per_minute
+            )
+
+    def add_schema(self, message):
+        self.decoder.add_schema(message.payload)
+
+    def publish_filtered_schema(self, fleet_unit):
+        if self.batched_wire_format == "json":
+            return
+
+        fleet_unit.filtered_schema, schema_payload = wire_format.create_schema(fleet_unit.angles, dtype=self.batched_wire_format)
+        publish(
+            wire_format.schema_topic(f"morbidostat/{fleet_unit.name}/{self.experiment}/od_filtered_batched"),
+            schema_payload,
+            verbose=self.verbose,
+            retain=True,
+        )
+
+    def publish_filtered(self, names):
+        for name in names:
+            fleet_unit = self.units[name]
+            state = fleet_unit.bank.state(name)
+            publish(
+                f"morbidostat/{name}/{self.experiment}/growth_rate",
+                self.multiplicative_rate_to_exp_rate(state[-1]),
+                verbose=self.verbose,
+                retain=True,
+            )
+            for (i, angle_label) in enumerate(fleet_unit.angles):
+                publish(f"morbidostat/{name}/{self.experiment}/od_filtered/{angle_label}", state[i], verbose=self.verbose)
+
+            if fleet_unit.filtered_schema is not None:
+                publish(
+                    f"morbidostat/{name}/{self.experiment}/od_filtered_batched",
+                    wire_format.encode(fleet_unit.filtered_schema, state[:-1]),
+                    verbose=self.verbose,
+                )
+
+    def log_error(self, name, e):
+        publish(f"morbidostat/{name}/{self.experiment}/error_log", f"[{JOB_NAME}]: failed {e}. Skipping.", verbose=self.verbose)
+
+    def set_experiment(self, experiment):
+        # the filters carry on as they are: only the topics change.
+        super(FleetGrowthRateCalculator, self).set_experiment(experiment)
+        self.set_publish_policies()
+        for fleet_unit in self.units.values():
+            self.publish_filtered_schema(fleet_unit)
+
+    def start_passive_listeners(self):
+        self.subscribe_and_callback(self.add_schema, wire_format.schema_topic(f"morbidostat/+/{self.experiment}/od_raw_batched"))
+        self.subscribe_and_callback(self.queue_reading, f"morbidostat/+/{self.experiment}/od_raw_batched")
+        self.subscribe_and_callback(self.on_od_reading_state, f"morbidostat/+/{self.experiment}/od_reading/$state")
+        self.subscribe_and_callback(
+            self.queue_io_event,
+            [f"morbidostat/+/{self.experiment}/io_events", f"morbidostat/+/{self.experiment}/od_gain_events"],
+        )
+
+
+@log_start(unit)
+@log_stop(unit)
+def fleet_growth_rate_calculating(verbose, ignore_cache, batch_interval=1.0):
+    calculator = FleetGrowthRateCalculator(verbose=verbose, ignore_cache=ignore_cache, unit=unit, experiment=whoami.experiment)
+    yield from every(batch_interval, calculator.update_pending, stats=calculator.stats)
+
+
+@click.command()
+@click.option("--batch-interval", default=1.0, show_default=True, help="seconds between updates of the units' filters")
+@click.option("--ignore-cache", default=False, help="Ignore the cached growth_rate values")
+@click.option("--verbose", "-v", count=True, help="Print to std out")
+def click_fleet_growth_rate_calculating(batch_interval, ignore_cache, verbose):
+    calculator = fleet_growth_rate_calculating(verbose, ignore_cache, batch_interval=batch_interval)
+    while True:
+        next(calculator)
+
+
+if __name__ == "__main__":
+    click_fleet_growth_rate_calculating()
@@ -10,9 +10,10 @@ import click
 import json
 
 from morbidostat.utils import log_start, log_stop
-from morbidostat.pubsub import subscribe_and_callback, publish
+from morbidostat.pubsub import publish
 from morbidostat.background_jobs import BackgroundJob
-from morbidostat.whoami import unit, experiment, hostname
+from morbidostat import whoami
+from morbidostat.whoami import unit, hostname
 
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
@@ -63,9 +64,15 @@ class LogAggregation(BackgroundJob):
         with open(self.output, "w") as f:
             json.dump(self.aggregated_log_table, f)
 
+    def set_experiment(self, experiment):
+        self.topics = [topic.replace(f"/{self.experiment}/", f"/{experiment}/") for topic in self.topics]
+        super(LogAggregation, self).set_experiment(experiment)
+
     def start_passive_listeners(self):
-        subscribe_and_callback(self.on_message, self.topics)
-        subscribe_and_callback(self.clear, f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/aggregated_log_table/set")
+        self.subscribe_and_callback(self.on_message, self.topics)
+        self.subscribe_and_callback(
+            self.clear, f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/aggregated_log_table/set"
+        )
 
 
 @click.command()
@@ -74,6 +81,7 @@ class LogAggregation(BackgroundJob):
 )
 @click.option("--verbose", "-v", count=True, help="print to std.out")
 def run(output, verbose):
+    experiment = whoami.experiment
     logs = LogAggregation(
         [f"morbidostat/+/{experiment}/log", f"morbidostat/+/{experiment}/error_log"],
         output,
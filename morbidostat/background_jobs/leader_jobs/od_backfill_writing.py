@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+This job runs on the leader, and writes the raw OD readings that workers republish with `mb od_backfill`, from
+
+    morbidostat/+/<experiment>/od_raw_backfill
+
+to the observation database's od_readings_raw, as the Node-RED flow does od_raw's: one row per reading and angle, with
+the angle's "/" dropped (135/A -> 135A). The timestamps are the worker's, as ISO 8601.
+
+The leader usually has some of the window already (ex: it missed part of it). Readings within half a sampling interval
+of a row of the same unit and angle are skipped, so a window can be backfilled more than once.
+"""
+import json
+import os
+import signal
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import click
+import numpy as np
+
+from morbidostat.actions.replay_growth_rates import nearest, parse_timestamps
+from morbidostat.background_jobs import BackgroundJob
+from morbidostat.config import config
+from morbidostat.pubsub import publish, QOS
+from morbidostat import whoami
+from morbidostat.whoami import unit
+
+JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
+
+
+def iso(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="milliseconds")
+
+
+class ODBackfillWriter(BackgroundJob):
+
+    editable_settings = []
+
+    def __init__(self, database=None, unit=None, experiment=None, verbose=0):
+        super(ODBackfillWriter, self).__init__(job_name=JOB_NAME, verbose=verbose, unit=unit, experiment=experiment)
+        self.database = database or config["data"]["observation_database"]
+        self.tolerance = 0.5 / float(config["od_sampling"]["samples_per_second"])
+        self.start_passive_listeners()
+
+    def missing(self, connection, unit, experiment, angle, timestamps):
+        """
+        A mask of the `timestamps` (sorted) that have no row of the unit's angle within self.tolerance.
+        """
+        # the rows' timestamps are ISO 8601, so a range of days, compared as text, narrows the rows to parse.
+        first, last = (datetime.fromtimestamp(t, timezone.utc) for t in (timestamps[0], timestamps[-1]))
+        labels = [
+            row[0]
+            for row in connection.execute(
+                "SELECT timestamp FROM od_readings_raw WHERE experiment = ? AND morbidostat_unit = ? AND angle = ? "
+                "AND timestamp BETWEEN ? AND ?",
+                (experiment, unit, angle, f"{first - timedelta(days=1):%Y-%m-%d}", f"{last + timedelta(days=2):%Y-%m-%d}"),
+            )
+        ]
+        if not labels:
+            return np.ones(len(timestamps), dtype=bool)
+        return nearest(np.sort(parse_timestamps(labels)), timestamps, self.tolerance) < 0
+
+    def write_chunk(self, message):
+        unit, experiment = message.topic.split("/")[1:3]
+        chunk = json.loads(message.payload)
+        timestamps = np.array(chunk.pop("timestamps"), dtype=float)
+        if not len(timestamps):
+            return
+
+        written = 0
+        connection = sqlite3.connect(self.database)
+        try:
+            with connection:
+                for (channel, values) in chunk.items():
+                    angle = channel.replace("/", "")
+                    new = self.missing(connection, unit, experiment, angle, timestamps)
+                    connection.executemany(
+                        "INSERT INTO od_readings_raw (timestamp, morbidostat_unit, od_reading_v, experiment, angle) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(iso(t), unit, float(v), experiment, angle) for (t, v) in zip(timestamps[new], np.asarray(values)[new])],
+                    )
+                    written += int(new.sum())
+        finally:
+            connection.close()
+
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/log",
+            f"[{JOB_NAME}]: wrote {written} of {len(timestamps) * len(chunk)} backfilled readings from {unit}.",
+            verbose=self.verbose,
+        )
+
+    def start_passive_listeners(self):
+        self.subscribe_and_callback(self.write_chunk, f"morbidostat/+/{self.experiment}/od_raw_backfill", qos=QOS.AT_LEAST_ONCE)
+
+
+@click.command()
+@click.option("--database", default=None, help="default: [data] observation_database")
+@click.option("--verbose", "-v", count=True, help="Print to std out")
+def click_od_backfill_writing(database, verbose):
+    writer = ODBackfillWriter(database=database, unit=unit, experiment=whoami.experiment, verbose=verbose)
+    while True:
+        signal.pause()
+
+
+if __name__ == "__main__":
+    click_od_backfill_writing()
@@ -19,26 +19,50 @@ Also published to
 
     morbidostat/<unit>/<experiment>/od_raw_batched
 
+as JSON, or in the binary format of `morbidostat.utils.wire_format` if `batched_wire_format` in the config is float32
+or float64. The channel order is then published (retained) to
 
+    morbidostat/<unit>/<experiment>/od_raw_batched/$schema
+
+Each reading of a channel can be a burst of ADC conversions (`[od_sampling] conversions_per_reading`), reduced to one
+value on the worker with `burst_reduction`: mean, median or trimmed_mean. The message rate doesn't change, and the
+spread of each channel's burst (the standard deviation of one conversion) is published, in the same encoding, to
+
+    morbidostat/<unit>/<experiment>/od_raw_dispersion_batched
+
+Channels can be spread over several ADS1115s on the I2C bus (addresses 0x48 to 0x4B): `--od-angle-channel 90,0x49:0`
+reads input 0 of the ADC at 0x49, and `135,0` input 0 of the one at 0x48. The ADCs convert at the same time (see
+`morbidostat.utils.adc_scanner`). The time spent reading the ADCs each tick is in the job's `$stats`, under
+`callbacks/adc_read`.
+
+Each channel has its own gain (see `AutoGain`). Changes are published, as JSON, to
+
+    morbidostat/<unit>/<experiment>/od_gain_events
+
+ex: {"event": "gain_change", "channel": "135/A", "previous_gain": 8, "gain": 4, "signal": 0.47}
+
+Every reading is also kept on the worker, in the memory-mapped ring buffer `[od_sampling] ring_buffer` (see
+`morbidostat.utils.ring_buffer`), which holds the last `ring_buffer_days` of readings. `mb od_backfill` republishes
+windows of it that the leader missed.
 
 """
 import time
 import json
 import os
 import string
+import statistics
 from collections import Counter
 
 import click
-from adafruit_ads1x15.analog_in import AnalogIn
-import adafruit_ads1x15.ads1115 as ADS
-import board
-import busio
 
 from morbidostat.utils.streaming_calculations import MovingStats
-from morbidostat.utils import log_start, log_stop
-from morbidostat.whoami import unit, experiment
+from morbidostat.utils.adc_scanner import InterleavedScanner, parse_channel, DEFAULT_ADDRESS
+from morbidostat.utils.ring_buffer import ReadingRingBuffer, capacity_for
+from morbidostat.utils import log_start, log_stop, wire_format
+from morbidostat import whoami, hardware
+from morbidostat.whoami import unit
 from morbidostat.config import config
-from morbidostat.pubsub import publish, subscribe_and_callback
+from morbidostat.pubsub import publish, QOS
 from morbidostat.utils.timing import every
 from morbidostat.background_jobs import BackgroundJob
 
@@ -51,45 +75,190 @@ ADS_GAIN_THRESHOLDS = {
     16: (-1, 0.256),
 }
 
+GAINS = sorted(ADS_GAIN_THRESHOLDS)  # increasing gain, decreasing full scale
+
+
+def full_scale(gain):
+    return ADS_GAIN_THRESHOLDS[gain][1]
+
+
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
 
+def trimmed_mean(values, proportion=0.25):
+    # the mean once `proportion` of the values are dropped from each end. 0.25 is the interquartile mean.
+    values = sorted(values)
+    cut = int(len(values) * proportion)
+    return statistics.mean(values[cut : len(values) - cut])
+
+
+def robust_std(values):
+    # the standard deviation of normal noise, estimated from the median absolute deviation, so a few outliers
+    # (ex: a conversion during a pump's switching) don't inflate it.
+    median = statistics.median(values)
+    return 1.4826 * statistics.median(abs(v - median) for v in values)
+
+
+BURST_REDUCTIONS = {
+    "mean": (statistics.mean, statistics.stdev),
+    "median": (statistics.median, robust_std),
+    "trimmed_mean": (trimmed_mean, robust_std),
+}
+
+
+def reduce_burst(values, reduction="trimmed_mean"):
+    """
+    Returns (value, dispersion) of a burst of conversions. The dispersion is None for a single conversion.
+    """
+    if len(values) == 1:
+        return values[0], None
+    center, spread = BURST_REDUCTIONS[reduction]
+    return center(values), spread(values)
+
+
+class AutoGain:
+    """
+    The gain of one channel: the highest whose full scale fits the channel's signal, with hysteresis so a signal near
+    a boundary doesn't switch back and forth.
+
+    - down (a lower gain, a larger range) as soon as a reading passes `high` of the full scale: near saturation,
+      readings are wrong.
+    - up only once the max of the last `lookback` readings is under `low` of the higher gain's full scale. After
+      going up, the signal has to grow by high / low (30%) to come back down.
+    """
+
+    def __init__(self, gain=8, lookback=20, high=0.9, low=0.7):
+        assert low < high
+        self.gain = gain
+        self.high = high
+        self.low = low
+        self.lookback = lookback
+        self.signals = MovingStats(lookback)
+
+    def update(self, signal):
+        """
+        Returns the new gain if it changes, else None.
+        """
+        self.signals.update(signal)
+        gain = self.gain
+
+        if signal >= self.high * full_scale(gain):
+            gain = next((g for g in reversed(GAINS) if signal < self.high * full_scale(g)), GAINS[0])
+        elif self.signals.max is not None:
+            gain = max(g for g in GAINS if g <= gain or self.signals.max < self.low * full_scale(g))
+
+        if gain == self.gain:
+            return None
+        self.gain = gain
+        # readings at the previous gain say nothing about how close to the new full scale the signal is.
+        self.signals = MovingStats(self.lookback)
+        return gain
+
+
 class ODReader(BackgroundJob):
     """
     Parameters
     -----------
 
-    od_channels: list of (label, ADS channel), ex: [("90/A", 0), ("90/B", 1), ...]
+    od_channels: list of (label, channel), ex: [("90/A", "0"), ("90/B", "0x49:1"), ...]
+        a channel is an input of the ADC at 0x48, "<i2c address>:<input>", or a tuple (i2c address, input).
+    adcs: {i2c address: ADS1115}, or a single ADS1115 at 0x48.
+    conversions_per_reading: int
+        the size of the burst of conversions taken per channel per reading.
+    burst_reduction: str
+        how a burst is reduced to one value: mean, median or trimmed_mean.
+    data_rate: int
+        ADS1115 conversions per second. None keeps the ADC's (128).
+    continuous: bool
+        put the ADCs in continuous conversion mode: a burst then reads consecutive conversions, instead of
+        triggering each one over I2C.
+    ring_buffer: ReadingRingBuffer
+        where to keep the readings on the worker, or None.
 
     """
 
     editable_settings = []
 
-    def __init__(self, od_channels, ads, unit=None, experiment=None, verbose=0):
+    def __init__(
+        self,
+        od_channels,
+        adcs,
+        conversions_per_reading=1,
+        burst_reduction="trimmed_mean",
+        data_rate=None,
+        continuous=False,
+        ring_buffer=None,
+        unit=None,
+        experiment=None,
+        verbose=0,
+    ):
+        if burst_reduction not in BURST_REDUCTIONS:
+            raise ValueError(f"burst_reduction must be one of {list(BURST_REDUCTIONS)}.")
+
         self.unit = unit
         self.experiment = experiment
         self.verbose = verbose
-        self.ma = MovingStats(lookback=20)
-        self.ads = ads
-        self.od_channels_to_analog_in = {}
-
-        for (label, channel) in od_channels:
-            ai = AnalogIn(self.ads, getattr(ADS, "P" + channel))
-            self.od_channels_to_analog_in[label] = ai
+        self.adcs = adcs if isinstance(adcs, dict) else {DEFAULT_ADDRESS: adcs}
+        self.conversions_per_reading = conversions_per_reading
+        self.burst_reduction = burst_reduction
+        if data_rate is not None:
+            for ads in self.adcs.values():
+                ads.data_rate = data_rate
+
+        self.od_channels = {label: parse_channel(channel) for (label, channel) in od_channels}
+        self.scanner = InterleavedScanner(self.adcs, self.od_channels, continuous=continuous)
+        self.auto_gains = {label: AutoGain(gain) for (label, gain) in self.scanner.gains.items()}
+        self.ring_buffer = ring_buffer
 
         super(ODReader, self).__init__(job_name=JOB_NAME, verbose=verbose, unit=unit, experiment=experiment)
+        self.adc_read_stats = self.stats.callback("adc_read")
         self.start_passive_listeners()
+        self.publish_batched_schema()
+
+    def set_experiment(self, experiment):
+        super(ODReader, self).set_experiment(experiment)
+        self.publish_batched_schema()
+
+    def publish_batched_schema(self):
+        self.batched_wire_format = config["od_sampling"].get("batched_wire_format", "json")
+        if self.batched_wire_format == "json":
+            return
+
+        self.batched_schema, schema_payload = wire_format.create_schema(self.od_channels.keys(), dtype=self.batched_wire_format)
+        for topic in ["od_raw_batched", "od_raw_dispersion_batched"]:
+            publish(
+                wire_format.schema_topic(f"morbidostat/{self.unit}/{self.experiment}/{topic}"),
+                schema_payload,
+                verbose=self.verbose,
+                retain=True,
+            )
+
+    def encode_batch(self, raw_signals):
+        if self.batched_wire_format == "json":
+            return json.dumps(raw_signals)
+        return wire_format.encode(self.batched_schema, list(raw_signals.values()))
+
+    def read_channels(self):
+        """
+        Returns {label: (voltage, dispersion)}, from a burst of `conversions_per_reading` conversions per channel.
+        """
+        start = time.monotonic()
+        bursts = self.scanner.scan(self.conversions_per_reading)
+        self.adc_read_stats.record(None, start, time.monotonic())
+        return {label: reduce_burst(voltages, self.burst_reduction) for (label, voltages) in bursts.items()}
 
     def take_reading(self, counter=None):
         while self.state != self.READY:
+            if self.state == self.DISCONNECTED:
+                return
             time.sleep(0.5)
 
         try:
-            raw_signals = {}
-            for (angle_label, ads_channel) in self.od_channels_to_analog_in.items():
-                raw_signal_ = ads_channel.voltage
+            raw_signals, dispersions = {}, {}
+            for (angle_label, (raw_signal_, dispersion)) in self.read_channels().items():
                 publish(f"morbidostat/{self.unit}/{self.experiment}/od_raw/{angle_label}", raw_signal_, verbose=self.verbose)
                 raw_signals[angle_label] = raw_signal_
+                dispersions[angle_label] = dispersion
 
                 # since we don't show the user the raw voltage values, they may miss that they are near saturation of the op-amp (and could
                 # also damage the ADC). We'll alert the user if the voltage gets higher than 2.5V, which is well above anything normal.
@@ -102,23 +271,21 @@ class ODReader(BackgroundJob):
                     )
                 # TODO: check if more than 3V, and shut down something? to prevent damage to ADC.
 
+            if self.ring_buffer is not None:
+                self.ring_buffer.append(time.time(), [raw_signals[label] for label in self.ring_buffer.channels])
+
             # publish the batch of data, too, for growth reading
-            publish(f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched", json.dumps(raw_signals), verbose=self.verbose)
-
-            # the max signal should determine the board's gain
-            self.ma.update(max(raw_signals.values()))
-
-            # check if using correct gain
-            if counter % 5 == 0 and self.ma.mean is not None:
-                for gain, (lb, ub) in ADS_GAIN_THRESHOLDS.items():
-                    if (0.95 * lb <= self.ma.mean < 0.95 * ub) and (self.ads.gain != gain):
-                        self.ads.gain = gain
-                        publish(
-                            f"morbidostat/{self.unit}/{self.experiment}/log",
-                            f"[{JOB_NAME}] ADC gain updated to {self.ads.gain}.",
-                            verbose=self.verbose,
-                        )
-                        break
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/od_raw_batched", self.encode_batch(raw_signals), verbose=self.verbose
+            )
+            if self.conversions_per_reading > 1:
+                publish(
+                    f"morbidostat/{self.unit}/{self.experiment}/od_raw_dispersion_batched",
+                    self.encode_batch(dispersions),
+                    verbose=self.verbose,
+                )
+
+            self.update_gains(raw_signals)
 
             return raw_signals
 
@@ -136,10 +303,31 @@ class ODReader(BackgroundJob):
             )
             raise e
 
+    def update_gains(self, raw_signals):
+        for (label, signal) in raw_signals.items():
+            previous_gain = self.scanner.gains[label]
+            gain = self.auto_gains[label].update(signal)
+            if gain is None:
+                continue
 
-@log_start(unit, experiment)
-@log_stop(unit, experiment)
-def od_reading(od_angle_channel, verbose, sampling_rate=1 / float(config["od_sampling"]["samples_per_second"])):
+            self.scanner.gains[label] = gain
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/od_gain_events",
+                json.dumps(
+                    {"event": "gain_change", "channel": label, "previous_gain": previous_gain, "gain": gain, "signal": signal}
+                ),
+                verbose=self.verbose,
+                qos=QOS.EXACTLY_ONCE,
+            )
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/log",
+                f"[{JOB_NAME}] OD sensor {label} gain updated to {gain}.",
+                verbose=self.verbose,
+            )
+
+
+def create_od_reader(od_angle_channel, verbose=0, job_class=ODReader, **kwargs):
+    # job_class and kwargs: ex, an AsyncBackgroundJob flavour of ODReader, and its loop.
     angle_counter = Counter()
     od_channels = []
     for input_ in od_angle_channel:
@@ -152,10 +340,36 @@ def od_reading(od_angle_channel, verbose, sampling_rate=1 / float(config["od_sam
 
         od_channels.append((angle_label, channel))
 
-    i2c = busio.I2C(board.SCL, board.SDA)
-    ads = ADS.ADS1115(i2c, gain=8)  # we can the gain dynamically later
-
-    yield from every(sampling_rate, ODReader(od_channels, ads, unit=unit, experiment=experiment, verbose=verbose).take_reading)
+    # one ADC per address used, sharing the bus. The gains change dynamically later.
+    adcs = hardware.create_adcs({label: parse_channel(channel) for (label, channel) in od_channels}, gain=8)
+
+    sampling = config["od_sampling"]
+    ring_buffer = None
+    if sampling.get("ring_buffer"):
+        capacity = capacity_for(float(sampling.get("ring_buffer_days", 7)), float(sampling["samples_per_second"]))
+        labels = [label for (label, _) in od_channels]
+        ring_buffer = ReadingRingBuffer.open_or_create(os.path.expanduser(sampling["ring_buffer"]), labels, capacity)
+
+    return job_class(
+        od_channels,
+        adcs,
+        conversions_per_reading=int(sampling.get("conversions_per_reading", 1)),
+        burst_reduction=sampling.get("burst_reduction", "trimmed_mean"),
+        data_rate=int(sampling["adc_data_rate"]) if sampling.get("adc_data_rate") else None,
+        continuous=sampling.get("adc_mode", "single") == "continuous",
+        ring_buffer=ring_buffer,
+        unit=unit,
+        experiment=whoami.experiment,
+        verbose=verbose,
+        **kwargs,
+    )
+
+
+@log_start(unit)
+@log_stop(unit)
+def od_reading(od_angle_channel, verbose, sampling_rate=1 / float(config["od_sampling"]["samples_per_second"])):
+    reader = create_od_reader(od_angle_channel, verbose)
+    yield from every(sampling_rate, reader.take_reading, stats=reader.stats)
 
 
 @click.command()
@@ -169,6 +383,8 @@ pair of angle,channel for optical density reading. Can be invoked multiple times
 
 --od-angle-channel 135,0 --od-angle-channel 90,1 --od-angle-channel 45,2
 
+A channel on an ADC other than the one at 0x48 is <i2c address>:<input>, ex: --od-angle-channel 90,0x49:0
+
 """,
 )
 @click.option(
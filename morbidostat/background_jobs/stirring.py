@@ -8,16 +8,16 @@ This script is designed to run in a background process and push data to MQTT.
 import time, os, traceback, signal, sys
 
 import click
-import RPi.GPIO as GPIO
 
 from morbidostat.utils import log_start, log_stop
-from morbidostat.whoami import unit, experiment
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.config import config
+from morbidostat import hardware
 from morbidostat.pubsub import publish, subscribe_and_callback
 from morbidostat.utils.timing import every
 from morbidostat.background_jobs import BackgroundJob
 
-GPIO.setmode(GPIO.BCM)
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
 
@@ -35,6 +35,7 @@ class Stirrer(BackgroundJob):
         self.hertz = hertz
         self.pin = pin
 
+        GPIO = hardware.get_gpio()
         GPIO.setup(self.pin, GPIO.OUT)
         GPIO.output(self.pin, 0)
         self.pwm = GPIO.PWM(self.pin, self.hertz)
@@ -69,12 +70,15 @@ class Stirrer(BackgroundJob):
 
 
 def stirring(duty_cycle=int(config["stirring"][f"duty_cycle{unit}"]), duration=None, verbose=0):
+    GPIO = hardware.get_gpio()
+
     def terminate(*args):
         GPIO.cleanup()
 
     signal.signal(signal.SIGTERM, terminate)
     signal.signal(signal.SIGINT, terminate)
 
+    experiment = whoami.experiment
     publish(f"morbidostat/{unit}/{experiment}/log", f"[stirring]: start stirring with duty cycle={duty_cycle}", verbose=verbose)
 
     try:
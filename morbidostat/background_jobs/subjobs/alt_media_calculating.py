@@ -4,17 +4,15 @@ Continuously monitor the bioreactor and provide summary statistics on what's goi
 """
 import json
 import time
-import subprocess
 import signal
 import threading
 import os
 
 import click
 
-from morbidostat.pubsub import publish, subscribe_and_callback, QOS
+from morbidostat.pubsub import publish, get_retained, QOS
 from morbidostat.utils import log_start, log_stop
-from morbidostat.whoami import unit, experiment
-from morbidostat.config import leader_hostname
+from morbidostat.whoami import unit
 from morbidostat.background_jobs import BackgroundJob
 from typing import Optional
 
@@ -76,27 +74,20 @@ class AltMediaCalculator(BackgroundJob):
 
         return self.latest_alt_media_fraction
 
-    def get_initial_alt_media_fraction(self) -> float:
-        """
-        This is a hack to use a timeout (not available in paho-mqtt) to
-        see if a value is present in the MQTT cache (retained message)
-
-        TODO: replace
-        """
-        test_mqtt = subprocess.run(
-            [
-                f'mosquitto_sub -t "morbidostat/{self.unit}/{self.experiment}/{JOB_NAME}/alt_media_fraction" -W 3 -h {leader_hostname}'
-            ],
-            shell=True,
-            capture_output=True,
-            universal_newlines=True,
-        )
-        if test_mqtt.stdout == "":
+    def get_initial_alt_media_fraction(self, experiment=None) -> float:
+        topic = f"morbidostat/{self.unit}/{experiment or self.experiment}/{JOB_NAME}/alt_media_fraction"
+        cached = get_retained(topic)[topic]
+        if cached is None:
             return 0.0
         else:
-            return float(test_mqtt.stdout.strip())
+            return float(cached)
+
+    def set_experiment(self, experiment):
+        # the fraction is per experiment.
+        self.latest_alt_media_fraction = self.get_initial_alt_media_fraction(experiment)
+        super(AltMediaCalculator, self).set_experiment(experiment)
 
     def start_passive_listeners(self) -> None:
-        subscribe_and_callback(
+        self.subscribe_and_callback(
             callback=self.on_io_event, topics=f"morbidostat/{self.unit}/{self.experiment}/io_events", qos=QOS.EXACTLY_ONCE
         )
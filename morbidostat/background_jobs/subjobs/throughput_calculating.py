@@ -9,8 +9,9 @@ import click
 import json
 
 
-from morbidostat.pubsub import publish, subscribe_and_callback, QOS
-from morbidostat.whoami import unit, experiment
+from morbidostat.pubsub import publish, get_retained, QOS
+from morbidostat import whoami
+from morbidostat.whoami import unit
 from morbidostat.config import leader_hostname
 from morbidostat import utils
 from morbidostat.background_jobs import BackgroundJob
@@ -49,6 +50,7 @@ class ThroughputCalculator(BackgroundJob):
         self._media_throughput = 0
         self._alt_media_throughput = 0
 
+        self.load_cached_values()
         self.start_passive_listeners()
 
     @property
@@ -80,56 +82,36 @@ class ThroughputCalculator(BackgroundJob):
             raise ValueError("Unknown event type")
 
     def update_media_throughput(self, media_delta, alt_media_delta):
+        # published (if changed) by BackgroundJob, together, once the io_event is handled.
+        self.alt_media_throughput += alt_media_delta
+        self.media_throughput += media_delta
 
-        self._alt_media_throughput += alt_media_delta
-        self._media_throughput += media_delta
+    def cached_values(self, experiment):
+        media_topic = f"morbidostat/{self.unit}/{experiment}/{self.job_name}/media_throughput"
+        alt_media_topic = f"morbidostat/{self.unit}/{experiment}/{self.job_name}/alt_media_throughput"
 
-        publish(
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/media_throughput",
-            self.media_throughput,
-            verbose=self.verbose,
-            retain=True,
-            qos=QOS.EXACTLY_ONCE,
-        )
-
-        publish(
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/alt_media_throughput",
-            self.alt_media_throughput,
-            verbose=self.verbose,
-            retain=True,
-            qos=QOS.EXACTLY_ONCE,
-        )
-        return
+        retained = get_retained([media_topic, alt_media_topic])
+        return tuple(float(retained[topic]) if retained[topic] is not None else 0 for topic in (media_topic, alt_media_topic))
 
-    def set_media_initial_throughput(self, message):
-        self.media_throughput = float(message.payload)
+    def load_cached_values(self):
+        self.media_throughput, self.alt_media_throughput = self.cached_values(self.experiment)
 
-    def set_alt_media_initial_throughput(self, message):
-        self.alt_media_throughput = float(message.payload)
+    def set_experiment(self, experiment):
+        # the totals are per experiment: carry on from the new experiment's, rather than from ours.
+        self._media_throughput, self._alt_media_throughput = self.cached_values(experiment)
+        super(ThroughputCalculator, self).set_experiment(experiment)
 
     def start_passive_listeners(self) -> None:
-        subscribe_and_callback(
-            self.set_media_initial_throughput,
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/media_throughput",
-            timeout=3,
-            max_msgs=1,
-        )
-        subscribe_and_callback(
-            self.set_alt_media_initial_throughput,
-            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/alt_media_throughput",
-            timeout=3,
-            max_msgs=1,
-        )
-        subscribe_and_callback(
+        self.subscribe_and_callback(
             callback=self.on_io_event, topics=f"morbidostat/{self.unit}/{self.experiment}/io_events", qos=QOS.EXACTLY_ONCE
         )
 
 
-@utils.log_start(unit, experiment)
-@utils.log_stop(unit, experiment)
+@utils.log_start(unit)
+@utils.log_stop(unit)
 def throughput_calculating():
 
-    calc = ThroughputCalculator()
+    calc = ThroughputCalculator(unit=unit, experiment=whoami.experiment)
 
     while True:
         signal.pause()
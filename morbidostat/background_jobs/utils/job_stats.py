@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime metrics of a background job. `BackgroundJob` publishes them, retained, as JSON to
+`morbidostat/<unit>/<experiment>/<job_name>/$stats` every `[job_stats] publish_interval` seconds:
+
+    callbacks      per callback: runs, how long they waited to start (ms since the message arrived), and a
+                   histogram of how long they took (ms, keyed by bucket upper bound, not cumulative)
+    messages_in    per topic, messages handled by the job's callbacks
+    messages_out   per topic, messages published by the process (shared by the jobs of a worker_host)
+    ticks          the job's periodic task: runs, runs skipped because it was behind schedule, and drift (ms late vs schedule)
+    tasks          per task run by a utils.timing.Scheduler: runs, skips, overruns, jitter and duration (see TaskStats)
+    threads, rss_mb, cpu_time, cpu_percent (since the previous snapshot), publish_queue (messages not yet sent)
+
+Counts are totals since the job started. Recording a run is a few arithmetic operations and a dict update, without a
+lock; `benchmarks/job_stats_overhead.py` measures what it costs.
+"""
+import bisect
+import os
+import threading
+import time
+from collections import Counter
+
+LATENCY_BUCKETS_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000)
+BUCKET_LABELS = [str(bound) for bound in LATENCY_BUCKETS_MS] + ["+Inf"]
+_BUCKETS = [bound / 1000 for bound in LATENCY_BUCKETS_MS]
+
+
+class CallbackStats:
+    """
+    The runs of one callback. Only the thread running the callback writes to it, so it has no lock.
+    """
+
+    __slots__ = ("counts", "total", "max", "wait_total", "wait_max", "messages_in")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKET_LABELS)
+        self.total = 0.0
+        self.max = 0.0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.messages_in = Counter()
+
+    def record(self, message, start, end):
+        """
+        A run handling `message` (None if it wasn't handling one), from `start` to `end`, both time.monotonic():
+        the clock paho stamps messages with when they arrive.
+        """
+        duration = end - start
+        self.counts[bisect.bisect_left(_BUCKETS, duration)] += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+        if message is not None:
+            self.messages_in[message.topic] += 1
+            wait = start - message.timestamp if message.timestamp else 0.0
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+
+    def as_dict(self):
+        counts = list(self.counts)
+        count = sum(counts)
+        return {
+            "count": count,
+            "mean_ms": round(self.total / count * 1000, 3) if count else None,
+            "max_ms": round(self.max * 1000, 3),
+            "mean_wait_ms": round(self.wait_total / count * 1000, 3) if count else None,
+            "max_wait_ms": round(self.wait_max * 1000, 3),
+            "histogram_ms": dict(zip(BUCKET_LABELS, counts)),
+        }
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # not Linux: the peak RSS is the best we have.
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class JobStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.callbacks = {}  # name -> CallbackStats
+        self.tasks = {}  # name -> utils.timing.TaskStats
+        self.ticks = 0
+        self.skipped_ticks = 0
+        self.drift_total = 0.0
+        self.drift_max = 0.0
+        self.drift_last = 0.0
+        self._last_cpu = (time.monotonic(), time.process_time())
+
+    def callback(self, name):
+        """
+        The CallbackStats that runs of callback `name` are recorded in.
+        """
+        with self._lock:
+            return self.callbacks.setdefault(name, CallbackStats())
+
+    def task(self, name):
+        """
+        The TaskStats that runs of periodic task `name` are recorded in.
+        """
+        from morbidostat.utils.timing import TaskStats
+
+        with self._lock:
+            return self.tasks.setdefault(name, TaskStats())
+
+    def record_tick(self, drift, skipped=0):
+        """
+        A run of the periodic task, started `drift` seconds after it was scheduled, after skipping `skipped` runs.
+        """
+        with self._lock:
+            self.ticks += 1
+            self.skipped_ticks += skipped
+            self.drift_total += drift
+            self.drift_last = drift
+            if drift > self.drift_max:
+                self.drift_max = drift
+
+    def snapshot(self):
+        from morbidostat.pubsub import get_publish_counts, get_publish_client
+
+        now, cpu_time = time.monotonic(), time.process_time()
+        last_now, last_cpu_time = self._last_cpu
+        self._last_cpu = (now, cpu_time)
+
+        with self._lock:
+            callbacks = {name: stats.as_dict() for (name, stats) in self.callbacks.items()}
+            messages_in = Counter()
+            for stats in self.callbacks.values():
+                messages_in.update(dict(stats.messages_in))
+            ticks = {
+                "count": self.ticks,
+                "skipped": self.skipped_ticks,
+                "drift_mean_ms": round(self.drift_total / self.ticks * 1000, 3) if self.ticks else None,
+                "drift_max_ms": round(self.drift_max * 1000, 3),
+                "drift_last_ms": round(self.drift_last * 1000, 3),
+            }
+            tasks = {name: stats.as_dict() for (name, stats) in self.tasks.items()}
+
+        return {
+            "timestamp": time.time(),
+            "uptime": round(time.time() - self.started_at, 3),
+            "callbacks": callbacks,
+            "messages_in": messages_in,
+            "messages_out": get_publish_counts(),
+            "ticks": ticks,
+            "tasks": tasks,
+            "threads": threading.active_count(),
+            "rss_mb": round(rss_mb(), 2),
+            "cpu_time": round(cpu_time, 3),
+            "cpu_percent": round(100 * (cpu_time - last_cpu_time) / (now - last_now), 2) if now > last_now else None,
+            "publish_queue": get_publish_client().pending(),
+        }
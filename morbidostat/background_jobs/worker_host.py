@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Run several background jobs in one Python process, instead of one process per job. The jobs share the imports
+(numpy, paho, ...), `whoami`'s lookup of the experiment, and pubsub's connections, which on a small worker saves
+most of the memory and start up time of each extra job.
+
+>>> mb worker_host --job stirring --job od_reading --job growth_rate_calculating
+
+Jobs can be started and stopped over MQTT:
+
+    morbidostat/<unit>/<experiment>/worker_host/start    {"job": "io_controlling", "kwargs": {"mode": "turbidostat", ...}}
+    morbidostat/<unit>/<experiment>/worker_host/stop     io_controlling
+
+(or stopped like any other job, with `morbidostat/<unit>/<experiment>/<job>/$state/set` set to `disconnected`). The
+names of the running jobs are published, retained, to `morbidostat/<unit>/<experiment>/worker_host/jobs`.
+
+The jobs' periodic tasks share one thread, a utils.timing.Scheduler. Their runs are in each job's `$stats` (`tasks`).
+"""
+import json
+import os
+import signal
+import threading
+from collections import namedtuple
+
+import click
+
+from morbidostat.pubsub import publish, QOS
+from morbidostat import whoami
+from morbidostat.whoami import unit
+from morbidostat.config import config
+from morbidostat.background_jobs import BackgroundJob
+from morbidostat.utils.timing import Scheduler
+
+JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
+
+
+# how a job's periodic task (ex: taking a reading) is run: every `interval` seconds, the first run after `delay` seconds.
+# Tasks that wait (ex: on the pumps) are `blocking`, and run in a thread of their own so they don't hold up the others.
+Periodic = namedtuple("Periodic", ["interval", "task", "delay", "blocking"], defaults=(False,))
+
+
+def start_stirring(duty_cycle=None, verbose=0):
+    from morbidostat.background_jobs.stirring import Stirrer
+
+    if duty_cycle is None:
+        duty_cycle = int(config["stirring"][f"duty_cycle{unit}"])
+    return Stirrer(duty_cycle, unit, whoami.experiment, verbose=verbose), None
+
+
+def start_od_reading(od_angle_channel=None, sampling_rate=None, verbose=0):
+    from morbidostat.background_jobs.od_reading import create_od_reader
+
+    od_angle_channel = od_angle_channel or list(config["od_config"].values())
+    sampling_rate = sampling_rate or 1 / float(config["od_sampling"]["samples_per_second"])
+    reader = create_od_reader(od_angle_channel, verbose=verbose)
+    return reader, Periodic(sampling_rate, reader.take_reading, 0)
+
+
+def start_growth_rate_calculating(ignore_cache=False, verbose=0):
+    from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+
+    return GrowthRateCalculator(verbose=verbose, ignore_cache=ignore_cache, unit=unit, experiment=whoami.experiment), None
+
+
+def start_io_controlling(mode="silent", duration=60, skip_first_run=False, verbose=0, **kwargs):
+    from morbidostat.background_jobs.io_controlling import create_controller
+
+    controller = create_controller(mode=mode, duration=duration, verbose=verbose, **kwargs)
+    return controller, Periodic(duration * 60, controller.run, duration * 60 if skip_first_run else 0, blocking=True)
+
+
+# job name -> function returning the started job and its Periodic task (None for jobs that only react to messages).
+# A job's module is imported the first time the job is started.
+HOSTABLE_JOBS = {
+    "stirring": start_stirring,
+    "od_reading": start_od_reading,
+    "growth_rate_calculating": start_growth_rate_calculating,
+    "io_controlling": start_io_controlling,
+}
+
+
+class HostedJob:
+    """
+    A job running in the host, and its periodic task (if it has one) on the host's scheduler.
+    """
+
+    def __init__(self, name, job, periodic=None):
+        self.name = name
+        self.job = job
+        self.periodic = periodic
+        self.stopped = threading.Event()
+        self._scheduler = None
+        self._task = None
+
+    def start(self, scheduler, on_error):
+        if self.periodic is not None:
+            interval, task, delay, blocking = self.periodic
+            self._scheduler = scheduler
+            self._task = scheduler.add(
+                task,
+                interval,
+                offset=delay,
+                name=self.name,
+                pass_counter=True,
+                stats=self.job.stats,
+                thread=blocking,
+                on_error=lambda _, e: on_error(self, e),
+            )
+
+    @property
+    def is_running(self):
+        return not self.stopped.is_set() and self.job.state != self.job.DISCONNECTED
+
+    def stop(self, timeout=5.0):
+        self.stopped.set()
+        if self._task is not None:
+            self._scheduler.cancel(self._task)
+        if self.job.state != self.job.DISCONNECTED:
+            self.job.set_state(self.job.DISCONNECTED)
+        if self._task is not None:
+            self._task.join(timeout)
+
+
+class WorkerHost(BackgroundJob):
+    editable_settings = []
+
+    def __init__(self, unit=None, experiment=None, verbose=0):
+        super(WorkerHost, self).__init__(job_name=JOB_NAME, verbose=verbose, unit=unit, experiment=experiment)
+        self.hosted_jobs = {}
+        self.scheduler = Scheduler(name=f"{JOB_NAME}_scheduler").start()
+        self._starting = set()
+        self._lock = threading.Lock()
+        self.publish_jobs()
+        self.start_passive_listeners()
+
+    def start_passive_listeners(self):
+        self.subscribe_and_callback(
+            self.on_start_message, f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/start", qos=QOS.EXACTLY_ONCE
+        )
+        self.subscribe_and_callback(
+            self.on_stop_message, f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/stop", qos=QOS.EXACTLY_ONCE
+        )
+        self.subscribe_and_callback(
+            self.on_job_state, f"morbidostat/{self.unit}/{self.experiment}/+/$state", qos=QOS.AT_LEAST_ONCE
+        )
+
+    def on_start_message(self, message):
+        try:
+            request = json.loads(message.payload)
+        except ValueError:
+            request = {"job": message.payload.decode()}
+
+        # starting a job subscribes and waits for retained values, which are delivered on the thread running this
+        # callback, so the job is started from a thread of its own.
+        threading.Thread(target=self.start_job, args=(request["job"],), kwargs=request.get("kwargs", {}), daemon=True).start()
+
+    def on_stop_message(self, message):
+        self.stop_job(message.payload.decode())
+
+    def on_job_state(self, message):
+        # a hosted job can be stopped with its own $state/set.
+        name = message.topic.split("/")[3]
+        if name in self.hosted_jobs and message.payload.decode() == self.DISCONNECTED:
+            self.publish_jobs()
+
+    def start_job(self, name, **kwargs):
+        """
+        Start `name` (a key of HOSTABLE_JOBS) in this process. Returns the job, or None if it didn't start.
+        """
+        with self._lock:
+            self._remove_disconnected_jobs()
+            if name not in HOSTABLE_JOBS or name in self.hosted_jobs or name in self._starting:
+                self.log(f"Not starting {name}: it's unknown, or already running.")
+                return None
+            self._starting.add(name)
+
+        try:
+            hosted = HostedJob(name, *HOSTABLE_JOBS[name](verbose=self.verbose, **kwargs))
+        except Exception as e:
+            with self._lock:
+                self._starting.discard(name)
+            publish(
+                f"morbidostat/{self.unit}/{self.experiment}/error_log",
+                f"[{self.job_name}] {name} failed to start: {str(e)}",
+                verbose=self.verbose,
+            )
+            return None
+
+        with self._lock:
+            self._starting.discard(name)
+            self.hosted_jobs[name] = hosted
+        hosted.start(self.scheduler, on_error=self.on_job_error)
+        self.log(f"Started {name}.")
+        self.publish_jobs()
+        return hosted.job
+
+    def stop_job(self, name):
+        with self._lock:
+            hosted = self.hosted_jobs.pop(name, None)
+        if hosted is None:
+            return
+        hosted.stop()
+        self.log(f"Stopped {name}.")
+        self.publish_jobs()
+
+    def on_job_error(self, hosted, e):
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/error_log", f"[{hosted.name}] failed with {str(e)}", verbose=self.verbose
+        )
+        self.stop_job(hosted.name)
+
+    def _remove_disconnected_jobs(self):
+        # jobs can be stopped behind our back, with their own $state/set.
+        for name in [name for (name, hosted) in self.hosted_jobs.items() if not hosted.is_running]:
+            self.hosted_jobs.pop(name).stop()
+
+    def publish_jobs(self):
+        with self._lock:
+            self._remove_disconnected_jobs()
+            names = ",".join(sorted(self.hosted_jobs))
+        publish(
+            f"morbidostat/{self.unit}/{self.experiment}/{self.job_name}/jobs",
+            names,
+            verbose=self.verbose,
+            retain=True,
+            qos=QOS.AT_LEAST_ONCE,
+        )
+
+    def log(self, message):
+        publish(f"morbidostat/{self.unit}/{self.experiment}/log", f"[{self.job_name}] {message}", verbose=self.verbose)
+
+    def disconnected(self):
+        for name in list(getattr(self, "hosted_jobs", {})):
+            self.stop_job(name)
+        if hasattr(self, "scheduler"):
+            self.scheduler.stop()
+        super(WorkerHost, self).disconnected()
+
+
+def worker_host(jobs=(), verbose=0):
+    host = WorkerHost(unit=unit, experiment=whoami.experiment, verbose=verbose)
+    for name in jobs:
+        host.start_job(name)
+
+    while host.state != host.DISCONNECTED:
+        signal.pause()
+
+
+@click.command()
+@click.option(
+    "--job", "jobs", multiple=True, type=click.Choice(list(HOSTABLE_JOBS)), help="a job to start. Can be invoked multiple times."
+)
+@click.option("--verbose", "-v", count=True, help="print to std. out")
+def click_worker_host(jobs, verbose):
+    worker_host(jobs, verbose)
+
+
+if __name__ == "__main__":
+    click_worker_host()
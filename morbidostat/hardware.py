@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+The hardware the jobs drive: GPIO (pumps, stirring) and the ADS1115s of the OD sensors. `[hardware] backend` in
+config.ini, or the MORBIDOSTAT_HARDWARE environment variable, selects the drivers:
+
+    rpi         RPi.GPIO, and adafruit_ads1x15 ADS1115s on the board's I2C bus.
+    simulated   a culture growing in the process, seen by simulated ADS1115s and diluted by the pumps run through
+                the simulated GPIO (morbidostat/utils/simulated_hardware.py).
+
+    def add_media(...):
+        GPIO = hardware.get_gpio()
+
+    adcs = create_adcs({"135/A": (0x48, 0), "90/A": (0x49, 0)})
+
+The drivers are imported when first used, so importing a job doesn't need the Raspberry Pi's libraries. Get the GPIO
+in the functions that drive the pins: `from morbidostat.hardware import GPIO` at the top of a module loads the driver
+when the module is imported.
+"""
+import os
+import threading
+
+from morbidostat.config import config
+
+_lock = threading.RLock()
+_simulated_culture = None
+_gpio = None
+
+
+def backend():
+    return os.environ.get("MORBIDOSTAT_HARDWARE", config["hardware"].get("backend", "rpi"))
+
+
+def simulated_culture():
+    """
+    The culture of the simulated backend, shared by the process's ADCs and GPIO.
+    """
+    global _simulated_culture
+    with _lock:
+        if _simulated_culture is None:
+            from morbidostat.utils.simulated_hardware import create_culture
+
+            _simulated_culture = create_culture()
+        return _simulated_culture
+
+
+def get_gpio():
+    global _gpio
+    with _lock:
+        if _gpio is None:
+            if backend() == "simulated":
+                from morbidostat.utils.simulated_hardware import SimulatedGPIO
+                from morbidostat.whoami import unit
+
+                gpio = SimulatedGPIO(simulated_culture(), unit)
+            else:
+                import RPi.GPIO as gpio
+
+            gpio.setmode(gpio.BCM)
+            _gpio = gpio
+        return _gpio
+
+
+def create_adcs(channels, gain=8):
+    """
+    {i2c address: ADS1115} for the addresses of `channels`, {label: (i2c address, input)}.
+    """
+    if backend() == "simulated":
+        from morbidostat.utils.simulated_hardware import create_adcs as create_simulated_adcs
+
+        noise = float(config["simulation"].get("noise", 0.002))
+        return create_simulated_adcs(simulated_culture(), channels, gain=gain, noise=noise)
+
+    import adafruit_ads1x15.ads1115 as ADS
+    import board
+    import busio
+
+    i2c = busio.I2C(board.SCL, board.SDA)
+    addresses = sorted({address for (address, _) in channels.values()})
+    return {address: ADS.ADS1115(i2c, gain=gain, address=address) for address in addresses}
+
+
+def __getattr__(name):
+    # `from morbidostat.hardware import GPIO` gets the selected backend's.
+    if name == "GPIO":
+        return get_gpio()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 # pubsub
-import socket
+import atexit
+import fcntl
+import os
+import queue
+import re
+import shutil
+import sys
 import threading
 import time
 import traceback
+import uuid
+from collections import deque, defaultdict, Counter
 from click import echo, style
-from paho.mqtt import publish as mqtt_publish
-from paho.mqtt import subscribe as mqtt_subscribe
-from morbidostat.config import leader_hostname
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from morbidostat.config import leader_hostname, config
+from morbidostat.utils.segment_log import SegmentLog, PublishRecord
 
 
 class QOS:
@@ -16,125 +26,978 @@ class QOS:
     EXACTLY_ONCE = 2
 
 
-def publish(topic, message, hostname=leader_hostname, verbose=0, retries=10, **mqtt_kwargs):
-    retry_count = 1
-    while True:
-        try:
-            mqtt_publish.single(topic, payload=message, hostname=hostname, **mqtt_kwargs)
+MQTT_PROTOCOLS = {"3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+# as in config.ini. 5 keeps the original time of replayed messages, see PublishClient.
+MQTT_PROTOCOL = MQTT_PROTOCOLS[config["network"].get("mqtt_protocol", "5")]
 
-            if (verbose == 1 and topic.endswith("log")) or verbose > 1:
-                current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-                echo(
-                    style(f"{current_time} ", bold=True) + style(f"{topic}: ", fg="bright_blue") + style(f"{message}", fg="green")
-                )
-            return
 
-        except (ConnectionRefusedError, socket.gaierror, OSError, socket.timeout) as e:
-            # possible that leader is down/restarting, keep trying, but log to local machine.
-            current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-            echo(
-                style(f"{current_time}:", fg="white")
-                + style(f"Attempt {retry_count}: Unable to connect to host: {hostname}. {str(e)}", fg="red")
-            )
-            time.sleep(5 * retry_count)  # linear backoff
-            retry_count += 1
+_in_process_broker = None
+_in_process_broker_lock = threading.Lock()
+
+
+def get_in_process_broker():
+    global _in_process_broker
+    with _in_process_broker_lock:
+        if _in_process_broker is None:
+            from morbidostat.utils.in_process_broker import Broker
+
+            _in_process_broker = Broker().start()
+        return _in_process_broker
+
+
+def broker_address(hostname):
+    """
+    The (host, port) to connect to for `hostname`'s broker. If the in-process broker is selected (`[network] broker`
+    in config.ini, or the MORBIDOSTAT_BROKER environment variable), it serves every hostname.
+    """
+    if os.environ.get("MORBIDOSTAT_BROKER", config["network"].get("broker", "mosquitto")) == "in_process":
+        return "127.0.0.1", get_in_process_broker().port
+    return hostname, 1883
+
+
+class PublishClient:
+    """
+    A long-lived connection to a single broker. paho's network loop runs in a daemon thread, and
+    will reconnect on its own if the connection drops (ex: the leader reboots).
+
+    Publishing never blocks the caller: messages are put on an in-memory queue that a sender thread drains.
+    While the broker is unreachable (or the queue is over `max_queue_size`), the sender appends messages to an
+    on-disk segment log instead, and replays them in order once the connection is back. Replayed messages carry the
+    time they were originally published as the MQTT v5 user property `timestamp` (with `[network] mqtt_protocol=5`,
+    the default). A new client also takes over the logs of processes that died before replaying theirs (see
+    `adopt_orphaned_spools`).
+
+    Limits: the queue is only moved to disk by the sender, so while it is busy (writing a batch, or replaying) the
+    queue keeps growing past `max_queue_size`, by the publishes made meanwhile. And a message handed to paho is no
+    longer ours: on a connection that died without paho noticing yet (until its keepalive), QoS 0 messages are lost
+    without a trace. paho re-sends QoS 1 and 2 messages on reconnect, so use those for what mustn't be lost.
+
+    Don't create these directly, use `get_publish_client`, so that a process shares one connection per broker.
+    """
 
-        if retry_count == retries:
-            raise ConnectionRefusedError(f"Unable to connect to host: {hostname}.")
+    def __init__(self, hostname, keepalive=60, max_queue_size=int(config["pubsub"]["max_queue_size"]), protocol=MQTT_PROTOCOL):
+        self.hostname = hostname
+        self.protocol = protocol
+        self.max_queue_size = max_queue_size
+        self._connected = threading.Event()
+        self._stopping = False
+
+        self._pending = deque()
+        self._in_flight = 0  # taken off the queue by the sender, and not yet sent or on disk
+        self._condition = threading.Condition()
+        self._spool = SegmentLog(claim_spool_directory(hostname))
+        adopt_orphaned_spools(self._spool, hostname)
+
+        self._client = mqtt.Client(protocol=protocol)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.connect_async(*broker_address(hostname), keepalive=keepalive)
+        self._client.loop_start()
+
+        self._sender = threading.Thread(target=self._send_forever, daemon=True)
+        self._sender.start()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == mqtt.CONNACK_ACCEPTED:
+            self._connected.set()
+            with self._condition:
+                self._condition.notify()
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        self._connected.clear()
+
+    @property
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def publish(self, topic, message, qos=QOS.AT_MOST_ONCE, retain=False):
+        record = PublishRecord(time.time(), topic, message, qos, retain)
+        with self._condition:
+            self._pending.append(record)
+            self._condition.notify()
+
+    def publish_many(self, records):
+        """
+        Queue several (topic, message, qos, retain) at once, so the sender sends them back to back.
+        """
+        now = time.time()
+        records = [PublishRecord(now, topic, message, qos, retain) for (topic, message, qos, retain) in records]
+        with self._condition:
+            self._pending.extend(records)
+            self._condition.notify()
+
+    def _send(self, record, properties=None):
+        if not self.is_connected:
+            return False
+        info = self._client.publish(
+            record.topic, payload=record.payload, qos=record.qos, retain=record.retain, properties=properties
+        )
+        return info.rc != mqtt.MQTT_ERR_NO_CONN
+
+    def _replay(self, max_records=100):
+        position = None
+        for (next_position, record) in self._spool.read(max_records):
+            if self.protocol == mqtt.MQTTv5:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.UserProperty = ("timestamp", str(record.timestamp))
+            else:
+                properties = None
+
+            if not self._send(record, properties):
+                break
+            position = next_position
+
+        if position is not None:
+            self._spool.commit(position)
+
+    def _send_forever(self):
+        # only this thread writes to the segment log and hands messages to paho, which keeps them in order. The lock
+        # is only held to take records off the queue, so publishing never waits on the disk or the network.
+        while True:
+            with self._condition:
+                while not (self._pending or self._stopping or (self._spool.has_pending() and self.is_connected)):
+                    self._condition.wait(timeout=1.0)
+
+                if self._stopping and not self._pending:
+                    return
 
+                # anything newer has to wait behind what is already on disk. If the sender is far behind, the queue
+                # moves to disk too, keeping the order.
+                to_spool = self._spool.has_pending() or not self.is_connected or len(self._pending) >= self.max_queue_size
+                if to_spool:
+                    records = list(self._pending)
+                    self._pending.clear()
+                else:
+                    records = [self._pending.popleft()]
+                self._in_flight = len(records)
 
-def subscribe(topics, hostname=leader_hostname, retries=10, **mqtt_kwargs):
-    retry_count = 1
-    while True:
+            try:
+                if to_spool:
+                    self._spool.extend(records)
+                    if self.is_connected:
+                        self._replay()
+                elif not self._send(records[0]):
+                    self._spool.append(records[0])
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending) + self._in_flight + self._spool.has_pending()
+
+    def flush(self, timeout=5.0):
+        """
+        Wait for the queue (and the on-disk log) to be handed to paho. Returns False if that didn't happen within `timeout`.
+        """
+        end = time.time() + timeout
+        while self.pending():
+            if time.time() > end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def disconnect(self, timeout=5.0):
+        if self.is_connected:
+            self.flush(timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._sender.join(timeout)
+
+        # whatever didn't make it out goes to disk, to be sent next time.
+        with self._condition:
+            self._spool.extend(self._pending)
+            self._pending.clear()
+            self._spool.close()
+
+        # DISCONNECT is queued behind any outgoing messages, so this flushes before closing.
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._connected.clear()
+
+
+def claim_spool_directory(hostname):
+    """
+    Each process gets its own segment log, named after the script that's running (ex: `od_reading`), so that a
+    restarted job picks up what the previous run couldn't send. A lock file stops two live processes sharing one.
+    """
+    process_name = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+    root = os.path.join(os.path.expanduser(config["pubsub"]["spool_directory"]), hostname)
+
+    for name in (process_name, f"{process_name}-{os.getpid()}"):
+        directory = os.path.join(root, name)
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, "lock"), "w")
         try:
-            return mqtt_subscribe.simple(topics, hostname=hostname, **mqtt_kwargs)
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        _spool_locks.append(lock)
+        return directory
 
-        except (ConnectionRefusedError, socket.gaierror, OSError, socket.timeout) as e:
-            current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-            # possible that leader is down/restarting, keep trying, but log to local machine.
-            echo(
-                style(f"{current_time}:", fg="white")
-                + style(f"Attempt {retry_count}: Unable to connect to host: {hostname}. {str(e)}", fg="red")
-            )
-            time.sleep(5 * retry_count)  # linear backoff
-            retry_count += 1
-
-        if retry_count == retries:
+
+def adopt_orphaned_spools(spool, hostname):
+    """
+    A process that found its name's log taken used a `<name>-<pid>` one, which no later process claims. Move the
+    unsent records of those whose process is gone (unlocked, and the pid dead) to the end of `spool`, and remove them.
+    Returns how many records were moved.
+    """
+    root = os.path.join(os.path.expanduser(config["pubsub"]["spool_directory"]), hostname)
+    moved = 0
+    for name in sorted(os.listdir(root)):
+        directory = os.path.join(root, name)
+        match = re.fullmatch(r".+-(\d+)", name)
+        if directory == spool.directory or match is None or not os.path.isdir(directory) or _is_alive(int(match.group(1))):
+            continue
+
+        with open(os.path.join(directory, "lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            orphan = SegmentLog(directory)
+            while True:
+                records = orphan.read(max_records=1000)
+                if not records:
+                    break
+                spool.extend(record for (_, record) in records)
+                orphan.commit(records[-1][0])
+                moved += len(records)
+            orphan.close()
+            shutil.rmtree(directory)
+    return moved
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_spool_locks = []
+_publish_clients = {}
+_publish_clients_lock = threading.Lock()
+
+
+def get_publish_client(hostname=leader_hostname):
+    with _publish_clients_lock:
+        if hostname not in _publish_clients:
+            _publish_clients[hostname] = PublishClient(hostname)
+        return _publish_clients[hostname]
+
+
+@atexit.register
+def disconnect_publish_clients():
+    publish_policies.release_all()
+    with _publish_clients_lock:
+        for client in _publish_clients.values():
+            client.disconnect()
+        _publish_clients.clear()
+
+
+def flush(hostname=leader_hostname, timeout=5.0):
+    """
+    `publish` returns before the message is sent. Use this to wait until everything published so far has been handed off.
+    """
+    return get_publish_client(hostname).flush(timeout)
+
+
+_publish_counts = Counter()
+_publish_counts_lock = threading.Lock()
+
+
+def get_publish_counts():
+    """
+    Returns {topic: n}, the messages this process has published to each topic (after publish policies).
+    """
+    with _publish_counts_lock:
+        return dict(_publish_counts)
+
+
+def _published_total():
+    with _publish_counts_lock:
+        return sum(_publish_counts.values())
+
+
+def publish(topic, message, hostname=leader_hostname, verbose=0, **mqtt_kwargs):
+    if publish_policies.allow(hostname, topic, message, mqtt_kwargs):
+        get_publish_client(hostname).publish(topic, message, **mqtt_kwargs)
+        with _publish_counts_lock:
+            _publish_counts[topic] += 1
+
+    if (verbose == 1 and topic.endswith("log")) or verbose > 1:
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        echo(style(f"{current_time} ", bold=True) + style(f"{topic}: ", fg="bright_blue") + style(f"{message}", fg="green"))
+
+
+def publish_many(messages, hostname=leader_hostname, verbose=0, qos=QOS.AT_MOST_ONCE, retain=False):
+    """
+    Publish several (topic, message) pairs in one burst: they're queued together, and go out back to back on the
+    connection (paho doesn't wait for one acknowledgement before sending the next message).
+    """
+    mqtt_kwargs = {"qos": qos, "retain": retain}
+    allowed = [(topic, message) for (topic, message) in messages if publish_policies.allow(hostname, topic, message, mqtt_kwargs)]
+    get_publish_client(hostname).publish_many((topic, message, qos, retain) for (topic, message) in allowed)
+    with _publish_counts_lock:
+        _publish_counts.update(topic for (topic, _) in allowed)
+
+    for (topic, message) in allowed:
+        if (verbose == 1 and topic.endswith("log")) or verbose > 1:
             current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-            raise ConnectionRefusedError(f"Unable to connect to host: {hostname}.")
+            echo(style(f"{current_time} ", bold=True) + style(f"{topic}: ", fg="bright_blue") + style(f"{message}", fg="green"))
+
 
+class TopicTrie:
+    """
+    Maps MQTT topic filters, which may contain the wildcards `+` and `#`, to values. `match` walks only the branches
+    that can match a topic, so dispatch cost doesn't grow with the number of unrelated subscriptions.
+    """
+
+    class _Node:
+        __slots__ = ("children", "values")
+
+        def __init__(self):
+            self.children = {}
+            self.values = []
+
+    def __init__(self):
+        self._root = self._Node()
+
+    def insert(self, topic_filter, value):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, self._Node())
+        node.values.append(value)
+
+    def remove(self, topic_filter, value):
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            if level not in path[-1].children:
+                return
+            path.append(path[-1].children[level])
+
+        if value in path[-1].values:
+            path[-1].values.remove(value)
+
+        # prune empty branches
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+
+    def values(self, topic_filter):
+        node = self._root
+        for level in topic_filter.split("/"):
+            if level not in node.children:
+                return []
+            node = node.children[level]
+        return node.values
+
+    def match(self, topic):
+        levels = topic.split("/")
+        # wildcards at the first level don't match topics that start with $, ex: $SYS
+        skip_wildcards_at_root = topic.startswith("$")
+        yield from self._match(self._root, levels, 0, skip_wildcards_at_root)
+
+    def _match(self, node, levels, i, skip_wildcards):
+        if not skip_wildcards and "#" in node.children:
+            # `a/#` also matches `a`
+            yield from node.children["#"].values
+
+        if i == len(levels):
+            yield from node.values
+            return
 
-def subscribe_and_callback(callback, topics, hostname=leader_hostname, timeout=None, max_msgs=None, **mqtt_kwargs):
+        if levels[i] in node.children:
+            yield from self._match(node.children[levels[i]], levels, i + 1, False)
+        if not skip_wildcards and "+" in node.children:
+            yield from self._match(node.children["+"], levels, i + 1, False)
+
+
+class PublishPolicy:
     """
-    Creates a new thread, wrapping around paho's subscribe.callback. Callbacks only accept a single parameter, message.
+    Limits how often a (high-frequency) topic is sent.
+
+    max_rate: at most this many messages per second.
+    coalesce: if True, a message over the rate isn't dropped but held, and sent once the rate allows. A newer message
+        replaces a held one, so the latest value always gets through.
+    deadband: numeric messages within `deadband` of the last value sent are dropped...
+    max_interval: ...unless nothing has been sent for `max_interval` seconds, so consumers don't think the topic is stale.
+    """
+
+    def __init__(self, max_rate=None, coalesce=True, deadband=None, max_interval=None):
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.coalesce = coalesce
+        self.deadband = deadband
+        self.max_interval = max_interval
+
+
+class _TopicState:
+    __slots__ = ("last_sent", "last_value", "held", "timer")
+
+    def __init__(self):
+        self.last_sent = -float("inf")
+        self.last_value = None
+        self.held = None
+        self.timer = None
+
+
+def _as_float(message):
+    try:
+        return float(message)
+    except (TypeError, ValueError):
+        return None
+
+
+class PublishPolicies:
+    """
+    The policies registered in this process, keyed by topic filter, with counts of messages forwarded and
+    suppressed per topic. If several filters match a topic, the one with the fewest wildcards is used.
+    """
+
+    def __init__(self):
+        self._trie = TopicTrie()
+        self._policies = {}
+        self._lookup = {}
+        self._states = {}
+        self._lock = threading.Lock()
+        self.stats = defaultdict(Counter)
+
+    def set(self, topic_filter, policy):
+        with self._lock:
+            if topic_filter in self._policies:
+                self._trie.remove(topic_filter, (topic_filter, self._policies[topic_filter]))
+            self._policies[topic_filter] = policy
+            self._trie.insert(topic_filter, (topic_filter, policy))
+            self._lookup.clear()
+
+    def remove(self, topic_filter):
+        with self._lock:
+            policy = self._policies.pop(topic_filter, None)
+            if policy is not None:
+                self._trie.remove(topic_filter, (topic_filter, policy))
+                self._lookup.clear()
+
+    def clear(self):
+        self.release_all()
+        with self._lock:
+            self._trie = TopicTrie()
+            self._policies.clear()
+            self._lookup.clear()
+            self._states.clear()
+            self.stats.clear()
+
+    def _policy_for(self, topic):
+        if topic not in self._lookup:
+            matches = sorted(self._trie.match(topic), key=lambda match: match[0].count("+") + match[0].count("#"))
+            self._lookup[topic] = matches[0][1] if matches else None
+        return self._lookup[topic]
+
+    def allow(self, hostname, topic, message, mqtt_kwargs):
+        """
+        Returns True if the message should be sent now. Otherwise it's been dropped, or held to be sent later.
+        """
+        if not self._policies:
+            return True
+
+        with self._lock:
+            policy = self._policy_for(topic)
+            if policy is None:
+                return True
+
+            state = self._states.setdefault((hostname, topic), _TopicState())
+            stats = self.stats[topic]
+            now = time.monotonic()
+            value = _as_float(message) if policy.deadband is not None else None
+
+            if (
+                value is not None
+                and state.last_value is not None
+                and abs(value - state.last_value) < policy.deadband
+                and not (policy.max_interval is not None and now - state.last_sent >= policy.max_interval)
+            ):
+                # nothing new to say, and that includes anything held.
+                stats["suppressed"] += 1 + (state.held is not None)
+                state.held = None
+                return False
+
+            wait = state.last_sent + policy.min_interval - now
+            if wait <= 0:
+                stats["suppressed"] += state.held is not None
+                state.held = None
+                state.last_sent, state.last_value = now, value
+                stats["forwarded"] += 1
+                return True
+
+            if not policy.coalesce:
+                stats["suppressed"] += 1
+                return False
+
+            stats["suppressed"] += state.held is not None
+            state.held = (message, value, mqtt_kwargs)
+            if state.timer is None:
+                state.timer = threading.Timer(wait, self._release, (hostname, topic))
+                state.timer.daemon = True
+                state.timer.start()
+            return False
+
+    def _release(self, hostname, topic):
+        with self._lock:
+            state = self._states[(hostname, topic)]
+            state.timer = None
+            if state.held is None:
+                return
+            message, value, mqtt_kwargs = state.held
+            state.held = None
+            state.last_sent, state.last_value = time.monotonic(), value
+            self.stats[topic]["forwarded"] += 1
+
+        get_publish_client(hostname).publish(topic, message, **mqtt_kwargs)
+        with _publish_counts_lock:
+            _publish_counts[topic] += 1
+
+    def release_all(self):
+        """
+        Send anything held now, ex: at exit.
+        """
+        with self._lock:
+            held = [key for (key, state) in self._states.items() if state.held is not None]
+            for state in self._states.values():
+                if state.timer is not None:
+                    state.timer.cancel()
+                    state.timer = None
+        for (hostname, topic) in held:
+            self._release(hostname, topic)
+
+
+publish_policies = PublishPolicies()
+
+
+def set_publish_policy(topic_filter, max_rate=None, coalesce=True, deadband=None, max_interval=None):
+    """
+    Throttle messages `publish`ed (by this process) to topics matching `topic_filter`. See `PublishPolicy`. Ex:
+
+        set_publish_policy(f"morbidostat/{unit}/{experiment}/od_filtered/#", max_rate=1)
+
+    """
+    publish_policies.set(topic_filter, PublishPolicy(max_rate, coalesce, deadband, max_interval))
+
+
+def remove_publish_policy(topic_filter):
+    publish_policies.remove(topic_filter)
+
+
+def get_publish_policy_stats():
+    """
+    Returns {topic: {"forwarded": n, "suppressed": m}} for topics that have a policy.
+    """
+    with publish_policies._lock:
+        return {topic: dict(counts) for (topic, counts) in publish_policies.stats.items()}
+
+
+class Subscription:
+    """
+    A callback registered on a process's shared `SubscribeClient`. Has the `join` / `is_alive` interface of
+    the thread that `subscribe_and_callback` used to return.
 
-    Parameters
-    -------------
     timeout: float
-        the client will  only listen for <timeout> seconds before disconnecting. (kinda)
+        stop listening after <timeout> seconds.
     max_msgs: int
-        the client will process <max_msgs> messages before disconnecting.
+        stop listening after <max_msgs> messages.
+    """
 
+    def __init__(self, callback, topic_filters, qos=QOS.AT_MOST_ONCE, timeout=None, max_msgs=None):
+        self.callback = callback
+        self.topic_filters = topic_filters
+        self.qos = qos
+        self.max_msgs = max_msgs
+        self.deadline = time.time() + timeout if timeout else None
+
+        self.count = 0
+        self.client = None
+        self.subscribed = threading.Event()  # set when the broker acknowledges the subscription
+        self._done = threading.Event()
+
+        # when a second subscription to a topic filter is added, the broker re-sends retained messages to the shared
+        # client. Those are for the new subscription, so a subscription skips a retained message with the payload it
+        # last saw on the topic. One that changed (ex: while the client was reconnecting) is delivered.
+        self._seen_payloads = {}  # topic -> the payload of the last message delivered
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def is_expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def join(self, timeout=None):
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.time(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        self._done.wait(timeout)
+        if self.is_expired():
+            self.cancel()
+
+    def cancel(self):
+        if self.is_alive():
+            self._done.set()
+            if self.client is not None:
+                self.client.remove(self)
+
+    def deliver(self, message):
+        if not self.is_alive():
+            return
 
-    TODO: what happens when I lose connection to host?
-    """
+        if self.is_expired():
+            self.cancel()
+            return
 
-    def wrap_callback(actual_callback):
-        def _callback(client, userdata, message):
-            try:
-                if "timeout" in userdata and time.time() - userdata["started_at"] > userdata["timeout"]:
-                    client.disconnect()
-                    return
+        if message.retain and self._seen_payloads.get(message.topic) == message.payload:
+            return
+        self._seen_payloads[message.topic] = message.payload
 
-                if "max_msgs" in userdata:
-                    if userdata["count"] > userdata["max_msgs"]:
-                        client.disconnect()
-                        return
-                    else:
-                        userdata["count"] += 1
+        self.count += 1
+        if self.max_msgs is not None and self.count >= self.max_msgs:
+            self.cancel()
 
-                return actual_callback(message)
+        try:
+            self.callback(message)
+        except Exception as e:
+            # don't let one bad callback take down dispatch for every other subscription in the process.
+            traceback.print_exc()
 
-            except Exception as e:
-                traceback.print_exc()
+            # this is paho's network thread, so don't look up the experiment: that waits on a message from this thread.
+            from morbidostat import whoami
 
-                from morbidostat.whoami import unit, experiment
+            if whoami.latest_experiment.value is not None:
+                publish(f"morbidostat/{whoami.unit}/{whoami.latest_experiment.value}/error_log", str(e), verbose=1)
 
-                publish(f"morbidostat/{unit}/{experiment}/error_log", str(e), verbose=1)
 
-                raise e
+class SubscribeClient:
+    """
+    One connection per broker holds every subscription in the process. Incoming messages are dispatched to
+    `Subscription`s through a `TopicTrie`, on paho's network thread, so thread and connection counts don't grow
+    as jobs add listeners.
 
-        return _callback
+    Don't create these directly, use `get_subscribe_client`.
+    """
+
+    def __init__(self, hostname, keepalive=60):
+        self.hostname = hostname
+        self._trie = TopicTrie()
+        self._filters = {}  # topic filter -> number of subscriptions
+        self._timed_subscriptions = []
+        self._lock = threading.RLock()
+        self._connected = threading.Event()
+        self._subacks = {}  # mid -> Event
+
+        self._client = mqtt.Client(protocol=MQTT_PROTOCOL)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_subscribe = self._on_subscribe
+        self._client.on_message = self._on_message
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.connect_async(*broker_address(hostname), keepalive=keepalive)
+        self._client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        # the broker forgets our subscriptions when we disconnect, so (re)subscribe to everything.
+        with self._lock:
+            topics = [(topic_filter, self._max_qos(topic_filter)) for topic_filter in self._filters]
+        if topics:
+            self._client.subscribe(topics)
+        if rc == mqtt.CONNACK_ACCEPTED:
+            self._connected.set()
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        self._connected.clear()
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        with self._lock:
+            subscribed = self._subacks.pop(mid, None)
+        if subscribed is not None:
+            subscribed.set()
+
+    def wait_for_connection(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def publish_barrier(self, topic):
+        """
+        Publish on the subscriber's own connection. Sent after a subscription is acknowledged, this arrives back
+        after the retained messages for that subscription.
+        """
+        self._client.publish(topic, payload=b"", qos=QOS.AT_MOST_ONCE)
+
+    def _max_qos(self, topic_filter):
+        return max(subscription.qos for subscription in self._trie.values(topic_filter))
+
+    def _on_message(self, client, userdata, message):
+        with self._lock:
+            self._remove_expired()
+            # a subscription with overlapping filters should only see a message once.
+            subscriptions = list({id(s): s for s in self._trie.match(message.topic)}.values())
+
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def _remove_expired(self):
+        if self._timed_subscriptions:
+            for subscription in [s for s in self._timed_subscriptions if s.is_expired()]:
+                subscription.cancel()
+
+    def add(self, subscription):
+        subscription.client = self
+        with self._lock:
+            self._remove_expired()
+            for topic_filter in subscription.topic_filters:
+                self._trie.insert(topic_filter, subscription)
+                self._filters[topic_filter] = self._filters.get(topic_filter, 0) + 1
+
+            # always (re)subscribe, so the broker sends this subscription any retained messages.
+            _, mid = self._client.subscribe([(f, self._max_qos(f)) for f in subscription.topic_filters])
+            self._subacks[mid] = subscription.subscribed
+
+            if subscription.deadline is not None:
+                self._timed_subscriptions.append(subscription)
+        return subscription
+
+    def remove(self, subscription):
+        with self._lock:
+            for topic_filter in subscription.topic_filters:
+                self._trie.remove(topic_filter, subscription)
+                self._filters[topic_filter] -= 1
+                if self._filters[topic_filter] == 0:
+                    del self._filters[topic_filter]
+                    self._client.unsubscribe(topic_filter)
+
+            if subscription in self._timed_subscriptions:
+                self._timed_subscriptions.remove(subscription)
+
+    def disconnect(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+
+_subscribe_clients = {}
+_subscribe_clients_lock = threading.Lock()
+
+
+def get_subscribe_client(hostname=leader_hostname):
+    with _subscribe_clients_lock:
+        if hostname not in _subscribe_clients:
+            _subscribe_clients[hostname] = SubscribeClient(hostname)
+        return _subscribe_clients[hostname]
+
+
+def _as_list(topics):
+    return [topics] if isinstance(topics, str) else list(topics)
+
+
+def subscribe(topics, hostname=leader_hostname, timeout=None, qos=QOS.AT_MOST_ONCE):
+    """
+    Block until a message arrives on one of `topics`, and return it. Returns None if nothing arrived within `timeout` seconds.
+
+    Don't call this from inside a callback: callbacks run on the thread that would deliver the message.
+    """
+    messages = []
+    subscription = get_subscribe_client(hostname).add(Subscription(messages.append, _as_list(topics), qos=qos, max_msgs=1))
+    subscription.join(timeout)
+    subscription.cancel()
+    return messages[0] if messages else None
 
-    assert callable(callback), "callback should be callable - did you mess up the order of arguments?"
 
-    userdata = {}
-    if timeout:
-        userdata["started_at"] = time.time()
-        userdata["timeout"] = timeout
+def subscribe_and_callback(callback, topics, hostname=leader_hostname, timeout=None, max_msgs=None, qos=QOS.AT_MOST_ONCE):
+    """
+    Register `callback` on the process's shared subscriber. Callbacks only accept a single parameter, message, and
+    all callbacks share one thread, so they should return quickly.
 
-    if max_msgs:
-        userdata["count"] = 0
-        userdata["max_msgs"] = max_msgs
+    Parameters
+    -------------
+    timeout: float
+        stop listening after <timeout> seconds.
+    max_msgs: int
+        stop listening after <max_msgs> messages.
 
-    thread = threading.Thread(
-        target=mqtt_subscribe.callback,
-        args=(wrap_callback(callback), topics),
-        kwargs={"hostname": hostname, "userdata": userdata, **mqtt_kwargs},
-        daemon=True,
-    )
-    thread.start()
-    return thread
+    Returns a `Subscription`, which can be `cancel`ed.
+    """
+    assert callable(callback), "callback should be callable - did you mess up the order of arguments?"
 
+    subscription = Subscription(callback, _as_list(topics), qos=qos, timeout=timeout, max_msgs=max_msgs)
+    return get_subscribe_client(hostname).add(subscription)
 
-def prune_retained_messages(topics_to_prune="#", hostname=leader_hostname):
-    topics = []
+
+def get_retained(topics, hostname=leader_hostname, timeout=3.0):
+    """
+    Fetch the retained values of several topics in one round trip. Returns a dict of topic -> payload (bytes), with None
+    for topics that have no retained message.
+
+    Returns as soon as the broker has sent its retained messages: once the subscription is acknowledged, we publish a
+    "barrier" message to ourselves, which the broker delivers after the retained set. If this process has been
+    publishing, the barrier goes out behind those messages, on the same connection, so we never read back a value
+    older than one we've published (they arrive as live messages before the barrier). `timeout` only matters if the
+    broker is unreachable.
+    """
+    topics = _as_list(topics)
+    barrier = f"morbidostat/_retained_barrier/{uuid.uuid4().hex}"
+    retained = {topic: None for topic in topics if not ("+" in topic or "#" in topic)}
+    done = threading.Event()
 
     def on_message(message):
-        topics.append(message.topic)
+        if message.topic == barrier:
+            done.set()
+        else:
+            retained[message.topic] = message.payload or None
+
+    end = time.time() + timeout
+    client = get_subscribe_client(hostname)
+    if not client.wait_for_connection(timeout):
+        return retained
+
+    subscription = client.add(Subscription(on_message, topics + [barrier]))
+    if subscription.subscribed.wait(max(end - time.time(), 0)):
+        publish_client = _publish_clients.get(hostname)
+        if publish_client is not None and publish_client.is_connected:
+            publish_client.publish(barrier, b"")
+        else:
+            client.publish_barrier(barrier)
+        done.wait(max(end - time.time(), 0))
+    subscription.cancel()
+    return retained
+
+
+def settle(hostname=leader_hostname, timeout=5.0, rounds=3):
+    """
+    Wait until what this process has published so far has been delivered to, and handled by, this process's
+    subscriptions. Returns False on timeout. Useful in tests, instead of sleeping. Don't call it from a callback.
+
+    A broker forwards one connection's messages in order, so once a barrier published after them comes back on the
+    subscriber connection, the messages before it have been dispatched. If callbacks published in the meantime (ex: a
+    job's attributes, after a `/set`), we wait for those too, up to `rounds` barriers.
+    """
+    end = time.time() + timeout
+    for _ in range(rounds):
+        barrier = f"morbidostat/_settle_barrier/{uuid.uuid4().hex}"
+        done = threading.Event()
+        subscription = get_subscribe_client(hostname).add(Subscription(lambda message: done.set(), [barrier], max_msgs=1))
+        if subscription.subscribed.wait(max(end - time.time(), 0)):
+            published = _published_total()
+            # not counted, so the barriers' topics, new every time, don't pile up in the jobs' $stats.
+            get_publish_client(hostname).publish(barrier, "")
+            done.wait(max(end - time.time(), 0))
+        subscription.cancel()
+
+        if not done.is_set():
+            return False
+        if _published_total() == published:
+            break
+    return True
+
+
+class RetainedMessagesClient:
+    """
+    One connection for bulk work on retained messages: stream the ones matching some topic filters, and set or
+    clear many at once. Publishes are pipelined in batches of `batch_size`, waiting for the broker's acks per batch
+    rather than per message.
 
-    thread = subscribe_and_callback(on_message, topics_to_prune, hostname=hostname)
-    thread.join(timeout=1)
+        with RetainedMessagesClient() as client:
+            for message in client.stream("morbidostat/+/exp/#"):
+                print(message.topic, message.payload)
 
-    for topic in topics.copy():
-        publish(topic, None, retain=True, hostname=hostname)
+    """
+
+    def __init__(self, hostname=leader_hostname, batch_size=500, timeout=30.0, keepalive=60):
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._messages = queue.Queue()
+        self._subacks = {}
+
+        self._client = mqtt.Client(protocol=MQTT_PROTOCOL)
+        self._client.max_inflight_messages_set(batch_size)
+        self._client.on_message = lambda client, userdata, message: self._messages.put(message)
+        self._client.on_subscribe = self._on_subscribe
+        self._client.connect(*broker_address(hostname), keepalive=keepalive)
+        self._client.loop_start()
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        self._subacks.setdefault(mid, threading.Event()).set()
+
+    def stream(self, topic_filters):
+        """
+        Yields the retained messages on topics matching `topic_filters`, as the broker sends them.
+        """
+        topic_filters = _as_list(topic_filters)
+        barrier = f"morbidostat/_retained_barrier/{uuid.uuid4().hex}"
+
+        _, mid = self._client.subscribe([(topic_filter, QOS.EXACTLY_ONCE) for topic_filter in topic_filters] + [(barrier, 0)])
+        if not self._subacks.setdefault(mid, threading.Event()).wait(self.timeout):
+            raise TimeoutError("The broker didn't acknowledge the subscription.")
+        # the broker sends the retained messages when it processes the subscription, so this comes back after them.
+        self._client.publish(barrier, b"")
+
+        seen = set()
+        try:
+            while True:
+                try:
+                    message = self._messages.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("Timed out waiting for retained messages.")
+                if message.topic == barrier:
+                    return
+                # skip live messages (including our own clears), and duplicates from overlapping filters.
+                if message.retain and message.payload and message.topic not in seen:
+                    seen.add(message.topic)
+                    yield message
+        finally:
+            self._client.unsubscribe(topic_filters + [barrier])
+
+    def publish_retained(self, messages):
+        """
+        messages: iterable of (topic, payload), with payload None to clear the topic. Returns how many were sent.
+        """
+        count = 0
+        in_flight = []
+        for (topic, payload) in messages:
+            in_flight.append(self._client.publish(topic, payload, qos=QOS.AT_LEAST_ONCE, retain=True))
+            count += 1
+            if len(in_flight) >= self.batch_size:
+                self._wait_for(in_flight)
+        self._wait_for(in_flight)
+        return count
+
+    def clear(self, topics):
+        return self.publish_retained((topic, None) for topic in topics)
+
+    def _wait_for(self, in_flight):
+        end = time.time() + self.timeout
+        for info in in_flight:
+            info.wait_for_publish(max(end - time.time(), 0))
+            if not info.is_published():
+                raise TimeoutError("The broker didn't acknowledge the messages.")
+        in_flight.clear()
+
+    def disconnect(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect()
+
+
+def prune_retained_messages(topics_to_prune="#", hostname=leader_hostname, batch_size=500):
+    """
+    Clear every retained message on topics matching `topics_to_prune`. Returns how many were cleared.
+    """
+    with RetainedMessagesClient(hostname, batch_size=batch_size) as client:
+        # collect the topics before clearing, else the broker echoes every clear back to us while we're subscribed.
+        return client.clear([message.topic for message in client.stream(topics_to_prune)])
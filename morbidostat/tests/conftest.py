@@ -5,6 +5,7 @@ import pytest
 
 
 # Replace libraries by fake RPi ones
+import os
 import sys
 import fake_rpi
 
@@ -14,6 +15,52 @@ sys.modules["smbus"] = fake_rpi.smbus  # Fake smbus (I2C)
 
 fake_rpi.toggle_print(False)
 
+# run against a broker inside the test process, unless told otherwise (ex: MORBIDOSTAT_BROKER=mosquitto)
+os.environ.setdefault("MORBIDOSTAT_BROKER", "in_process")
+# and against simulated hardware (a culture that grows, and that the pumps dilute)
+os.environ.setdefault("MORBIDOSTAT_HARDWARE", "simulated")
+
 from morbidostat.config import config
 
 config["network"]["leader_hostname"] = "localhost"
+
+
+@pytest.fixture(autouse=True)
+def clear_publish_policies():
+    # policies are per process, so don't let one test's jobs throttle the next test's publishes.
+    from morbidostat import pubsub
+
+    yield
+    pubsub.publish_policies.clear()
+
+
+@pytest.fixture(autouse=True)
+def stop_jobs_and_reset_the_simulated_hardware(monkeypatch):
+    # a job a test leaves running keeps its listeners and threads, and (ex: an io_controlling) goes on dosing the
+    # culture of the tests after it. So each test's jobs are stopped, and the next test gets a new culture and GPIO.
+    from morbidostat import hardware
+    from morbidostat.background_jobs import BackgroundJob
+
+    jobs = []
+    init = BackgroundJob.init
+
+    def recording_init(self):
+        jobs.append(self)
+        init(self)
+
+    monkeypatch.setattr(BackgroundJob, "init", recording_init)
+    yield
+    for job in jobs:
+        if job.state != job.DISCONNECTED:
+            job.set_state(job.DISCONNECTED)
+    with hardware._lock:
+        hardware._simulated_culture = None
+        hardware._gpio = None
+
+
+@pytest.fixture(autouse=True, scope="session")
+def keep_files_out_of_the_home_directory(tmp_path_factory):
+    # the publish clients' on-disk logs would otherwise be left in (and replayed from) the user's ~/.morbidostat, and
+    # od_reading's ring buffer would take the place of the worker's own readings there.
+    config["pubsub"]["spool_directory"] = str(tmp_path_factory.mktemp("publish_spool"))
+    config["od_sampling"]["ring_buffer"] = str(tmp_path_factory.mktemp("od_sampling") / "od_readings_raw.ring")
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from morbidostat.background_jobs.async_jobs import async_jobs
+from morbidostat.pubsub import publish, subscribe_and_callback
+from morbidostat.whoami import unit, experiment
+
+
+def test_od_reading_growth_rate_and_io_controlling_run_on_one_loop():
+    received = {"od_raw_batched": [], "growth_rate": [], "log": []}
+    for topic, messages in received.items():
+        subscribe_and_callback(
+            lambda message, messages=messages: messages.append(message), f"morbidostat/{unit}/{experiment}/{topic}"
+        )
+
+    def io_controlling_ran():
+        return any(b"[io_controlling]: triggered" in message.payload for message in received["log"])
+
+    async def stop_when_io_controlling_has_run():
+        # it runs on the growth rate and the filtered OD.
+        while not io_controlling_ran():
+            await asyncio.sleep(0.05)
+        for job in ["od_reading", "growth_rate_calculating", "io_controlling"]:
+            publish(f"morbidostat/{unit}/{experiment}/{job}/$state/set", "disconnected")
+
+    async def main():
+        jobs = async_jobs(
+            {
+                "od_reading": {"sampling_rate": 0.1},
+                "growth_rate_calculating": {},
+                "io_controlling": {"mode": "silent", "duration": 1 / 60, "skip_first_run": True},
+            }
+        )
+        # every job returns once it's disconnected.
+        await asyncio.wait_for(asyncio.gather(jobs, stop_when_io_controlling_has_run()), 30)
+
+    asyncio.run(main())
+    assert len(received["od_raw_batched"]) > 1 and received["growth_rate"]
+    assert io_controlling_ran()
+
+
+def test_readings_are_taken_off_the_loop(monkeypatch):
+    import threading
+    from morbidostat.background_jobs.async_jobs import od_reading
+    from morbidostat.background_jobs.od_reading import ODReader
+
+    threads = []
+    take_reading = ODReader.take_reading
+
+    def recording_take_reading(self, counter=None):
+        threads.append(threading.current_thread())
+        return take_reading(self, counter=counter)
+
+    monkeypatch.setattr(ODReader, "take_reading", recording_take_reading)
+
+    async def stop_after_two_readings():
+        while len(threads) < 2:
+            await asyncio.sleep(0.05)
+        publish(f"morbidostat/{unit}/{experiment}/od_reading/$state/set", "disconnected")
+
+    async def main():
+        await asyncio.wait_for(asyncio.gather(od_reading(sampling_rate=0.1), stop_after_two_readings()), 30)
+
+    asyncio.run(main())
+    assert threading.main_thread() not in threads
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import paho.mqtt.client as mqtt
+
+from morbidostat import async_pubsub
+from morbidostat.pubsub import publish, settle
+from morbidostat.whoami import unit, experiment
+
+
+def test_subscribe_returns_the_next_message_or_none_after_the_timeout():
+    topic = f"morbidostat/{unit}/{experiment}/async_subscribe"
+
+    async def main():
+        waiting = asyncio.ensure_future(async_pubsub.subscribe(topic, timeout=5))
+        await asyncio.sleep(0.2)
+        await async_pubsub.publish(topic, "hello")
+        message = await waiting
+        nothing = await async_pubsub.subscribe(topic, timeout=0.2)
+        return message, nothing
+
+    message, nothing = asyncio.run(main())
+    assert message.payload == b"hello"
+    assert nothing is None
+
+
+def test_iteration_ends_after_max_msgs_in_order():
+    topic = f"morbidostat/{unit}/{experiment}/async_iter"
+
+    async def main():
+        received = []
+        async with async_pubsub.subscribe_iter(topic, max_msgs=3, timeout=5) as messages:
+            settle()
+            for i in range(5):
+                await async_pubsub.publish(topic, i)
+            async for message in messages:
+                received.append(message.payload)
+        return received
+
+    assert asyncio.run(main()) == [b"0", b"1", b"2"]
+
+
+def test_the_last_message_isnt_dropped_when_the_subscription_finishes_before_it_is_queued():
+    # Subscription.deliver finishes the subscription (max_msgs) before it hands the message over: iteration must not
+    # take the finished subscription for the end, while the message is on its way.
+    topic = f"morbidostat/{unit}/{experiment}/async_race"
+    message = mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = b"last"
+
+    async def main():
+        messages = async_pubsub.subscribe_iter(topic, max_msgs=1)
+        handing_over = threading.Event()
+        callback = messages.subscription.callback
+
+        def slow_callback(message):
+            handing_over.wait(5)
+            callback(message)
+
+        messages.subscription.callback = slow_callback
+        threading.Thread(target=messages.subscription.deliver, args=(message,), daemon=True).start()
+        await asyncio.sleep(0.1)
+        assert not messages.subscription.is_alive()
+
+        next_message = asyncio.ensure_future(messages.__anext__())
+        await asyncio.sleep(0.1)
+        handing_over.set()
+        received = await asyncio.wait_for(next_message, 5)
+        return received, [m async for m in messages]
+
+    received, rest = asyncio.run(main())
+    assert received.payload == b"last"
+    assert rest == []
+
+
+def test_cancel_ends_a_waiting_iteration():
+    topic = f"morbidostat/{unit}/{experiment}/async_cancel"
+
+    async def main():
+        messages = async_pubsub.subscribe_iter(topic)
+        consumer = asyncio.ensure_future(asyncio.wait_for(messages.__anext__(), 5))
+        await asyncio.sleep(0.1)
+        messages.cancel()
+        try:
+            await consumer
+        except StopAsyncIteration:
+            return True
+        return False
+
+    assert asyncio.run(main())
+
+
+def test_get_retained():
+    retained = f"morbidostat/{unit}/{experiment}/async_retained"
+    publish(retained, "kept", retain=True)
+    settle()
+
+    values = asyncio.run(async_pubsub.get_retained([retained, f"{retained}_not"], timeout=2))
+    assert values == {retained: b"kept", f"{retained}_not": None}
@@ -1,16 +1,15 @@
 # -*- coding: utf-8 -*-
 # test background_job
 import pytest
-import time
 
 from morbidostat.background_jobs import BackgroundJob
 from morbidostat.whoami import unit, experiment as exp
-from morbidostat.pubsub import publish
+from morbidostat.pubsub import publish, settle
 
 
 def pause():
-    # to avoid race conditions
-    time.sleep(0.5)
+    # wait until everything published so far has been handled
+    settle()
 
 
 def test_states():
@@ -25,3 +24,249 @@ def test_states():
 
     publish(f"morbidostat/{unit}/{exp}/job/$state/set", "disconnected")
     pause()
+
+
+def test_attributes_are_published_on_change_and_batched():
+    from morbidostat.pubsub import subscribe_and_callback
+
+    class JustSomeJob(BackgroundJob):
+        editable_settings = ["volume", "target_od"]
+
+        def __init__(self, **kwargs):
+            super(JustSomeJob, self).__init__(job_name="just_some_job", unit=unit, experiment=exp)
+            self.volume = 1.0
+            self.target_od = 1.0
+
+    received = []
+    subscribe_and_callback(lambda message: received.append(message.payload), f"morbidostat/{unit}/{exp}/just_some_job/volume")
+    settle()
+
+    job = JustSomeJob()
+    job.volume = 1.0
+    job.volume = 1.0
+    pause()
+    assert received == [b"1.0"]
+
+    with job.batched_attr_updates():
+        job.volume = 2.0
+        job.volume = 3.0
+        job.target_od = 2.0
+        pause()
+        assert received == [b"1.0"]
+    pause()
+    assert received == [b"1.0", b"3.0"]
+
+    # changes made while handling a message are published once the handler returns
+    publish(f"morbidostat/{unit}/{exp}/just_some_job/volume/set", 4.0)
+    pause()
+    assert received == [b"1.0", b"3.0", b"4.0"]
+    job.set_state("disconnected")
+
+
+def test_a_dict_changed_in_place_is_republished():
+    from morbidostat.pubsub import subscribe_and_callback
+
+    class JustSomeJob(BackgroundJob):
+        editable_settings = ["gains"]
+
+        def __init__(self, **kwargs):
+            super(JustSomeJob, self).__init__(job_name="dict_job", unit=unit, experiment=exp)
+            self.gains = {"135/A": 1}
+
+    received = []
+    subscribe_and_callback(lambda message: received.append(message.payload), f"morbidostat/{unit}/{exp}/dict_job/gains")
+    settle()
+
+    job = JustSomeJob()
+    job.gains["135/A"] = 2
+    job.gains = job.gains
+    job.publish_attr("gains")
+    pause()
+    assert received == [b'{"135/A": 1}', b'{"135/A": 2}']
+    job.set_state("disconnected")
+
+
+def test_job_moves_to_another_experiment():
+    from morbidostat.pubsub import get_retained
+
+    class JustSomeJob(BackgroundJob):
+        editable_settings = ["volume"]
+
+        def __init__(self, **kwargs):
+            super(JustSomeJob, self).__init__(job_name="moving_job", unit=unit, experiment=exp)
+            self.volume = 1.0
+
+    job = JustSomeJob()
+    job.set_experiment("_another_experiment")
+    assert job.experiment == "_another_experiment"
+    pause()
+
+    old, new = f"morbidostat/{unit}/{exp}/moving_job", f"morbidostat/{unit}/_another_experiment/moving_job"
+    retained = get_retained([f"{old}/$state", f"{new}/$state", f"{new}/volume"])
+    assert retained == {f"{old}/$state": b"disconnected", f"{new}/$state": b"ready", f"{new}/volume": b"1.0"}
+
+    # it listens on the new experiment's topics, and not the old ones.
+    publish(f"{old}/volume/set", 2.0)
+    publish(f"{new}/volume/set", 3.0)
+    pause()
+    assert job.volume == 3.0
+
+    job.set_state("disconnected")
+
+
+def test_runtime_stats_are_published():
+    import json
+    from morbidostat.pubsub import get_retained
+
+    class JustSomeJob(BackgroundJob):
+        editable_settings = ["volume"]
+
+        def __init__(self, **kwargs):
+            super(JustSomeJob, self).__init__(job_name="stats_job", unit=unit, experiment=exp)
+            self.volume = 1.0
+
+    job = JustSomeJob()
+    for volume in [2.0, 3.0]:
+        publish(f"morbidostat/{unit}/{exp}/stats_job/volume/set", volume)
+    pause()
+    job.stats.record_tick(drift=0.5, skipped=2)
+    job.publish_stats()
+    pause()
+
+    stats = json.loads(get_retained(f"morbidostat/{unit}/{exp}/stats_job/$stats")[f"morbidostat/{unit}/{exp}/stats_job/$stats"])
+    assert stats["callbacks"]["set_attr_from_message"]["count"] == 2
+    assert sum(stats["callbacks"]["set_attr_from_message"]["histogram_ms"].values()) == 2
+    assert stats["messages_in"] == {f"morbidostat/{unit}/{exp}/stats_job/volume/set": 2}
+    assert stats["messages_out"][f"morbidostat/{unit}/{exp}/stats_job/volume"] >= 3
+    assert stats["ticks"] == {"count": 1, "skipped": 2, "drift_mean_ms": 500.0, "drift_max_ms": 500.0, "drift_last_ms": 500.0}
+    assert stats["threads"] >= 1 and stats["rss_mb"] > 0 and stats["cpu_time"] > 0
+
+    job.set_state("disconnected")
+
+
+def test_profile_is_published_and_written(monkeypatch, tmp_path):
+    import threading
+    import time
+    from morbidostat.config import config
+    from morbidostat.pubsub import get_retained
+
+    monkeypatch.setitem(config["job_stats"], "profile_directory", str(tmp_path))
+    topic = f"morbidostat/{unit}/{exp}/profiled_job/$profile"
+    publish(topic, None, retain=True)
+
+    job = BackgroundJob(job_name="profiled_job", unit=unit, experiment=exp)
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    threading.Thread(target=busy_loop, name="busy thread", daemon=True).start()
+    publish(f"{topic}/set", 0.5)
+
+    # the profile is written to disk after it's published.
+    deadline = time.time() + 10
+    while not list(tmp_path.glob("*.collapsed")):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    stop.set()
+    pause()
+
+    collapsed = get_retained(topic)[topic].decode()
+    busy = [line for line in collapsed.splitlines() if line.startswith("busy_thread;")]
+    assert busy and all("busy_loop (test_background_job.py:" in line for line in busy)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.splitlines())
+    (written,) = tmp_path.glob("*.collapsed")
+    assert written.read_text().strip() == collapsed
+
+    job.set_state("disconnected")
+
+
+def test_async_job_runs_its_listeners_and_periodic_tasks_on_the_loop():
+    import asyncio
+    import threading
+    import time
+    from morbidostat.background_jobs import AsyncBackgroundJob, _async_jobs
+    from morbidostat.pubsub import subscribe_and_callback
+
+    class AsyncJob(AsyncBackgroundJob):
+        editable_settings = ["volume"]
+
+        def __init__(self, **kwargs):
+            self.threads, self.ticks = set(), []
+            super(AsyncJob, self).__init__(job_name="async_job", unit=unit, experiment=exp, **kwargs)
+            self.volume = 1.0
+            self.subscribe_and_callback(self.on_message, f"morbidostat/{unit}/{exp}/async_job_messages")
+
+        async def on_message(self, message):
+            self.threads.add(threading.current_thread())
+            await asyncio.sleep(0)
+            self.volume = float(message.payload)
+
+        def tick(self, counter=None):
+            self.threads.add(threading.current_thread())
+            self.ticks.append(counter)
+            if len(self.ticks) == 2:
+                raise ValueError("a bad tick")
+
+    errors = []
+    subscribe_and_callback(lambda message: errors.append(message.payload), f"morbidostat/{unit}/{exp}/error_log")
+
+    async def main():
+        # created in a thread of the loop's executor, which is where its blocking start up runs.
+        job = await AsyncJob.create()
+        assert job.loop is asyncio.get_running_loop()
+        job.every(0.05, job.tick)
+        publish(f"morbidostat/{unit}/{exp}/async_job_messages", 2.5)
+        await asyncio.sleep(0.3)
+
+        publish(f"morbidostat/{unit}/{exp}/async_job/$state/set", "sleeping")
+        await asyncio.sleep(0.2)
+        ticks_while_ready = len(job.ticks)
+        await asyncio.sleep(0.2)
+        assert len(job.ticks) == ticks_while_ready
+
+        publish(f"morbidostat/{unit}/{exp}/async_job/$state/set", "disconnected")
+        await asyncio.wait_for(job.run_forever(), 5)
+        # the loop's last job: it's forgotten.
+        assert asyncio.get_running_loop() not in _async_jobs
+        return job
+
+    job = asyncio.run(main())
+    pause()
+    assert job.threads == {threading.main_thread()}
+    assert job.volume == 2.5
+    # a failing tick is logged, and the task carries on
+    assert len(job.ticks) > 2 and job.ticks == list(range(1, len(job.ticks) + 1))
+    assert any(b"a bad tick" in e for e in errors)
+    assert job.stats.snapshot()["callbacks"]["on_message"]["count"] == 1
+
+
+def test_async_periodic_tasks_keep_the_schedulers_schedule_on_a_virtual_clock():
+    import asyncio
+    from morbidostat.background_jobs import AsyncBackgroundJob
+    from morbidostat.utils.timing import VirtualClock
+
+    clock = VirtualClock()
+    starts = []
+
+    class AsyncJob(AsyncBackgroundJob):
+        def slow(self, counter=None):
+            starts.append((counter, clock.now()))
+            if counter == 2:
+                # as test_timing's: the run due at 2 is skipped, and the one due at 3 starts 0.5s late
+                clock.advance(2.5)
+            if counter == 5:
+                self.set_state(self.DISCONNECTED)
+
+    async def main():
+        job = AsyncJob(job_name="async_virtual_clock_job", unit=unit, experiment=exp)
+        job.every(1.0, job.slow, clock=clock)
+        await asyncio.wait_for(job.run_forever(), 5)
+        return job
+
+    job = asyncio.run(main())
+    assert starts == [(1, 0.0), (2, 1.0), (3, 3.5), (4, 4.0), (5, 5.0)]
+    task_stats = job.stats.snapshot()["tasks"]["slow"]
+    assert task_stats["skipped"] == 1 and task_stats["overruns"] == 1
+    assert task_stats["jitter_max_ms"] == pytest.approx(500)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+import pytest
+
+from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from morbidostat.background_jobs.leader_jobs.fleet_growth_rate_calculating import FleetGrowthRateCalculator
+from morbidostat.pubsub import publish, settle, subscribe_and_callback
+from morbidostat.utils.streaming_calculations import ExtendedKalmanFilter
+from morbidostat.whoami import unit
+
+# its own experiment, so the calculator doesn't pick up other tests' units.
+experiment = "test_fleet_growth_rate_calculating"
+
+
+def readings(od, angles=("135/A", "90/A")):
+    return json.dumps({angle: od * (i + 1) for (i, angle) in enumerate(angles)})
+
+
+def test_units_are_updated_together_as_separate_filters():
+    units = [f"{unit}_{i}" for i in range(3)]
+    publish(f"morbidostat/{units[0]}/{experiment}/od_normalization/median", '{"135/A": 0.5, "90/A": 1.0}', retain=True)
+    publish(f"morbidostat/{units[0]}/{experiment}/od_normalization/variance", '{"135/A": 1e-4, "90/A": 1e-4}', retain=True)
+    publish(f"morbidostat/{units[1]}/{experiment}/growth_rate", 0.2, retain=True)
+    # the retained readings are the filters' initial states.
+    for name in units:
+        publish(f"morbidostat/{name}/{experiment}/od_raw_batched", readings(0.5), retain=True)
+    publish(f"morbidostat/{units[2]}/{experiment}/od_raw_batched", readings(0.5, ["135/A", "90/A", "45/A"]), retain=True)
+    settle()
+
+    growth_rates = {}
+    subscribe_and_callback(
+        lambda message: growth_rates.update({message.topic.split("/")[1]: float(message.payload)}),
+        f"morbidostat/+/{experiment}/growth_rate",
+    ).subscribed.wait(5)
+
+    calc = FleetGrowthRateCalculator(unit=unit, experiment=experiment)
+    settle()
+    calc.update_pending()
+    assert sorted(calc.units) == units
+    assert len(calc.banks[2]) == 2 and len(calc.banks[3]) == 1
+
+    # the same, one filter per unit
+    median, variance = {"135/A": 0.5, "90/A": 1.0}, {"135/A": 1e-4, "90/A": 1e-4}
+    initial_state = np.array([1.0, 1.0, calc.exp_rate_to_multiplicative_rate(0.0)])
+    angles = list(GrowthRateCalculator.sorted_observations(median))
+    reference = ExtendedKalmanFilter(initial_state, *GrowthRateCalculator.create_covariances(angles, median, variance))
+
+    for t in range(1, 30):
+        for name in units[:2]:
+            publish(f"morbidostat/{name}/{experiment}/od_raw_batched", readings(0.5 * 1.01 ** t))
+        reference.update(np.array([0.5 * 1.01 ** t / 0.5, 2 * 0.5 * 1.01 ** t]))
+        if t == 9:
+            # applies from the next reading, though that's in the same batch.
+            publish(f"morbidostat/{units[0]}/{experiment}/io_events", '{"volume_change": 1.5, "event": "add_media"}')
+            reference.scale_OD_variance_for_next_n_steps(2e4, 2 * calc.samples_per_minute)
+        # a unit with several new readings gets them in order.
+        if t % 2 == 0:
+            settle()
+            calc.update_pending()
+
+    settle()
+    calc.update_pending()
+    settle()
+    assert calc.units[units[0]].bank.state(units[0]) == pytest.approx(reference.state_, rel=1e-9)
+    # (throttled, so not necessarily the latest)
+    assert growth_rates[units[0]] > 0 and growth_rates[units[1]] > 0 and units[2] not in growth_rates
+    calc.set_state(calc.DISCONNECTED)
+
+
+def test_units_leave_and_rejoin():
+    experiment = "test_fleet_units_leave_and_rejoin"
+    units = [f"{unit}_leaving", f"{unit}_staying"]
+    calc = FleetGrowthRateCalculator(unit=unit, experiment=experiment)
+    for name in units:
+        publish(f"morbidostat/{name}/{experiment}/od_raw_batched", readings(0.5))
+    settle()
+    calc.update_pending()
+    assert sorted(calc.units) == units
+
+    publish(f"morbidostat/{units[0]}/{experiment}/od_reading/$state", "lost")
+    settle()
+    assert list(calc.units) == [units[1]] and calc.banks[2].keys == [units[1]]
+
+    # a new channel: the unit starts again, from that reading.
+    publish(f"morbidostat/{units[1]}/{experiment}/od_raw_batched", readings(0.6, ["135/A", "90/A", "90/B"]))
+    settle()
+    calc.update_pending()
+    assert units[1] not in calc.units
+    calc.update_pending()
+    assert calc.units[units[1]].angles == ["90/B", "90/A", "135/A"] and len(calc.banks[2]) == 0
+
+    publish(f"morbidostat/{units[1]}/{experiment}/od_raw_batched", readings(0.6, ["135/A", "90/A", "90/B"]))
+    publish(f"morbidostat/{units[0]}/{experiment}/od_raw_batched", readings(0.5))
+    settle()
+    calc.update_pending()
+    assert sorted(calc.units) == units and len(calc.banks[3]) == 1
+    calc.set_state(calc.DISCONNECTED)
+
+
+def test_a_unit_whose_filter_fails_is_reset_and_the_others_carry_on():
+    experiment = "test_fleet_a_unit_whose_filter_fails"
+    units = [f"{unit}_failing", f"{unit}_healthy"]
+    errors = []
+    subscribe_and_callback(
+        lambda message: errors.append(message.topic.split("/")[1]), f"morbidostat/+/{experiment}/error_log"
+    ).subscribed.wait(5)
+
+    calc = FleetGrowthRateCalculator(unit=unit, experiment=experiment)
+    for name in units:
+        publish(f"morbidostat/{name}/{experiment}/od_raw_batched", readings(0.5))
+    settle()
+    calc.update_pending()
+    bank = calc.banks[2]
+    healthy_state = bank.state(units[1])
+
+    # a singular covariance: the batch's solve raises LinAlgError.
+    failing = bank._rows[units[0]]
+    for array in (bank._covariances, bank._process_noise, bank._observation_noise):
+        array[failing] = 0.0
+    for name in units:
+        publish(f"morbidostat/{name}/{experiment}/od_raw_batched", readings(0.51))
+    settle()
+    calc.update_pending()
+    settle()
+    assert errors == [units[0]]
+    assert list(calc.units) == [units[1]] and not (bank.state(units[1]) == healthy_state).all()
+
+    # it rejoins from its next reading.
+    publish(f"morbidostat/{units[0]}/{experiment}/od_raw_batched", readings(0.52))
+    settle()
+    calc.update_pending()
+    assert sorted(calc.units) == units
+    calc.set_state(calc.DISCONNECTED)
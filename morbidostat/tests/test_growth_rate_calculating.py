@@ -1,17 +1,16 @@
 # -*- coding: utf-8 -*-
 import pytest
 import json
-import time
 import numpy as np
 
 from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
-from morbidostat.pubsub import subscribe, publish
+from morbidostat.pubsub import subscribe, publish, settle
 from morbidostat.whoami import unit, experiment
 
 
 def pause():
-    # to avoid race conditions when updating state
-    time.sleep(0.5)
+    # wait until everything published so far has been handled
+    settle()
 
 
 def test_subscribing(monkeypatch):
@@ -20,6 +19,8 @@ def test_subscribing(monkeypatch):
     publish(f"morbidostat/{unit}/{experiment}/growth_rate", None, retain=True)
 
     publish(f"morbidostat/{unit}/{experiment}/growth_rate", 1.0, retain=True)
+    # the calculator starts from the latest (retained) reading
+    publish(f"morbidostat/{unit}/{experiment}/od_raw_batched", '{"135/A": 0.778586260567034, "90/A": 0.20944389172032837}', retain=True)
     calc = GrowthRateCalculator(unit=unit, experiment=experiment)
     pause()
     assert calc.initial_growth_rate == 1.0
@@ -138,3 +139,18 @@ def test_scaling_works():
     pause()
     assert calc.od_normalization_factors == {"90/A": 0.8, "135/A": 0.5}
     assert ((calc.ekf.observation_noise_covariance - 5 * np.array([[1e-4 / 0.8 ** 2, 0], [0, 1e-6 / 0.5 ** 2]])) < 1e-7).all()
+
+
+def test_gain_changes_are_treated_like_io_events():
+    publish(f"morbidostat/{unit}/{experiment}/od_raw_batched", '{"135/A": 0.778586260567034, "90/A": 0.20944389172032837}', retain=True)
+    calc = GrowthRateCalculator(unit=unit, experiment=experiment)
+    pause()
+    assert calc.ekf._OD_scale_counter < 0
+
+    publish(
+        f"morbidostat/{unit}/{experiment}/od_gain_events",
+        json.dumps({"event": "gain_change", "channel": "135/A", "previous_gain": 8, "gain": 4, "signal": 0.47}),
+    )
+    pause()
+    assert calc.ekf._OD_scale_counter == 2 * calc.samples_per_minute
+    calc.set_state(calc.DISCONNECTED)
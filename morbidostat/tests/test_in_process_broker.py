@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# test_in_process_broker
+import queue
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from morbidostat.utils.in_process_broker import Broker
+
+
+@pytest.fixture
+def broker():
+    broker = Broker().start()
+    yield broker
+    broker.stop()
+
+
+def connect(broker, protocol=mqtt.MQTTv311, will=None):
+    messages = queue.Queue()
+    client = mqtt.Client(protocol=protocol)
+    client.on_message = lambda client, userdata, message: messages.put(message)
+    if will is not None:
+        client.will_set(*will)
+    client.connect("127.0.0.1", broker.port)
+    client.loop_start()
+    return client, messages
+
+
+@pytest.mark.parametrize("protocol", [mqtt.MQTTv311, mqtt.MQTTv5])
+def test_retained_and_wildcards(broker, protocol):
+    publisher, _ = connect(broker, protocol)
+    publisher.publish("morbidostat/1/exp/growth_rate", 0.5, qos=1, retain=True).wait_for_publish()
+    publisher.publish("morbidostat/2/exp/growth_rate", 0.6, qos=1).wait_for_publish()
+
+    subscriber, messages = connect(broker, protocol)
+    subscriber.subscribe("morbidostat/+/exp/#", qos=1)
+    message = messages.get(timeout=2)
+    assert (message.topic, message.payload, message.retain) == ("morbidostat/1/exp/growth_rate", b"0.5", True)
+
+    topic = "morbidostat/2/exp/od_filtered/135/A"
+    publisher.publish(topic, 1.1, qos=2)
+    message = messages.get(timeout=2)
+    # the subscription's QoS 1 caps the delivery
+    assert (message.topic, message.payload, message.qos, message.retain) == (topic, b"1.1", 1, False)
+
+    # an empty retained message clears the retained value
+    publisher.publish("morbidostat/1/exp/growth_rate", None, qos=1, retain=True).wait_for_publish()
+    assert broker.retained == {}
+
+
+def test_overlapping_subscriptions_get_one_copy(broker):
+    client, messages = connect(broker)
+    client.subscribe([("morbidostat/#", 0), ("morbidostat/1/+/log", 2)])
+    client.publish("morbidostat/1/exp/log", "hi", qos=2)
+    message = messages.get(timeout=2)
+    assert (message.payload, message.qos) == (b"hi", 2)
+    with pytest.raises(queue.Empty):
+        messages.get(timeout=0.2)
+
+
+def test_last_will_is_sent_only_if_connection_is_lost(broker):
+    listener, messages = connect(broker)
+    listener.subscribe("morbidostat/1/exp/job/$state")
+    listener.publish("sync", None).wait_for_publish()
+
+    graceful, _ = connect(broker, will=("morbidostat/1/exp/job/$state", "lost", 2, True))
+    graceful.disconnect()
+
+    lost, _ = connect(broker, will=("morbidostat/1/exp/job/$state", "lost", 2, True))
+    lost.loop_stop()
+    lost.socket().close()
+
+    message = messages.get(timeout=2)
+    assert (message.topic, message.payload) == ("morbidostat/1/exp/job/$state", b"lost")
+    assert broker.retained["morbidostat/1/exp/job/$state"].payload == b"lost"
+    with pytest.raises(queue.Empty):
+        messages.get(timeout=0.2)
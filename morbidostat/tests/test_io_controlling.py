@@ -10,8 +10,8 @@ from morbidostat import pubsub
 
 
 def pause():
-    # to avoid race conditions when updating state
-    time.sleep(0.5)
+    # wait until everything published so far has been handled
+    pubsub.settle()
 
 
 def test_silent_algorithm():
@@ -297,3 +297,11 @@ def test_execute_io_action():
     pause()
     assert ca.throughput_calculator.media_throughput == 1.80
     assert ca.throughput_calculator.alt_media_throughput == 1.50
+
+
+def test_the_pid_log_is_still_throttled_after_moving_to_another_experiment():
+    algo = PIDTurbidostat(volume=0.5, target_od=1.0, duration=60, unit=unit, experiment=experiment)
+    algo.set_experiment("_another_pid_experiment")
+    assert algo.pid.experiment == "_another_pid_experiment"
+    assert pubsub.publish_policies._policy_for(f"morbidostat/{unit}/_another_pid_experiment/pid_log") is not None
+    algo.set_state("disconnected")
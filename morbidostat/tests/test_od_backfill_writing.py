@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+import pytest
+
+from morbidostat.actions.od_backfill import od_backfill
+from morbidostat.actions.replay_growth_rates import parse_timestamps
+from morbidostat.background_jobs.leader_jobs.od_backfill_writing import ODBackfillWriter, iso
+from morbidostat.pubsub import settle
+from morbidostat.utils.ring_buffer import ReadingRingBuffer
+from morbidostat.whoami import unit
+
+CREATE_TABLES = os.path.join(os.path.dirname(__file__), "..", "..", "sql", "create_tables.sql")
+
+# its own experiment, so other tests' backfills aren't written.
+experiment = "test_od_backfill_writing"
+
+
+def test_backfilled_readings_the_leader_missed_are_written(tmp_path):
+    database = str(tmp_path / "observations.sqlite")
+    connection = sqlite3.connect(database)
+    with connection:
+        connection.executescript(open(CREATE_TABLES).read())
+        # the leader got the second reading of 135/A, a little after the worker took it.
+        connection.execute(
+            "INSERT INTO od_readings_raw (timestamp, morbidostat_unit, od_reading_v, experiment, angle) VALUES (?, ?, ?, ?, ?)",
+            (iso(1612345683.3), unit, 0.5, experiment, "135A"),
+        )
+    connection.close()
+
+    path = str(tmp_path / "od.ring")
+    buffer = ReadingRingBuffer.create(path, ["135/A", "90/A"], capacity=16)
+    for i in range(5):
+        buffer.append(1612345678.0 + 5 * i, [0.1 * i, 0.2 * i])
+
+    writer = ODBackfillWriter(database=database, unit=unit, experiment=experiment)
+    settle()
+    assert od_backfill(1612345678.0, chunk_size=2, experiment=experiment, path=path) == 5
+    settle()
+    writer.set_state(writer.DISCONNECTED)
+
+    connection = sqlite3.connect(database)
+    rows = connection.execute(
+        "SELECT angle, timestamp, od_reading_v FROM od_readings_raw WHERE experiment = ? ORDER BY angle, timestamp", (experiment,)
+    ).fetchall()
+    connection.close()
+
+    by_angle = {angle: [(t, v) for (a, t, v) in rows if a == angle] for angle in ("135A", "90A")}
+    assert len(by_angle["135A"]) == 5 and len(by_angle["90A"]) == 5
+    assert [v for (_, v) in by_angle["135A"]] == pytest.approx([0.0, 0.5, 0.2, 0.3, 0.4])
+    assert parse_timestamps([t for (t, _) in by_angle["90A"]]).tolist() == pytest.approx(
+        [1612345678.0 + 5 * i for i in range(5)], abs=1e-3
+    )
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import statistics
+import threading
+import time
+
+import pytest
+
+from morbidostat.background_jobs.od_reading import AutoGain, ODReader, reduce_burst, trimmed_mean
+from morbidostat.pubsub import settle, subscribe_and_callback
+from morbidostat.utils.streaming_calculations import MovingStats
+from morbidostat.utils.adc_scanner import InterleavedScanner, parse_channel
+from morbidostat.utils.simulated_ads1115 import SimulatedADS1115
+from morbidostat.whoami import unit, experiment
+
+
+def test_single_conversion_has_no_dispersion():
+    assert reduce_burst([0.5], "median") == (0.5, None)
+
+
+def test_burst_reductions_are_robust_to_an_outlier():
+    burst = [0.50, 0.51, 0.49, 0.50, 0.52, 0.48, 0.50, 2.0]
+
+    mean, std = reduce_burst(burst, "mean")
+    assert mean == pytest.approx(0.6875)
+
+    for reduction in ["median", "trimmed_mean"]:
+        value, dispersion = reduce_burst(burst, reduction)
+        assert value == pytest.approx(0.50, abs=0.005)
+        assert dispersion < std / 10
+
+    assert trimmed_mean([1, 2, 3, 4, 100, -100, 2.5, 3.5]) == pytest.approx(2.75)
+
+    with pytest.raises(KeyError):
+        reduce_burst(burst, "mode")
+
+
+def test_channels_are_addressed_by_i2c_address_and_input():
+    assert parse_channel("2") == (0x48, 2)
+    assert parse_channel("0x49:3") == (0x49, 3)
+    assert parse_channel((0x4A, 1)) == (0x4A, 1)
+
+
+def test_scanning_several_adcs_overlaps_their_conversions():
+    bus = threading.Lock()
+    adcs = {
+        address: SimulatedADS1115({pin: 0.1 * pin + (address - 0x48) for pin in range(4)}, gain=1, bus=bus)
+        for address in [0x48, 0x49, 0x4A]
+    }
+    channels = {f"{address}/{pin}": (address, pin) for address in adcs for pin in range(4)}
+    scanner = InterleavedScanner(adcs, channels)
+
+    start = time.perf_counter()
+    voltages = scanner.scan(conversions=2)
+    elapsed = time.perf_counter() - start
+
+    for (label, (address, pin)) in channels.items():
+        assert voltages[label] == pytest.approx([0.1 * pin + (address - 0x48)] * 2, abs=1e-3)
+    # 12 channels x 2 conversions at 128/s: 8 rounds of overlapped conversions, not 24 conversions back to back.
+    assert elapsed < 16 / 128
+
+    with pytest.raises(ValueError):
+        InterleavedScanner(adcs, {"135/A": (0x4B, 0)})
+
+
+def test_a_conversion_that_never_finishes_raises_instead_of_spinning():
+    class StuckADS1115(SimulatedADS1115):
+        polls = 0
+
+        def conversion_done(self):
+            StuckADS1115.polls += 1
+            return False
+
+    adc = StuckADS1115({0: 0.5}, gain=1)
+    scanner = InterleavedScanner({0x48: adc}, {"135/A": (0x48, 0)})
+
+    start = time.perf_counter()
+    with pytest.raises(OSError, match="0x48"):
+        scanner.scan()
+    # a few conversion periods (7.8ms at 128/s), polled with sleeps in between.
+    assert time.perf_counter() - start < 0.1
+    assert StuckADS1115.polls < 100
+
+
+def test_each_channel_sets_its_own_gain_and_publishes_changes():
+    events = []
+    subscribe_and_callback(
+        lambda message: events.append(json.loads(message.payload)), f"morbidostat/{unit}/{experiment}/od_gain_events"
+    )
+
+    # a bright and a dim channel on one ADC, and a dim one on another.
+    adc, other_adc = SimulatedADS1115({0: 1.5, 1: 0.1}, data_rate=860), SimulatedADS1115({0: 0.3}, data_rate=860, address=0x49)
+    reader = ODReader(
+        [("135/A", "0"), ("90/A", "1"), ("90/B", "0x49:0")], {0x48: adc, 0x49: other_adc}, unit=unit, experiment=experiment
+    )
+
+    for counter in range(25):
+        reader.take_reading(counter)
+    settle()
+    assert reader.scanner.gains == {"135/A": 2, "90/A": 16, "90/B": 8}
+
+    # the saturated channel came down at once, one event per change
+    changes = [(e["previous_gain"], e["gain"]) for e in events if e["channel"] == "135/A"]
+    assert changes == [(8, 4), (4, 2)]
+    assert all(e["event"] == "gain_change" for e in events)
+
+    # readings at the new gains are still in volts
+    readings = reader.take_reading(25)
+    assert readings["135/A"] == pytest.approx(1.5, abs=1e-3)
+    assert readings["90/A"] == pytest.approx(0.1, abs=1e-3)
+    reader.set_state(reader.DISCONNECTED)
+
+
+def test_auto_gain_has_hysteresis():
+    auto_gain = AutoGain(gain=4, lookback=5)
+    # 0.8V is over 0.7 of gain 2's full scale (2.048V), so it stays at 4 (1.024V)
+    assert all(auto_gain.update(0.8) is None for _ in range(10))
+
+    # past 0.9 of the full scale, it goes down at once
+    assert auto_gain.update(0.95) == 2
+
+    # and back up only once the window's max is under 0.7 of gain 4's full scale
+    assert all(auto_gain.update(0.8) is None for _ in range(10))
+    for _ in range(4):
+        assert auto_gain.update(0.7) is None
+    assert auto_gain.update(0.7) == 4
+
+
+def test_moving_stats_match_a_recomputation():
+    values = [random.gauss(1000, 1) for _ in range(200)]
+    stats = MovingStats(lookback=20)
+    for (i, value) in enumerate(values):
+        stats.update(value)
+        if i < 19:
+            assert stats.mean is None and stats.max is None
+            continue
+        window = values[i - 19 : i + 1]
+        assert stats.mean == pytest.approx(statistics.mean(window))
+        assert stats.std == pytest.approx(statistics.stdev(window))
+        assert (stats.max, stats.min) == (max(window), min(window))
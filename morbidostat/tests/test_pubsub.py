@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# test_pubsub
+import pytest
+
+from morbidostat.pubsub import TopicTrie, PublishPolicies, PublishPolicy
+
+
+def test_topic_trie_wildcards():
+    trie = TopicTrie()
+    for topic_filter in ["a/b", "a/+", "a/#", "#", "+/b", "a/b/c", "$SYS/#"]:
+        trie.insert(topic_filter, topic_filter)
+
+    assert sorted(trie.match("a/b")) == ["#", "+/b", "a/#", "a/+", "a/b"]
+    assert sorted(trie.match("a")) == ["#", "a/#"]
+    assert sorted(trie.match("a/b/c")) == ["#", "a/#", "a/b/c"]
+    assert sorted(trie.match("b/c")) == ["#"]
+
+
+def test_topic_trie_wildcards_dont_match_dollar_topics():
+    trie = TopicTrie()
+    trie.insert("#", "#")
+    trie.insert("+/broker", "+/broker")
+    trie.insert("$SYS/#", "$SYS/#")
+
+    assert list(trie.match("$SYS/broker")) == ["$SYS/#"]
+
+
+def test_topic_trie_remove_prunes_branches():
+    trie = TopicTrie()
+    trie.insert("morbidostat/1/exp/od_raw_batched", 1)
+    trie.insert("morbidostat/1/exp/+/set", 2)
+
+    trie.remove("morbidostat/1/exp/od_raw_batched", 1)
+    assert list(trie.match("morbidostat/1/exp/od_raw_batched")) == []
+    assert list(trie.match("morbidostat/1/exp/job/set")) == [2]
+
+    trie.remove("morbidostat/1/exp/+/set", 2)
+    assert trie._root.children == {}
+
+
+def test_publish_policy_coalesces_to_latest_value():
+    policies = PublishPolicies()
+    policies.set("morbidostat/1/exp/od_filtered/#", PublishPolicy(max_rate=10))
+    topic = "morbidostat/1/exp/od_filtered/135/A"
+
+    assert policies.allow("localhost", "morbidostat/1/exp/growth_rate", 1.0, {})
+    assert policies.allow("localhost", topic, 1.0, {})
+    assert not policies.allow("localhost", topic, 2.0, {})
+    assert not policies.allow("localhost", topic, 3.0, {})
+    assert policies._states[("localhost", topic)].held == (3.0, None, {})
+    policies._states[("localhost", topic)].timer.cancel()
+
+    assert policies.stats[topic] == {"forwarded": 1, "suppressed": 1}
+
+
+def test_publish_policy_deadband():
+    policies = PublishPolicies()
+    policies.set("morbidostat/1/exp/growth_rate", PublishPolicy(deadband=0.01))
+    topic = "morbidostat/1/exp/growth_rate"
+
+    assert policies.allow("localhost", topic, 0.5, {})
+    assert not policies.allow("localhost", topic, "0.505", {})
+    assert policies.allow("localhost", topic, 0.52, {})
+    assert policies.stats[topic] == {"forwarded": 2, "suppressed": 1}
+
+
+def test_retained_messages_dump_prune_and_restore(tmp_path):
+    from morbidostat.pubsub import publish, get_retained, settle
+    from morbidostat.actions.retained_messages import dump, prune, restore
+
+    topics = [f"morbidostat/_testing/retained_{i}/$properties" for i in range(50)]
+    for i, topic in enumerate(topics):
+        publish(topic, f"value_{i}", retain=True, hostname="localhost")
+    publish("morbidostat/_testing_other/kept", "kept", retain=True, hostname="localhost")
+    settle("localhost")
+
+    snapshot = tmp_path / "retained.snapshot"
+    assert dump("morbidostat/_testing/#", str(snapshot), hostname="localhost") == 50
+
+    assert prune("morbidostat/_testing/#", hostname="localhost", batch_size=8) == 50
+    assert get_retained(topics[:3], hostname="localhost") == {topic: None for topic in topics[:3]}
+    assert get_retained("morbidostat/_testing_other/kept", hostname="localhost")["morbidostat/_testing_other/kept"] == b"kept"
+
+    assert restore(str(snapshot), hostname="localhost", batch_size=8) == 50
+    assert get_retained(topics[7], hostname="localhost") == {topics[7]: b"value_7"}
+
+    prune(["morbidostat/_testing/#", "morbidostat/_testing_other/#"], hostname="localhost")
+
+
+def test_a_failing_callback_is_logged_without_looking_up_the_experiment(monkeypatch):
+    import threading
+    from morbidostat import whoami
+    from morbidostat.pubsub import publish, subscribe_and_callback
+
+    def get(*args, **kwargs):
+        raise AssertionError("looked up the experiment on the network thread")
+
+    # as outside of tests, where a lookup can wait on the leader
+    monkeypatch.setattr(whoami, "is_testing", lambda: False)
+    monkeypatch.setattr(whoami.LatestExperiment, "get", get)
+    errors = []
+    logged = threading.Event()
+    error_topic = f"morbidostat/{whoami.unit}/{whoami.latest_experiment.value}/error_log"
+    subscribe_and_callback(lambda message: (errors.append(message.payload), logged.set()), error_topic).subscribed.wait(5)
+
+    def fail(message):
+        raise ValueError("bad message")
+
+    subscribe_and_callback(fail, "morbidostat/_testing/failing_callback").subscribed.wait(5)
+    publish("morbidostat/_testing/failing_callback", "1")
+    assert logged.wait(5)
+    assert errors == [b"bad message"]
+
+
+def create_publish_client(hostname, monkeypatch, tmp_path, **kwargs):
+    from morbidostat import pubsub
+    from morbidostat.config import config
+
+    monkeypatch.setitem(config["pubsub"], "spool_directory", str(tmp_path))
+    client = pubsub.PublishClient(hostname, **kwargs)
+    assert client._connected.wait(5)
+    return client
+
+
+def test_publishing_doesnt_wait_on_the_sender(monkeypatch, tmp_path):
+    import threading
+
+    client = create_publish_client("slow_sender", monkeypatch, tmp_path)
+    sending, release = threading.Event(), threading.Event()
+    send = client._send
+
+    def slow_send(record, properties=None):
+        # ex: paho blocked on a full socket, or the disk
+        sending.set()
+        release.wait(5)
+        return send(record, properties)
+
+    client._send = slow_send
+    client.publish("morbidostat/test/slow_sender", 1)
+    assert sending.wait(5)
+
+    publisher = threading.Thread(target=client.publish, args=("morbidostat/test/slow_sender", 2), daemon=True)
+    publisher.start()
+    publisher.join(1)
+    assert not publisher.is_alive()
+    # the message being sent counts as pending
+    assert client.pending() == 2
+
+    release.set()
+    assert client.flush()
+    client.disconnect()
+
+
+def test_messages_published_while_disconnected_are_spooled_and_replayed_in_order(monkeypatch, tmp_path):
+    from morbidostat.pubsub import subscribe_and_callback, settle
+
+    topic = "morbidostat/test/spooled"
+    received = []
+    subscribe_and_callback(lambda message: received.append(int(message.payload)), topic)
+    settle()
+
+    client = create_publish_client("spooled", monkeypatch, tmp_path, max_queue_size=5)
+    client._connected.clear()
+    for i in range(12):
+        client.publish(topic, i)
+    client.publish_many([(topic, i, 1, False) for i in range(12, 20)])
+    assert not client.flush(0.2)
+    assert client._spool.has_pending()
+
+    # back online
+    client._connected.set()
+    with client._condition:
+        client._condition.notify()
+    assert client.flush()
+    client.disconnect()
+    settle()
+    assert received == list(range(20))
+
+
+def test_the_spools_of_dead_processes_are_adopted_and_replayed(monkeypatch, tmp_path):
+    import os
+    import subprocess
+    import sys
+    import time
+    from morbidostat.pubsub import subscribe_and_callback, settle
+    from morbidostat.utils.segment_log import SegmentLog, PublishRecord
+
+    topic = "morbidostat/test/orphaned"
+    received = []
+    subscribe_and_callback(lambda message: received.append(int(message.payload)), topic)
+    settle()
+
+    # left by processes that had to take `<name>-<pid>`: one died, the other is still running.
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    orphaned = SegmentLog(str(tmp_path / "orphaned" / f"od_reading-{dead.pid}"))
+    orphaned.extend(PublishRecord(time.time(), topic, i, 1, False) for i in range(5))
+    orphaned.close()
+    live = SegmentLog(str(tmp_path / "orphaned" / f"od_reading-{os.getpid()}"))
+    live.append(PublishRecord(time.time(), topic, 5, 1, False))
+    live.close()
+
+    client = create_publish_client("orphaned", monkeypatch, tmp_path)
+    assert client.flush()
+    client.disconnect()
+    settle()
+    assert received == list(range(5))
+    assert not (tmp_path / "orphaned" / f"od_reading-{dead.pid}").exists()
+    assert (tmp_path / "orphaned" / f"od_reading-{os.getpid()}").exists()
+
+
+def test_the_default_protocol_is_the_configs():
+    import paho.mqtt.client as mqtt
+    from morbidostat.pubsub import MQTT_PROTOCOL
+
+    assert MQTT_PROTOCOL == mqtt.MQTTv5
+
+
+@pytest.mark.parametrize("protocol", ["3.1.1", "5"])
+def test_replayed_messages_keep_their_time_with_mqtt_5(protocol, monkeypatch, tmp_path):
+    import queue
+    import time
+    import paho.mqtt.client as mqtt
+    from morbidostat.pubsub import MQTT_PROTOCOLS, broker_address
+
+    topic = f"morbidostat/test/replayed_{protocol}"
+    messages = queue.Queue()
+    subscriber = mqtt.Client(protocol=mqtt.MQTTv5)
+    subscriber.on_message = lambda client, userdata, message: messages.put(message)
+    subscriber.connect(*broker_address("localhost"))
+    subscriber.loop_start()
+    subscriber.subscribe(topic, qos=1)
+    time.sleep(0.2)
+
+    client = create_publish_client(f"replayed_{protocol}", monkeypatch, tmp_path, protocol=MQTT_PROTOCOLS[protocol])
+    client.publish(topic, "live")
+    assert client.flush()
+    client._connected.clear()
+    published_at = time.time()
+    client.publish(topic, "replayed", qos=1)
+    time.sleep(0.1)
+    client._connected.set()
+    with client._condition:
+        client._condition.notify()
+    assert client.flush()
+
+    live, replayed = messages.get(timeout=5), messages.get(timeout=5)
+    client.disconnect()
+    subscriber.disconnect()
+    subscriber.loop_stop()
+
+    assert (live.payload, replayed.payload) == (b"live", b"replayed")
+    assert not getattr(live.properties, "UserProperty", None)
+    if protocol == "5":
+        ((name, value),) = replayed.properties.UserProperty
+        assert name == "timestamp" and float(value) == pytest.approx(published_at, abs=0.05)
+    else:
+        assert not getattr(replayed.properties, "UserProperty", None)
+
+
+def test_get_retained_fetches_several_topics_at_once():
+    import time
+    from morbidostat.pubsub import publish, get_retained, settle
+
+    prefix = "morbidostat/test/get_retained"
+    publish(f"{prefix}/a", "1", retain=True)
+    publish(f"{prefix}/b", "2", retain=True)
+    publish(f"{prefix}/not_retained", "3")
+    publish(f"{prefix}/cleared", "4", retain=True)
+    publish(f"{prefix}/cleared", None, retain=True)
+    settle()
+
+    start = time.time()
+    retained = get_retained([f"{prefix}/a", f"{prefix}/b", f"{prefix}/not_retained", f"{prefix}/cleared", f"{prefix}/never"])
+    # the barrier ends the wait, not the timeout
+    assert time.time() - start < 1.0
+    assert retained == {
+        f"{prefix}/a": b"1",
+        f"{prefix}/b": b"2",
+        f"{prefix}/not_retained": None,
+        f"{prefix}/cleared": None,
+        f"{prefix}/never": None,
+    }
+
+    # wildcards return what they match
+    assert get_retained(f"{prefix}/+") == {f"{prefix}/a": b"1", f"{prefix}/b": b"2"}
+
+
+def test_get_retained_never_reads_back_a_value_older_than_one_just_published():
+    from morbidostat.pubsub import publish, get_retained
+
+    topic = "morbidostat/test/get_retained_ordering"
+    for i in range(20):
+        publish(topic, i, retain=True)
+        assert get_retained(topic)[topic] == str(i).encode()
+
+
+def test_get_retained_returns_what_it_has_after_the_timeout(monkeypatch):
+    import time
+    from morbidostat import pubsub
+
+    topic = "morbidostat/test/get_retained_timeout"
+    pubsub.publish(topic, "kept", retain=True)
+    pubsub.settle()
+
+    # a hostname with a subscriber but no publisher, and a barrier that never comes back.
+    monkeypatch.setattr(pubsub.SubscribeClient, "publish_barrier", lambda self, topic: None)
+    start = time.time()
+    retained = pubsub.get_retained([topic, f"{topic}_not"], hostname="no_barrier", timeout=0.5)
+    assert 0.5 <= time.time() - start < 1.5
+    assert retained == {topic: b"kept", f"{topic}_not": None}
+
+    # and a broker that can't be reached
+    monkeypatch.setattr(pubsub, "broker_address", lambda hostname: ("127.0.0.1", 1))
+    start = time.time()
+    assert pubsub.get_retained(topic, hostname="unreachable", timeout=0.5) == {topic: None}
+    assert time.time() - start < 1.5
+    assert not pubsub.settle(hostname="unreachable", timeout=0.5)
+
+
+def test_settle_waits_for_what_callbacks_publish():
+    from morbidostat.pubsub import publish, settle, subscribe_and_callback
+
+    prefix = "morbidostat/test/settle"
+    received = []
+    # a chain of callbacks, each publishing the next message
+    subscribe_and_callback(lambda message: publish(f"{prefix}/b", message.payload), f"{prefix}/a")
+    subscribe_and_callback(lambda message: publish(f"{prefix}/c", message.payload), f"{prefix}/b")
+    subscribe_and_callback(lambda message: received.append(message.payload), f"{prefix}/c")
+    assert settle()
+
+    for i in range(5):
+        publish(f"{prefix}/a", i)
+    assert settle()
+    assert received == [str(i).encode() for i in range(5)]
+
+
+def test_settle_barriers_arent_counted_in_the_publish_counts():
+    from morbidostat.pubsub import get_publish_counts, settle
+
+    for _ in range(3):
+        assert settle()
+    assert not [topic for topic in get_publish_counts() if topic.startswith("morbidostat/_settle_barrier/")]
+
+
+def test_a_retained_value_that_changed_is_delivered_again():
+    # ex: morbidostat/latest_experiment, changed while the shared client was reconnecting: the client resubscribes,
+    # and the broker re-sends it as retained.
+    import paho.mqtt.client as mqtt
+    from morbidostat.pubsub import Subscription
+
+    received = []
+    subscription = Subscription(lambda message: received.append(message.payload), ["morbidostat/latest_experiment"])
+    for (payload, retain) in [(b"exp1", True), (b"exp1", True), (b"exp2", False), (b"exp2", True), (b"exp3", True)]:
+        message = mqtt.MQTTMessage(topic=b"morbidostat/latest_experiment")
+        message.payload, message.retain = payload, retain
+        subscription.deliver(message)
+
+    assert received == [b"exp1", b"exp2", b"exp3"]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from morbidostat.actions.replay_growth_rates import Recording, load_recordings, replay_growth_rates, rts_smooth, run_filter
+
+CREATE_TABLES = os.path.join(os.path.dirname(__file__), "..", "..", "sql", "create_tables.sql")
+
+
+def create_database(path, unit="1", experiment="trial", hours=24, growth_rate=0.05):
+    """
+    Readings every 5 seconds of a culture growing at `growth_rate` per hour, at two angles recorded a moment apart,
+    with one reading of 90A missing, and an io event every 6 hours.
+    """
+    rng = np.random.default_rng(0)
+    times = 1612345678.0 + 5.0 * np.arange(int(hours * 720))
+    od = 0.1 * np.exp(growth_rate * (times - times[0]) / 3600)
+
+    def iso(t):
+        return datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="milliseconds")
+
+    rows = []
+    for (angle, scale, lag) in [("135A", 1.0, 0.0), ("90A", 0.4, 0.3)]:
+        for (i, (t, value)) in enumerate(zip(times + lag, scale * od * (1 + rng.normal(0, 0.005, len(times))))):
+            if not (angle == "90A" and i == 100):
+                rows.append((iso(t), unit, float(value), experiment, angle))
+
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript(open(CREATE_TABLES).read())
+        connection.executemany(
+            "INSERT INTO od_readings_raw (timestamp, morbidostat_unit, od_reading_v, experiment, angle) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        connection.executemany(
+            "INSERT INTO io_events (timestamp, experiment, event, volume_change_ml, morbidostat_unit) VALUES (?, ?, ?, ?, ?)",
+            [(iso(times[0] + 3600 * h + 2), experiment, "add_media", 1.0, unit) for h in range(6, hours, 6)],
+        )
+    connection.close()
+    return times
+
+
+def test_readings_are_aligned_and_replayed(tmp_path):
+    database = str(tmp_path / "observations.sqlite")
+    times = create_database(database)
+
+    (recording,) = load_recordings("trial", database=database)
+    assert recording.angles == ["90A", "135A"]
+    # the readings without a 90A are skipped
+    assert recording.readings.shape == (len(times) - 1, 2)
+    assert recording.timestamps[99:101].tolist() == [times[99] + 0.3, times[101] + 0.3]
+    assert recording.readings[0] == pytest.approx([0.04, 0.1], rel=0.02)
+    assert recording.io_event_steps.tolist() == [6 * 720, 12 * 720, 18 * 720]
+
+    filtered = replay_growth_rates("trial", smooth=False, database=database)["1"]
+    smoothed = replay_growth_rates("trial", database=database)["1"]
+    # after the filter's initial transient, smoothing removes much of its lag and noise.
+    assert np.abs(smoothed[720:] - 0.05).mean() < 0.5 * np.abs(filtered[720:] - 0.05).mean()
+    assert smoothed[720:].mean() == pytest.approx(0.05, abs=0.01)
+
+    # and the smoothed series are written back, replacing earlier replays.
+    replay_growth_rates("trial", units=["1"], database=database)
+    connection = sqlite3.connect(database)
+    rates = connection.execute("SELECT rate FROM growth_rates_smoothed WHERE experiment = 'trial' ORDER BY timestamp").fetchall()
+    angles = connection.execute("SELECT angle, COUNT(*) FROM od_readings_smoothed GROUP BY angle ORDER BY angle").fetchall()
+    connection.close()
+    assert np.array(rates)[:, 0] == pytest.approx(smoothed)
+    assert angles == [("135A", len(times) - 1), ("90A", len(times) - 1)]
+
+
+def test_the_smoother_matches_the_sequential_recursion():
+    rng = np.random.default_rng(1)
+    n = 300
+    od = np.exp(0.002 * np.arange(n))[:, None] * [1.0, 0.5, 0.25] * (1 + rng.normal(0, 0.01, (n, 3)))
+    recording = Recording("trial", "1", ["135A", "90A", "45A"], 5.0 * np.arange(n), None, od, np.array([100, 200]))
+    history = run_filter(recording)
+
+    x, P, x_pred, P_pred, F, _ = history
+    states, covariances = x.copy(), P.copy()
+    for t in range(n - 2, -1, -1):
+        C = P[t] @ F[t + 1].T @ np.linalg.inv(P_pred[t + 1])
+        states[t] = x[t] + C @ (states[t + 1] - x_pred[t + 1])
+        covariances[t] = P[t] + C @ (covariances[t + 1] - P_pred[t + 1]) @ C.T
+
+    smoothed_states, smoothed_covariances = rts_smooth(history)
+    assert smoothed_states == pytest.approx(states, rel=1e-9)
+    assert np.allclose(smoothed_covariances, covariances, rtol=1e-6, atol=1e-18)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# test_ring_buffer
+import json
+
+import numpy as np
+import pytest
+
+from morbidostat.actions.od_backfill import od_backfill
+from morbidostat.background_jobs.od_reading import ODReader
+from morbidostat.pubsub import settle, subscribe_and_callback
+from morbidostat.utils.ring_buffer import ReadingRingBuffer
+from morbidostat.utils.simulated_ads1115 import SimulatedADS1115
+from morbidostat.whoami import unit, experiment
+
+
+def test_reads_are_views_of_the_file_until_they_wrap(tmp_path):
+    path = str(tmp_path / "od.ring")
+    buffer = ReadingRingBuffer.create(path, ["135/A", "90/A"], capacity=8)
+    for i in range(6):
+        buffer.append(100.0 + i, [i, -i])
+
+    timestamps, values = buffer.read(2, 5)
+    assert list(timestamps) == [102.0, 103.0, 104.0]
+    assert values[:, 1].tolist() == [-2.0, -3.0, -4.0]
+    assert np.shares_memory(values, buffer.values)
+
+    # another process sees the same readings
+    reader = ReadingRingBuffer(path)
+    assert reader.channels == ("135/A", "90/A")
+    assert reader.count == 6
+    assert reader.window(101.5, 104.0)[0].tolist() == [102.0, 103.0]
+
+    for i in range(6, 12):
+        buffer.append(100.0 + i, [i, -i])
+    assert reader.count == 12 and len(reader) == 8
+    assert not reader.is_current(2)
+
+    # the oldest 8 readings, wrapping around the end of the file
+    timestamps, values = reader.read()
+    assert timestamps.tolist() == [100.0 + i for i in range(4, 12)]
+    assert not np.shares_memory(values, reader.values)
+    assert reader.search(107.5) == 8
+    assert reader.window(0, 106.0)[0].tolist() == [104.0, 105.0]
+    assert reader.latest(2)[1][:, 0].tolist() == [10.0, 11.0]
+    reader.close()
+
+
+def test_searches_find_every_reading_after_the_clock_is_stepped_back(tmp_path):
+    path = str(tmp_path / "od.ring")
+    buffer = ReadingRingBuffer.create(path, ["135/A"], capacity=16)
+    # the clock is stepped back an hour after the third reading, and catches up later.
+    timestamps = [3600.0, 3601.0, 3602.0, 3.0, 4.0, 5.0, 6.0, 7.0, 3603.0, 3604.0]
+    for (i, timestamp) in enumerate(timestamps):
+        buffer.append(timestamp, [i])
+
+    assert buffer.search(3601.5) == 2
+    assert buffer.window(3601.5)[0].tolist() == timestamps[2:]
+    assert buffer.window(3601.5, 3603.5)[0].tolist() == timestamps[2:9]
+    buffer.close()
+
+
+def test_a_new_buffer_is_started_for_other_channels(tmp_path):
+    path = str(tmp_path / "od.ring")
+    buffer = ReadingRingBuffer.open_or_create(path, ["135/A"], capacity=16)
+    buffer.append(1.0, [0.5])
+    buffer.close()
+
+    assert ReadingRingBuffer.open_or_create(path, ["135/A"], capacity=16).count == 1
+    assert ReadingRingBuffer.open_or_create(path, ["135/A", "90/A"], capacity=16).count == 0
+
+
+def test_od_reader_keeps_its_readings_and_they_can_be_backfilled(tmp_path):
+    path = str(tmp_path / "od.ring")
+    ads = SimulatedADS1115({0: 0.1, 1: 0.2})
+    channels = [("135/A", "0"), ("90/A", "1")]
+    ring_buffer = ReadingRingBuffer.create(path, ["135/A", "90/A"], capacity=64)
+    reader = ODReader(channels, ads, ring_buffer=ring_buffer, unit=unit, experiment=experiment)
+    for counter in range(1, 8):
+        reader.take_reading(counter)
+    reader.set_state(reader.DISCONNECTED)
+
+    buffer = ReadingRingBuffer(path)
+    assert buffer.count == 7
+    assert np.allclose(buffer.values[:7], [0.1, 0.2], atol=1e-3)
+
+    chunks = []
+    topic = f"morbidostat/{unit}/{experiment}/od_raw_backfill"
+    assert subscribe_and_callback(lambda message: chunks.append(json.loads(message.payload)), topic).subscribed.wait(5)
+    assert od_backfill(buffer.timestamps[2], chunk_size=2, experiment=experiment, path=path) == 5
+    settle()
+
+    assert [len(chunk["timestamps"]) for chunk in chunks] == [2, 2, 1]
+    assert sum((chunk["timestamps"] for chunk in chunks), []) == pytest.approx(buffer.timestamps[2:7].tolist(), abs=1e-3)
+    assert chunks[0]["90/A"] == pytest.approx([0.2, 0.2], abs=1e-3)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+
+import pytest
+
+from morbidostat import hardware
+from morbidostat.actions.add_media import add_media
+from morbidostat.actions.add_alt_media import add_alt_media
+from morbidostat.actions.remove_waste import remove_waste
+from morbidostat.background_jobs.od_reading import create_od_reader
+from morbidostat.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from morbidostat.pubsub import publish, settle, get_retained
+from morbidostat.utils.simulated_hardware import Culture, Sensor, VIAL_VOLUME
+from morbidostat.whoami import unit, experiment
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_culture_grows_logistically_and_alt_media_slows_it():
+    clock = Clock()
+    culture = Culture(initial_od=0.1, growth_rate=0.5, carrying_capacity=2.0, clock=clock)
+
+    clock.now = 3600
+    assert culture.od == pytest.approx(0.1 * math.exp(0.5), rel=0.05)
+    clock.now = 100 * 3600
+    assert culture.od == pytest.approx(2.0)
+
+    culture.add(VIAL_VOLUME, alt_media=True)
+    assert culture.od == pytest.approx(1.0)
+    assert culture.alt_media_fraction == pytest.approx(0.5)
+    assert culture.growth_rate < 0.5 / 5
+
+
+def test_pumps_dilute_the_simulated_culture():
+    assert hardware.backend() == "simulated"
+    culture = hardware.simulated_culture()
+
+    # each test gets a new culture and GPIO (see conftest.py)
+    assert hardware.GPIO.pumped_ml == {"media": 0.0, "alt_media": 0.0, "waste": 0.0}
+    od, volume = culture.od, culture.volume
+    # the testing unit's pumps move 1mL a second
+    add_media(duration=0.2)
+    assert culture.volume == pytest.approx(volume + 0.2, abs=0.02)
+    assert culture.od == pytest.approx(od * volume / culture.volume, rel=1e-3)
+
+    add_alt_media(duration=0.2)
+    assert culture.alt_media_fraction > 0
+    remove_waste(duration=culture.volume - VIAL_VOLUME + 0.5)
+    assert culture.volume == VIAL_VOLUME
+    assert hardware.GPIO.pumped_ml["waste"] == pytest.approx(volume + 0.9 - VIAL_VOLUME, abs=0.05)
+
+
+def test_od_reading_to_growth_rate_on_simulated_hardware():
+    for topic in ["od_raw_batched", "od_normalization/median", "od_normalization/variance"]:
+        publish(f"morbidostat/{unit}/{experiment}/{topic}", None, retain=True)
+    culture = hardware.simulated_culture()
+    reader = create_od_reader(["135,0", "90,0x49:0"])
+    assert set(reader.adcs) == {0x48, 0x49}
+
+    readings = reader.take_reading(1)
+    sensors = {"135/A": Sensor(culture, "135", noise=0), "90/A": Sensor(culture, "90", noise=0)}
+    for (label, sensor) in sensors.items():
+        assert readings[label] == pytest.approx(sensor(), abs=0.01)
+
+    # the readings flow on to the growth rate calculator, which starts from the next one
+    calcs = []
+    thread = threading.Thread(
+        target=lambda: calcs.append(GrowthRateCalculator(unit=unit, experiment=experiment, ignore_cache=True))
+    )
+    thread.start()
+    counter = 2
+    while thread.is_alive():
+        reader.take_reading(counter)
+        counter += 1
+        thread.join(0.1)
+    calc = calcs[0]
+    for counter in range(counter, counter + 3):
+        reader.take_reading(counter)
+    settle()
+    growth_rate_topic = f"morbidostat/{unit}/{experiment}/growth_rate"
+    assert get_retained(growth_rate_topic)[growth_rate_topic] is not None
+    # the filtered ODs track the sensors, within their noise (2mV)
+    assert calc.state_[:2] == pytest.approx([sensors[angle]() for angle in calc.angles], abs=0.005)
+
+    calc.set_state(calc.DISCONNECTED)
+    reader.set_state(reader.DISCONNECTED)
+
+
+def test_importing_the_pumps_and_stirring_doesnt_load_the_gpio_driver(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    # RPi.GPIO isn't installed here, so loading the rpi backend's driver would fail.
+    code = """
+import sys
+import morbidostat.actions.add_media, morbidostat.actions.add_alt_media, morbidostat.actions.remove_waste
+import morbidostat.actions.od_normalization, morbidostat.background_jobs.stirring
+from morbidostat import hardware
+assert hardware._gpio is None and "RPi" not in sys.modules
+"""
+    env = dict(os.environ, HOME=str(tmp_path), HOSTNAME="localhost", TESTING="1", MORBIDOSTAT_HARDWARE="rpi")
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
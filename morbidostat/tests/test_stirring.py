@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
 # test_stirring
-import time
 import pytest
 from morbidostat.background_jobs.stirring import stirring, Stirrer
 from morbidostat.whoami import unit, experiment as exp
-from morbidostat.pubsub import publish
+from morbidostat.pubsub import publish, settle
 
 
 def pause():
-    # to avoid race conditions
-    time.sleep(10.5)
+    # wait until everything published so far has been handled
+    settle()
 
 
 def test_stirring_runs():
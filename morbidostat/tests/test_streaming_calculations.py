@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# test_streaming_calculations
+import numpy as np
+import pytest
+
+from morbidostat.utils.streaming_calculations import (
+    EWMA,
+    ExtendedKalmanFilter,
+    ExtendedKalmanFilterBank,
+    RollingMeanVar,
+    RollingQuantiles,
+)
+
+
+def test_rolling_statistics_of_many_channels_match_a_recomputation():
+    rng = np.random.default_rng(0)
+    # rounded, so the windows have ties; offset, so a naive variance would lose precision
+    values = 1000 + np.round(rng.normal(size=(500, 3)), 1)
+    moments = RollingMeanVar(20, channels=3, min_periods=2)
+    quantiles = RollingQuantiles(20, channels=3, min_periods=1)
+
+    for (i, row) in enumerate(values):
+        moments.update(row)
+        quantiles.update(row)
+        window = values[max(0, i - 19) : i + 1]
+        assert quantiles.values == pytest.approx(window)
+        assert quantiles.median == pytest.approx(np.median(window, axis=0))
+        assert quantiles.quantile(0.9) == pytest.approx(np.quantile(window, 0.9, axis=0))
+        assert (quantiles.max, quantiles.min) == (pytest.approx(window.max(axis=0)), pytest.approx(window.min(axis=0)))
+        if i == 0:
+            assert moments.mean is None and moments.variance is None
+            continue
+        assert moments.mean == pytest.approx(window.mean(axis=0))
+        assert moments.variance == pytest.approx(window.var(axis=0, ddof=1), rel=1e-6)
+
+
+def test_warm_up_and_scalars():
+    quantiles = RollingQuantiles(5)
+    for value in [3, 1, 2, 5]:
+        quantiles.update(value)
+        assert quantiles.median is None
+    quantiles.update(4)
+    assert quantiles.median == 3.0 and isinstance(quantiles.median, float)
+    quantiles.update(0)
+    assert (quantiles.median, quantiles.min, quantiles.max) == (2.0, 0.0, 5.0)
+
+    with pytest.raises(ValueError):
+        RollingMeanVar(5, min_periods=6)
+
+
+def test_ewma():
+    ewma = EWMA(halflife=1, channels=2, min_periods=2)
+    ewma.update([1.0, 10.0])
+    assert ewma.mean is None
+    ewma.update([3.0, 10.0])
+    assert ewma.mean == pytest.approx([2.0, 10.0])
+    assert ewma.variance == pytest.approx([1.0, 0.0])
+
+    # a step is followed at the rate alpha
+    ewma = EWMA(alpha=0.1)
+    for _ in range(10):
+        ewma.update(1.0)
+    assert (ewma.mean, ewma.variance) == (1.0, 0.0)
+    ewma.update(2.0)
+    assert ewma.mean == pytest.approx(1.1)
+
+
+def dense_ekf_update(state, covariance, process_noise, observation_noise, observation):
+    # the textbook filter, with dense matrices and an explicit inverse.
+    d = state.shape[0]
+    F = np.eye(d) * state[-1]
+    F[:-1, -1], F[-1, -1] = state[:-1], 1.0
+    H = np.eye(d)[:-1]
+    state = np.append(state[:-1] * state[-1], state[-1])
+    covariance = F @ covariance @ F.T + process_noise
+    gain = covariance @ H.T @ np.linalg.inv(H @ covariance @ H.T + observation_noise)
+    return state + gain @ (observation - H @ state), (np.eye(d) - gain @ H) @ covariance
+
+
+@pytest.mark.parametrize("n_sensors", [1, 2, 5])
+@pytest.mark.parametrize("lapack", [True, False])
+def test_ekf_update_matches_the_dense_filter(n_sensors, lapack, monkeypatch):
+    from morbidostat.utils import streaming_calculations
+
+    if not lapack:
+        monkeypatch.setattr(streaming_calculations, "dpotrf", None)
+
+    rng = np.random.default_rng(1)
+    d = n_sensors + 1
+    state, covariance = np.append(np.ones(n_sensors), 1.0), np.diag([1e-5] * n_sensors + [1e-8])
+    process_noise = np.diag([1e-8] * n_sensors + [1e-14])
+    observation_noise = np.diag(rng.uniform(1e-5, 1e-4, n_sensors))
+    ekf = streaming_calculations.ExtendedKalmanFilter(state, covariance, process_noise.copy(), observation_noise)
+
+    for t in range(300):
+        observation = np.exp(0.002 * t) * (1 + rng.normal(0, 0.005, n_sensors))
+        if t == 100:
+            # like after a pump runs
+            ekf.scale_OD_variance_for_next_n_steps(2e4, 20)
+        noise = process_noise.copy()
+        if 100 <= t < 120:
+            noise[np.arange(n_sensors), np.arange(n_sensors)] *= 2e4
+        state, covariance = dense_ekf_update(state, covariance, noise, observation_noise, observation)
+        ekf.update(observation)
+
+        assert ekf.state_ == pytest.approx(state, rel=1e-9)
+        assert ekf.covariance_ == pytest.approx(covariance, rel=1e-6, abs=1e-18)
+    assert ekf.state_[-1] == pytest.approx(np.exp(0.002), rel=1e-3)
+    assert np.allclose(ekf.covariance_, ekf.covariance_.T, rtol=0, atol=1e-18)
+
+
+def test_ekf_bank_matches_a_filter_per_unit():
+    rng = np.random.default_rng(2)
+    n_sensors = 2
+
+    def parameters():
+        return (
+            np.append(rng.uniform(0.5, 1.5, n_sensors), 1.0),
+            np.diag([1e-5] * n_sensors + [1e-8]),
+            np.diag([1e-8] * n_sensors + [1e-14]),
+            np.diag(rng.uniform(1e-5, 1e-4, n_sensors)),
+        )
+
+    bank, filters = ExtendedKalmanFilterBank(n_sensors, capacity=2), {}
+
+    def join(key):
+        args = parameters()
+        bank.add(key, *args)
+        filters[key] = ExtendedKalmanFilter(*(arg.copy() for arg in args))
+
+    for key in "abcd":
+        join(key)
+
+    for t in range(200):
+        if t == 50:
+            bank.remove("b")
+            del filters["b"]
+        if t == 80:
+            join("e")
+        if t % 30 == 0:
+            bank.scale_OD_variance_for_next_n_steps("a", 2e4, 10)
+            filters["a"].scale_OD_variance_for_next_n_steps(2e4, 10)
+
+        # not every unit has a new reading every time.
+        keys = [key for key in filters if rng.random() < 0.8]
+        observations = np.exp(0.002 * t) * (1 + rng.normal(0, 0.005, (len(keys), n_sensors)))
+        bank.update(keys, observations)
+        for (key, observation) in zip(keys, observations):
+            filters[key].update(observation)
+
+        for (key, ekf) in filters.items():
+            assert bank.state(key) == pytest.approx(ekf.state_, rel=1e-9)
+            assert bank.covariance(key) == pytest.approx(ekf.covariance_, rel=1e-6, abs=1e-18)
+
+    assert sorted(bank.keys) == ["a", "c", "d", "e"] and bank.capacity == 4
+    assert bank.states.shape == (4, n_sensors + 1)
+    with pytest.raises(ValueError):
+        join("a")
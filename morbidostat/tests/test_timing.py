@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# test_timing
+import threading
+
+import pytest
+
+from morbidostat.utils.timing import Scheduler, VirtualClock, every
+from morbidostat.background_jobs.utils.job_stats import JobStats
+
+
+def test_tasks_run_on_their_own_schedules_in_one_thread():
+    clock = VirtualClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    scheduler.add(lambda: runs.append(("fast", clock.now())), 1.0, name="fast", priority=1)
+    scheduler.add(lambda: runs.append(("slow", clock.now())), 2.0, offset=0.5, name="slow")
+    # due with `fast`, but runs first
+    scheduler.add(lambda: runs.append(("urgent", clock.now())), 3.0, offset=1.0, name="urgent")
+
+    scheduler.run(until=4.0)
+    assert runs == [
+        ("fast", 0.0),
+        ("slow", 0.5),
+        ("urgent", 1.0),
+        ("fast", 1.0),
+        ("fast", 2.0),
+        ("slow", 2.5),
+        ("fast", 3.0),
+    ]
+    assert all(task.stats.jitter_max == 0 for task in scheduler.tasks)
+
+
+def test_late_runs_keep_the_schedule_and_are_counted():
+    clock = VirtualClock()
+    scheduler = Scheduler(clock)
+    starts = []
+
+    def slow(counter):
+        starts.append((counter, clock.now()))
+        if counter == 2:
+            # takes 2.5 periods: the run due at 2 is skipped, and the one due at 3 starts 0.5s late
+            clock.advance(2.5)
+
+    task = scheduler.add(slow, 1.0, pass_counter=True, stats=JobStats())
+    scheduler.run(until=6.0)
+
+    assert starts == [(1, 0.0), (2, 1.0), (3, 3.5), (4, 4.0), (5, 5.0)]
+    assert task.stats.runs == 5
+    assert task.stats.overruns == 1
+    assert task.stats.skipped == 1
+    assert task.stats.jitter_max == pytest.approx(0.5)
+    assert task.job_stats.snapshot()["tasks"]["slow"]["skipped"] == 1
+
+
+def test_cancelled_tasks_stop_and_errors_go_to_on_error():
+    clock = VirtualClock()
+    scheduler = Scheduler(clock)
+    errors = []
+
+    def fails():
+        raise ValueError("oops")
+
+    failing = scheduler.add(fails, 1.0, on_error=lambda task, e: (errors.append(str(e)), scheduler.cancel(task)))
+    scheduler.run(until=3.0)
+    assert errors == ["oops"]
+    assert failing not in scheduler.tasks
+
+
+def test_threaded_tasks_dont_hold_up_the_others():
+    scheduler = Scheduler()
+    release = threading.Event()
+    quick = []
+    blocking = scheduler.add(release.wait, 0.01, thread=True)
+    scheduler.add(lambda: quick.append(1), 0.01)
+    scheduler.start()
+    try:
+        threading.Event().wait(0.2)
+        assert len(quick) > 5
+        # the blocking task is still on its first run, so it skipped its others
+        assert blocking.stats.runs == 0
+        assert blocking.stats.overruns > 0
+    finally:
+        release.set()
+        scheduler.stop()
+        blocking.join()
+    assert blocking.stats.runs == 1
+
+
+def test_every_passes_a_counter_without_touching_the_callers_kwargs():
+    kwargs = {"increment": 2}
+    clock = VirtualClock()
+    runs = every(60, lambda counter, increment: (counter, clock.now() + increment), clock=clock, **kwargs)
+
+    assert [next(runs) for _ in range(3)] == [(1, 2.0), (2, 62.0), (3, 122.0)]
+    assert kwargs == {"increment": 2}
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import configparser
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pytest
+
+from morbidostat.actions.tune_growth_rate_filter import (
+    MAX_CANDIDATES,
+    RANGES,
+    create_candidates,
+    search,
+    tune_growth_rate_filter,
+)
+from morbidostat.actions.replay_growth_rates import load_recordings
+from morbidostat.background_jobs.growth_rate_calculating import KALMAN_PARAMETERS, GrowthRateCalculator
+
+CREATE_TABLES = os.path.join(os.path.dirname(__file__), "..", "..", "sql", "create_tables.sql")
+
+
+def create_database(path, experiment="trial", hours=6, growth_rate=0.3, noise=0.005):
+    """
+    Readings every 5 seconds of a culture growing at `growth_rate` per hour, at two angles, diluted back every 20 minutes.
+    """
+    rng = np.random.default_rng(0)
+    times = 1612345678.0 + 5.0 * np.arange(int(hours * 720))
+    od = 0.5 * np.exp(growth_rate * ((times - times[0]) % 1200) / 3600)
+    rows = [
+        (float(t), "1", float(value), experiment, angle)
+        for (angle, scale) in [("135A", 1.0), ("90A", 0.4)]
+        for (t, value) in zip(times, scale * od * (1 + rng.normal(0, noise, len(times))))
+    ]
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript(open(CREATE_TABLES).read())
+        connection.executemany("INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)", rows)
+        connection.executemany(
+            "INSERT INTO io_events VALUES (?, ?, 'add_media', 1.0, '1')", [(float(t), experiment) for t in times[240::240] - 2.5]
+        )
+    connection.close()
+
+
+def test_the_likelihood_finds_the_observation_noise_and_dilutions_need_more_od_variance(tmp_path):
+    database = str(tmp_path / "observations.sqlite")
+    # noisy enough that the growth during the first readings adds little to their variance
+    create_database(database, noise=0.02)
+    recordings = load_recordings("trial", database=database)
+    fixed = {name: (value, value) for (name, value) in KALMAN_PARAMETERS.items()}
+
+    # the readings' variance before the experiment is their noise, so a factor near 1 is most likely.
+    candidates = create_candidates("grid", 7, {**fixed, "observation_noise_factor": (0.01, 100)})[1:]
+    scores = search(recordings, candidates, processes=1)
+    most_likely = max(scores, key=lambda s: s.log_likelihood)
+    assert 0.3 <= most_likely.kalman_parameters["observation_noise_factor"] <= 3
+
+    # without more variance after dilutions, the filter takes them for a falling growth rate.
+    (unscaled, scaled) = search(recordings, create_candidates("grid", 2, {**fixed, "io_event_variance_factor": (1, 2e4)})[1:], 1)
+    assert scaled.log_likelihood > unscaled.log_likelihood
+    assert scaled.lag_minutes < unscaled.lag_minutes
+
+
+def test_the_pool_scores_the_same_and_the_best_is_written_as_config(tmp_path):
+    database = str(tmp_path / "observations.sqlite")
+    create_database(database, hours=2)
+    recordings = load_recordings("trial", database=database)
+    candidates = create_candidates("random", 3, RANGES, seed=1)
+    assert candidates[0] == GrowthRateCalculator.read_kalman_parameters() and len(candidates) == 4
+
+    scores = search(recordings, candidates, processes=2)
+    assert [s.log_likelihood for s in scores] == pytest.approx([s.log_likelihood for s in search(recordings, candidates, 1)])
+
+    output = str(tmp_path / "tuned.ini")
+    best = tune_growth_rate_filter(["trial"], n_candidates=3, seed=1, processes=2, output=output, database=database)
+    assert best.log_likelihood == max(s.log_likelihood for s in scores)
+
+    tuned = configparser.ConfigParser()
+    tuned.read(output)
+    assert GrowthRateCalculator.read_kalman_parameters(tuned) == pytest.approx(best.kalman_parameters, rel=1e-2)
+    # and a config without the section has the defaults
+    assert GrowthRateCalculator.read_kalman_parameters(configparser.ConfigParser()) == KALMAN_PARAMETERS
+
+
+def test_the_pool_runs_on_a_host_that_isnt_a_unit(tmp_path, monkeypatch):
+    # the spawned processes import the tool afresh, without pytest: importing it mustn't need the unit or the experiment.
+    monkeypatch.setenv("HOSTNAME", "not-a-morbidostat")
+    monkeypatch.delenv("TESTING", raising=False)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    database = str(tmp_path / "observations.sqlite")
+    create_database(database, hours=1)
+    recordings = load_recordings("trial", database=database)
+    candidates = create_candidates("random", 1, RANGES)
+
+    scores = []
+    # a pool whose processes fail to start respawns them forever, so don't wait on it forever.
+    thread = threading.Thread(target=lambda: scores.extend(search(recordings, candidates, processes=2)), daemon=True)
+    thread.start()
+    thread.join(timeout=120)
+    assert not thread.is_alive(), "the pool's processes didn't start"
+    assert [s.log_likelihood for s in scores] == pytest.approx([s.log_likelihood for s in search(recordings, candidates, 1)])
+
+
+def test_grids_default_to_a_few_values_and_are_capped():
+    assert len(create_candidates("grid")) == 1 + 5 ** len(RANGES)
+    assert len(create_candidates("random")) == 1 + 100
+
+    # fixed parameters don't count
+    fixed = {name: (1.0, 1.0) for name in RANGES}
+    assert len(create_candidates("grid", 1000, {**fixed, "od_process_variance": (1e-10, 1e-6)})) == 1 + 1000
+
+    with pytest.raises(ValueError, match="Use fewer values"):
+        create_candidates("grid", 100)
+    with pytest.raises(ValueError):
+        create_candidates("random", MAX_CANDIDATES + 1)
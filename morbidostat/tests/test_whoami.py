@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# test_whoami
+import time
+
+from morbidostat.whoami import LatestExperiment, LATEST_EXPERIMENT_TOPIC
+from morbidostat.pubsub import publish, settle
+
+
+def wait_for(predicate, timeout=5.0):
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_latest_experiment_is_read_from_cache_without_the_leader(tmp_path):
+    cache = tmp_path / "latest_experiment"
+    cache.write_text("cached_experiment")
+
+    # no broker at this hostname, but the cached name is returned straight away.
+    latest = LatestExperiment(cache_path=str(cache), hostname="unreachable.invalid")
+    assert latest.value == "cached_experiment"
+
+
+def test_latest_experiment_follows_the_leader(tmp_path):
+    cache = tmp_path / "latest_experiment"
+    publish(LATEST_EXPERIMENT_TOPIC, "first_experiment", retain=True)
+    settle()
+
+    latest = LatestExperiment(cache_path=str(cache), hostname="localhost")
+    changes = []
+    latest.add_callback(changes.append)
+    assert latest.get(timeout=5) == "first_experiment"
+    assert cache.read_text() == "first_experiment"
+
+    publish(LATEST_EXPERIMENT_TOPIC, "second_experiment", retain=True)
+    assert wait_for(lambda: changes == ["first_experiment", "second_experiment"])
+    assert latest.value == "second_experiment"
+    assert cache.read_text() == "second_experiment"
+
+    publish(LATEST_EXPERIMENT_TOPIC, None, retain=True)
+    settle()
+
+
+def test_importing_jobs_and_actions_does_not_look_up_the_experiment(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    # not under pytest, and with no cached name and no leader: a lookup would block, so it fails instead.
+    code = """
+from morbidostat import whoami
+
+def get(*args, **kwargs):
+    raise AssertionError("looked up the experiment")
+
+whoami.LatestExperiment.get = get
+import morbidostat.background_jobs.od_reading, morbidostat.background_jobs.growth_rate_calculating
+import morbidostat.background_jobs.io_controlling, morbidostat.background_jobs.stirring
+import morbidostat.background_jobs.leader_jobs.fleet_growth_rate_calculating, morbidostat.background_jobs.leader_jobs.log_aggregating
+import morbidostat.actions.od_normalization, morbidostat.actions.clean_tubes, morbidostat.actions.change_stirring_speed
+"""
+    env = {key: value for (key, value) in os.environ.items() if key != "TESTING"}
+    env.update(HOME=str(tmp_path), HOSTNAME="localhost", MORBIDOSTAT_HARDWARE="simulated")
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# test_wire_format
+import json
+
+import numpy as np
+import pytest
+
+from morbidostat.utils import wire_format
+
+
+def test_round_trip():
+    schema, schema_payload = wire_format.create_schema(["135/A", "90/A"], dtype="float64")
+    payload = wire_format.encode(schema, [0.778586260567034, 0.20944389172032837], timestamp=1.5)
+    assert wire_format.is_binary(payload)
+    assert len(payload) == wire_format.HEADER.size + 2 * 8
+
+    decoder = wire_format.Decoder()
+    decoder.add_schema(schema_payload)
+    decoded_schema, timestamp, values = decoder.decode(payload)
+    assert decoded_schema.channels == ("135/A", "90/A")
+    assert timestamp == 1.5
+    np.testing.assert_array_equal(values, [0.778586260567034, 0.20944389172032837])
+
+
+def test_schema_id_changes_with_channel_order():
+    schema1, _ = wire_format.create_schema(["135/A", "90/A"])
+    schema2, _ = wire_format.create_schema(["90/A", "135/A"])
+    assert schema1.id != schema2.id
+
+
+def test_decode_to_dict_accepts_json_and_binary():
+    schema, schema_payload = wire_format.create_schema(["135/A", "90/A"])
+    decoder = wire_format.Decoder()
+
+    with pytest.raises(KeyError):
+        decoder.decode(wire_format.encode(schema, [0.5, 0.25]))
+
+    decoder.add_schema(schema_payload)
+    assert decoder.decode_to_dict(wire_format.encode(schema, [0.5, 0.25])) == {"135/A": 0.5, "90/A": 0.25}
+    assert decoder.decode_to_dict(json.dumps({"135/A": 0.5, "90/A": 0.25})) == {"135/A": 0.5, "90/A": 0.25}
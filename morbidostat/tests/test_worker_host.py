@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# test_worker_host
+import json
+import time
+
+from morbidostat.background_jobs.worker_host import WorkerHost
+from morbidostat.whoami import unit, experiment as exp
+from morbidostat.pubsub import publish, settle, get_retained
+
+
+def wait_for(predicate, timeout=5.0):
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def running_jobs():
+    settle()
+    # no jobs is an empty payload, which clears the retained message
+    return get_retained(f"morbidostat/{unit}/{exp}/worker_host/jobs")[f"morbidostat/{unit}/{exp}/worker_host/jobs"] or b""
+
+
+def test_start_and_stop_jobs_over_mqtt():
+    host = WorkerHost(unit=unit, experiment=exp)
+    assert running_jobs() == b""
+
+    publish(f"morbidostat/{unit}/{exp}/worker_host/start", json.dumps({"job": "stirring", "kwargs": {"duty_cycle": 50}}))
+    assert wait_for(lambda: "stirring" in host.hosted_jobs)
+    stirrer = host.hosted_jobs["stirring"].job
+    assert stirrer.state == stirrer.READY
+    assert stirrer.duty_cycle == 50
+    assert running_jobs() == b"stirring"
+
+    # starting a job that's running does nothing
+    assert host.start_job("stirring") is None
+
+    publish(f"morbidostat/{unit}/{exp}/worker_host/stop", "stirring")
+    assert wait_for(lambda: "stirring" not in host.hosted_jobs)
+    assert stirrer.state == stirrer.DISCONNECTED
+    assert running_jobs() == b""
+
+    host.set_state("disconnected")
+
+
+def test_hosted_job_stopped_with_its_own_state():
+    host = WorkerHost(unit=unit, experiment=exp)
+    stirrer = host.start_job("stirring", duty_cycle=50)
+    assert running_jobs() == b"stirring"
+
+    publish(f"morbidostat/{unit}/{exp}/stirring/$state/set", "disconnected")
+    assert wait_for(lambda: stirrer.state == stirrer.DISCONNECTED)
+    assert wait_for(lambda: running_jobs() == b"")
+
+    host.set_state("disconnected")
@@ -8,14 +8,21 @@ from functools import wraps
 import numpy as np
 
 
-def log_start(unit, experiment):
+def log_start(unit, experiment=None):
+    """
+    Log the start of the decorated function to `morbidostat/<unit>/<experiment>/log`. The experiment defaults to the
+    latest, looked up when the function is called, not when it's decorated.
+    """
+
     def actual_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             from morbidostat.pubsub import publish
+            from morbidostat.whoami import get_latest_experiment_name
 
             func_name = func.__name__
-            publish(f"morbidostat/{unit}/{experiment}/log", f"[{func_name}]: starting.", verbose=1)
+            topic = f"morbidostat/{unit}/{experiment or get_latest_experiment_name()}/log"
+            publish(topic, f"[{func_name}]: starting.", verbose=1)
             return func(*args, **kwargs)
 
         return wrapper
@@ -23,16 +30,27 @@ def log_start(unit, experiment):
     return actual_decorator
 
 
-def log_stop(unit, experiment):
+def log_stop(unit, experiment=None):
+    """
+    Log the termination (SIGTERM) of the decorated function. The experiment defaults to the latest when it's terminated.
+    """
+
     def actual_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             from morbidostat.pubsub import publish
+            from morbidostat.whoami import get_latest_experiment_name, latest_experiment
 
             func_name = func.__name__
+            started_in = experiment or get_latest_experiment_name()
 
             def terminate(*args):
-                publish(f"morbidostat/{unit}/{experiment}/log", f"[{func_name}]: terminated.", verbose=1)
+                # latest_experiment.value doesn't block, which matters in a signal handler.
+                publish(
+                    f"morbidostat/{unit}/{experiment or latest_experiment.value or started_in}/log",
+                    f"[{func_name}]: terminated.",
+                    verbose=1,
+                )
                 sys.exit()
 
             signal.signal(signal.SIGTERM, terminate)
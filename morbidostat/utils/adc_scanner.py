@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Reads single-ended inputs spread over several ADS1115s on one I2C bus, overlapping the conversions of different
+chips. A conversion takes 1/data_rate (7.8ms at 128/s), while starting one or reading its result over I2C takes
+well under a millisecond. So each round starts a conversion on every chip that has inputs left to read, waits
+once, and then collects the results: a scan takes about as long as the conversions of the chip with the most
+inputs, instead of the sum over all chips.
+
+    scanner = InterleavedScanner({0x48: ads_a, 0x49: ads_b}, {"135/A": (0x48, 0), "90/A": (0x49, 0)})
+    scanner.scan(conversions=4)  # {"135/A": [v1, v2, v3, v4], "90/A": [...]}
+
+The gain is part of the config written to start a conversion, so each channel has its own (`scanner.gains`, which
+starts from the `gain` of the channel's adafruit_ads1x15 ADS1115): a dim channel can use a higher gain than a bright
+one on the same chip. The registers are written here, and not with AnalogIn, since AnalogIn blocks until its
+conversion is done.
+"""
+import time
+
+DEFAULT_ADDRESS = 0x48
+
+_CONVERSION_REGISTER = 0x00
+_CONFIG_REGISTER = 0x01
+_OS_SINGLE = 0x8000  # written: start a conversion. read: 1 once the conversion is done.
+_MODE_SINGLE = 0x0100
+_COMP_QUE_DISABLE = 0x0003
+
+# gain -> (PGA bits, full scale voltage)
+_GAINS = {
+    2 / 3: (0x0000, 6.144),
+    1: (0x0200, 4.096),
+    2: (0x0400, 2.048),
+    4: (0x0600, 1.024),
+    8: (0x0800, 0.512),
+    16: (0x0A00, 0.256),
+}
+# a conversion not done within this many periods of starting means the chip isn't responding.
+_CONVERSION_TIMEOUT_PERIODS = 4
+
+_DATA_RATES = {8: 0x0000, 16: 0x0020, 32: 0x0040, 64: 0x0060, 128: 0x0080, 250: 0x00A0, 475: 0x00C0, 860: 0x00E0}
+
+
+def parse_channel(channel):
+    """
+    "2" or 2 -> (0x48, 2), "0x49:2" -> (0x49, 2), and (0x49, 2) is returned as is.
+    """
+    if isinstance(channel, tuple):
+        return channel
+    channel = str(channel)
+    if ":" in channel:
+        address, pin = channel.split(":")
+        return int(address, 0), int(pin)
+    return DEFAULT_ADDRESS, int(channel)
+
+
+def config_word(pin, gain, data_rate, single=True):
+    config = (0x04 | pin) << 12  # single-ended input AIN<pin> against GND
+    config |= _GAINS[gain][0] | _DATA_RATES[data_rate] | _COMP_QUE_DISABLE
+    if single:
+        config |= _OS_SINGLE | _MODE_SINGLE
+    return config
+
+
+def to_voltage(raw, gain):
+    if raw & 0x8000:
+        raw -= 1 << 16
+    return raw * _GAINS[gain][1] / 32768
+
+
+def write_register(ads, register, value):
+    with ads.i2c_device as i2c:
+        i2c.write(bytes([register, (value >> 8) & 0xFF, value & 0xFF]))
+
+
+def read_register(ads, register):
+    buffer = bytearray(2)
+    with ads.i2c_device as i2c:
+        i2c.write_then_readinto(bytes([register]), buffer)
+    return buffer[0] << 8 | buffer[1]
+
+
+class InterleavedScanner:
+    """
+    Parameters
+    -----------
+
+    adcs: {i2c address: adafruit_ads1x15 ADS1115}
+    channels: {label: (i2c address, pin)}
+    continuous: bool
+        keep the chips converting non-stop: each round switches every chip to its next input, and then reads
+        consecutive conversions, instead of triggering each one over I2C.
+
+    """
+
+    def __init__(self, adcs, channels, continuous=False):
+        unknown = {address for (address, _) in channels.values()} - set(adcs)
+        if unknown:
+            raise ValueError(f"No ADC at address(es) {', '.join(hex(a) for a in sorted(unknown))}.")
+
+        self.adcs = adcs
+        self.channels = channels
+        self.continuous = continuous
+        self.gains = {label: adcs[address].gain for (label, (address, _)) in channels.items()}
+        # the inputs of each chip, in the order they are read.
+        self.queues = {address: [] for address in adcs}
+        for (label, (address, pin)) in channels.items():
+            self.queues[address].append((label, pin))
+
+    def period(self, address):
+        return 1 / self.adcs[address].data_rate
+
+    def scan(self, conversions=1):
+        """
+        Returns {label: list of `conversions` voltages}, in the order of `channels`.
+        """
+        voltages = {label: [] for label in self.channels}
+        if self.continuous:
+            self._scan_continuous(conversions, voltages)
+        else:
+            self._scan_single(conversions, voltages)
+        return voltages
+
+    def _scan_single(self, conversions, voltages):
+        pending = {
+            address: [(label, pin) for (label, pin) in queue for _ in range(conversions)]
+            for (address, queue) in self.queues.items()
+            if queue
+        }
+
+        while pending:
+            started, start = [], time.perf_counter()
+            for (address, queue) in pending.items():
+                label, pin = queue.pop(0)
+                ads, gain = self.adcs[address], self.gains[label]
+                write_register(ads, _CONFIG_REGISTER, config_word(pin, gain, ads.data_rate))
+                started.append((address, ads, label, gain))
+
+            # the chips started within a few hundred µs of each other, so one conversion period after the first
+            # started, most are done; poll the rest.
+            time.sleep(max(0, min(self.period(a) for a in pending) - (time.perf_counter() - start)))
+            for (address, ads, label, gain) in started:
+                self._wait_for_conversion(address, label, start)
+                voltages[label].append(to_voltage(read_register(ads, _CONVERSION_REGISTER), gain))
+
+            pending = {address: queue for (address, queue) in pending.items() if queue}
+
+    def _wait_for_conversion(self, address, label, start):
+        period = self.period(address)
+        deadline = start + _CONVERSION_TIMEOUT_PERIODS * period
+        while not read_register(self.adcs[address], _CONFIG_REGISTER) & _OS_SINGLE:
+            if time.perf_counter() > deadline:
+                raise OSError(
+                    f"The ADC at {hex(address)} didn't finish converting {label} within {_CONVERSION_TIMEOUT_PERIODS} "
+                    f"periods ({1000 * _CONVERSION_TIMEOUT_PERIODS * period:.1f}ms)."
+                )
+            time.sleep(period / 16)
+
+    def _scan_continuous(self, conversions, voltages):
+        pending = {address: list(queue) for (address, queue) in self.queues.items() if queue}
+
+        while pending:
+            current = []
+            for (address, queue) in pending.items():
+                label, pin = queue.pop(0)
+                ads, gain = self.adcs[address], self.gains[label]
+                write_register(ads, _CONFIG_REGISTER, config_word(pin, gain, ads.data_rate, single=False))
+                current.append((ads, label, gain))
+
+            # writing the config restarts the conversion: the first one with the new input is ready after a period
+            # (plus the chip's wake up, hence 2 periods, as adafruit_ads1x15 waits). Then one conversion per period.
+            period = max(self.period(a) for a in pending)
+            next_time = time.perf_counter() + 2 * period
+            for _ in range(conversions):
+                time.sleep(max(0, next_time - time.perf_counter()))
+                for (ads, label, gain) in current:
+                    voltages[label].append(to_voltage(read_register(ads, _CONVERSION_REGISTER), gain))
+                next_time += period
+
+            pending = {address: queue for (address, queue) in pending.items() if queue}
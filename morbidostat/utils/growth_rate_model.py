@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+The growth rate filter's model: its noise parameters and covariances, and the order of its sensors. It's used by
+growth_rate_calculating and fleet_growth_rate_calculating, and offline by replay_growth_rates and
+tune_growth_rate_filter, whose worker processes import it. So it doesn't import whoami, pubsub or the jobs, and
+importing it does no I/O beyond reading the config.
+"""
+import numpy as np
+
+from morbidostat.config import config
+
+# the filter's noise, from the [growth_rate_kalman] section of the config if it's set. The defaults were chosen by hand;
+# `mb tune_growth_rate_filter` searches for better ones on recorded experiments.
+KALMAN_PARAMETERS = {
+    "rate_process_variance": 1e-14,
+    "od_process_variance": 1e-8,
+    "observation_noise_factor": 5.0,
+    "io_event_variance_factor": 2e4,
+}
+
+
+def sorted_observations(d):
+    # the filter's order of the sensors. 180 is the reference, not a reading of the culture.
+    return {k: d[k] for k in sorted(d, reverse=True) if not k.startswith("180")}
+
+
+def read_kalman_parameters(config=config):
+    """
+    KALMAN_PARAMETERS, overridden by those in the [growth_rate_kalman] section of `config`.
+    """
+    section = config["growth_rate_kalman"] if config.has_section("growth_rate_kalman") else {}
+    return {name: float(section.get(name, default)) for (name, default) in KALMAN_PARAMETERS.items()}
+
+
+def create_covariances(angles, od_normalization_factors, od_variances, kalman_parameters=None):
+    """
+    The filter's initial covariance, and its process and observation noise covariances, for the sensors `angles`.
+    `kalman_parameters` defaults to those in the config.
+    """
+    kalman_parameters = kalman_parameters or read_kalman_parameters()
+    d = len(angles) + 1
+
+    # empirically selected
+    initial_covariance = np.block(
+        [[1e-5 * np.ones((d - 1, d - 1)), 1e-8 * np.ones((d - 1, 1))], [1e-8 * np.ones((1, d - 1)), 1e-8]]
+    )
+    OD_process_covariance = create_OD_covariance(angles, kalman_parameters["od_process_variance"])
+
+    rate_process_variance = kalman_parameters["rate_process_variance"]
+    process_noise_covariance = np.block(
+        [[OD_process_covariance, 0 * np.ones((d - 1, 1))], [0 * np.ones((1, d - 1)), rate_process_variance]]
+    )
+    # a fudge factor on the variance of the readings before the experiment
+    observation_noise_covariance = kalman_parameters["observation_noise_factor"] * np.diag(
+        [od_variances[angle] / od_normalization_factors[angle] ** 2 for angle in angles]
+    )
+    return initial_covariance, process_noise_covariance, observation_noise_covariance
+
+
+def create_OD_covariance(angles, od_process_variance=KALMAN_PARAMETERS["od_process_variance"]):
+    d = len(angles)
+    variances = {"135": od_process_variance, "90": od_process_variance, "45": od_process_variance}
+
+    OD_covariance = 0 * np.ones((d, d))
+    for i, a in enumerate(angles):
+        for k in variances:
+            if a.startswith(k):
+                OD_covariance[i, i] = variances[k]
+    return OD_covariance
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+A small MQTT broker (3.1.1 and 5) that runs inside the current process, on a loopback port. It's a stand-in for
+mosquitto in tests and benchmarks, so they don't need a broker running on the machine.
+
+It implements what morbidostat uses: retained messages, QoS 0, 1 and 2, wildcards and last wills. It has no
+persistent sessions, authentication or topic aliases, and doesn't resend unacknowledged messages (loopback
+connections don't drop packets).
+
+Point `pubsub` at it by setting `broker=in_process` under [network] in config.ini, or the environment variable
+`MORBIDOSTAT_BROKER=in_process`. The tests do this by default.
+"""
+import socket
+import struct
+import threading
+import uuid
+
+from morbidostat.pubsub import TopicTrie
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+DISCONNECT_WITH_WILL = 0x04
+
+
+def encode_varint(n):
+    out = bytearray()
+    while True:
+        n, digit = divmod(n, 128)
+        out.append(digit | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    if isinstance(s, str):
+        s = s.encode("utf-8")
+    return struct.pack("!H", len(s)) + s
+
+
+def packet(first_byte, body):
+    return bytes([first_byte]) + encode_varint(len(body)) + body
+
+
+class _Reader:
+    """
+    Reads fields out of the body of a packet.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+    def byte(self):
+        self.offset += 1
+        return self.data[self.offset - 1]
+
+    def uint16(self):
+        self.offset += 2
+        return struct.unpack_from("!H", self.data, self.offset - 2)[0]
+
+    def varint(self):
+        n, shift = 0, 0
+        while True:
+            digit = self.byte()
+            n += (digit & 0x7F) << shift
+            if not digit & 0x80:
+                return n
+            shift += 7
+
+    def binary(self):
+        length = self.uint16()
+        self.offset += length
+        return self.data[self.offset - length : self.offset]
+
+    def string(self):
+        return self.binary().decode("utf-8")
+
+    def properties(self):
+        # MQTT 5 properties, kept as raw bytes.
+        length = self.varint()
+        self.offset += length
+        return self.data[self.offset - length : self.offset]
+
+    def rest(self):
+        rest = self.data[self.offset :]
+        self.offset = len(self.data)
+        return rest
+
+
+class Message:
+    __slots__ = ("topic", "payload", "qos", "retain", "properties")
+
+    def __init__(self, topic, payload, qos=0, retain=False, properties=b""):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.properties = properties
+
+
+class _Session:
+    """
+    One client connection, served by its own thread.
+    """
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.client_id = None
+        self.version = 4
+        self.will = None
+        self.subscriptions = {}  # topic filter -> (qos, options)
+        self.awaiting_release = set()  # QoS 2 packet ids we've received but not yet seen PUBREL for
+        self._next_packet_id = 0
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+
+    @property
+    def v5(self):
+        return self.version == 5
+
+    def start(self):
+        self._thread.start()
+
+    def send(self, data):
+        with self._write_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def packet_id(self):
+        with self._write_lock:
+            self._next_packet_id = self._next_packet_id % 65535 + 1
+            return self._next_packet_id
+
+    def _read_exactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_packet(self):
+        first_byte = self._read_exactly(1)[0]
+        length, shift = 0, 0
+        while True:
+            digit = self._read_exactly(1)[0]
+            length += (digit & 0x7F) << shift
+            if not digit & 0x80:
+                break
+            shift += 7
+        return first_byte >> 4, first_byte & 0x0F, self._read_exactly(length)
+
+    def serve(self):
+        graceful = False
+        try:
+            packet_type, _, body = self.read_packet()
+            if packet_type != CONNECT:
+                return
+            self.on_connect(_Reader(body))
+
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == DISCONNECT:
+                    reader = _Reader(body)
+                    graceful = not (self.v5 and reader.remaining() and reader.byte() == DISCONNECT_WITH_WILL)
+                    return
+                self.handle(packet_type, flags, _Reader(body))
+        except (OSError, ConnectionError, struct.error, IndexError):
+            pass
+        finally:
+            self.close()
+            self.broker.remove_session(self, publish_will=not graceful)
+
+    def on_connect(self, reader):
+        reader.string()  # protocol name
+        self.version = reader.byte()
+        flags = reader.byte()
+        keepalive = reader.uint16()
+        if self.v5:
+            reader.properties()
+
+        self.client_id = reader.string() or f"in_process-{uuid.uuid4().hex}"
+        if flags & 0x04:
+            properties = reader.properties() if self.v5 else b""
+            topic, payload = reader.string(), reader.binary()
+            self.will = Message(topic, payload, qos=(flags >> 3) & 0x03, retain=bool(flags & 0x20), properties=properties)
+
+        if keepalive:
+            self.sock.settimeout(1.5 * keepalive)
+
+        self.broker.add_session(self)
+        self.send(packet(CONNACK << 4, b"\x00\x00\x00" if self.v5 else b"\x00\x00"))
+
+    def handle(self, packet_type, flags, reader):
+        if packet_type == PUBLISH:
+            qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+            topic = reader.string()
+            packet_id = reader.uint16() if qos else None
+            properties = reader.properties() if self.v5 else b""
+            message = Message(topic, reader.rest(), qos, retain, properties)
+
+            if qos == 0:
+                self.broker.route(message, sender=self)
+            elif qos == 1:
+                self.broker.route(message, sender=self)
+                self.send(packet(PUBACK << 4, struct.pack("!H", packet_id)))
+            else:
+                # a resent QoS 2 message we've already routed isn't routed again.
+                if packet_id not in self.awaiting_release:
+                    self.awaiting_release.add(packet_id)
+                    self.broker.route(message, sender=self)
+                self.send(packet(PUBREC << 4, struct.pack("!H", packet_id)))
+
+        elif packet_type == PUBREL:
+            packet_id = reader.uint16()
+            self.awaiting_release.discard(packet_id)
+            self.send(packet(PUBCOMP << 4, struct.pack("!H", packet_id)))
+
+        elif packet_type == PUBREC:
+            self.send(packet((PUBREL << 4) | 0x02, struct.pack("!H", reader.uint16())))
+
+        elif packet_type == SUBSCRIBE:
+            packet_id = reader.uint16()
+            if self.v5:
+                reader.properties()
+            requests = []
+            while reader.remaining():
+                topic_filter, options = reader.string(), reader.byte()
+                requests.append((topic_filter, min(options & 0x03, 2), options))
+
+            header = struct.pack("!H", packet_id) + (b"\x00" if self.v5 else b"")
+            self.broker.subscribe(self, requests, packet((SUBACK << 4), header + bytes(qos for (_, qos, _) in requests)))
+
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = reader.uint16()
+            if self.v5:
+                reader.properties()
+            topic_filters = []
+            while reader.remaining():
+                topic_filters.append(reader.string())
+            for topic_filter in topic_filters:
+                self.broker.unsubscribe(self, topic_filter)
+
+            body = struct.pack("!H", packet_id) + (b"\x00" + bytes(len(topic_filters)) if self.v5 else b"")
+            self.send(packet(UNSUBACK << 4, body))
+
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP << 4, b""))
+
+        # PUBACK and PUBCOMP need nothing from us.
+
+    def deliver(self, message, qos, retain):
+        body = encode_string(message.topic)
+        if qos:
+            body += struct.pack("!H", self.packet_id())
+        if self.v5:
+            body += encode_varint(len(message.properties)) + message.properties
+        self.send(packet((PUBLISH << 4) | (qos << 1) | int(retain), body + message.payload))
+
+
+class Broker:
+    """
+    The broker, serving on a thread of its own:
+
+        broker = Broker().start()
+        client.connect("127.0.0.1", broker.port)
+
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self.host, self.port = self._server.getsockname()
+
+        self._lock = threading.RLock()
+        self._sessions = {}  # client id -> session
+        self._trie = TopicTrie()  # topic filter -> (session, topic filter)
+        self.retained = {}  # topic -> Message
+        self._thread = threading.Thread(target=self._accept_forever, daemon=True)
+
+    def start(self):
+        self._server.listen(64)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.close()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.close()
+
+    def _accept_forever(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _Session(self, sock).start()
+
+    def add_session(self, session):
+        with self._lock:
+            existing = self._sessions.get(session.client_id)
+            self._sessions[session.client_id] = session
+        if existing is not None:
+            # a client reconnecting with the same id takes over; the old connection is dropped.
+            existing.close()
+
+    def remove_session(self, session, publish_will):
+        with self._lock:
+            if self._sessions.get(session.client_id) is session:
+                del self._sessions[session.client_id]
+            for topic_filter in session.subscriptions:
+                self._trie.remove(topic_filter, (session, topic_filter))
+            session.subscriptions = {}
+        if publish_will and session.will is not None:
+            self.route(session.will, sender=None)
+
+    def subscribe(self, session, requests, suback):
+        """
+        Add `session`'s subscriptions, (topic filter, qos, options) `requests`, then send it `suback` and the matching
+        retained messages. It's all done holding the lock: a client that sees the SUBACK can rely on the subscription
+        being in place, and messages routed afterwards arrive after the retained ones.
+        """
+        with self._lock:
+            retained = []
+            for (topic_filter, qos, options) in requests:
+                if topic_filter not in session.subscriptions:
+                    self._trie.insert(topic_filter, (session, topic_filter))
+                session.subscriptions[topic_filter] = (qos, options)
+
+                retain_handling = (options >> 4) & 0x03 if session.v5 else 0
+                if retain_handling != 2:
+                    trie = TopicTrie()
+                    trie.insert(topic_filter, True)
+                    retained.extend(
+                        (message, min(qos, message.qos)) for message in self.retained.values() if any(trie.match(message.topic))
+                    )
+
+            session.send(suback)
+            for (message, qos) in retained:
+                session.deliver(message, qos, retain=True)
+
+    def unsubscribe(self, session, topic_filter):
+        with self._lock:
+            if session.subscriptions.pop(topic_filter, None) is not None:
+                self._trie.remove(topic_filter, (session, topic_filter))
+
+    def route(self, message, sender=None):
+        with self._lock:
+            if message.retain:
+                if message.payload:
+                    self.retained[message.topic] = message
+                else:
+                    self.retained.pop(message.topic, None)
+
+            # a session with several matching subscriptions gets the message once, at the highest QoS.
+            deliveries = {}
+            for (session, topic_filter) in self._trie.match(message.topic):
+                qos, options = session.subscriptions[topic_filter]
+                if session.v5 and options & 0x04 and session is sender:
+                    continue  # no local
+                retain = bool(session.v5 and options & 0x08 and message.retain)
+                previous_qos, previous_retain = deliveries.get(session, (-1, False))
+                deliveries[session] = (max(previous_qos, min(qos, message.qos)), previous_retain or retain)
+
+            # deliver while holding the lock, so every subscriber sees messages in the same order.
+            for (session, (qos, retain)) in deliveries.items():
+                session.deliver(message, qos, retain)
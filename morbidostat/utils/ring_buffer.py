@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+A fixed-size, memory-mapped ring buffer of timestamped readings, one value per channel. `od_reading` writes its
+raw voltages to one (`[od_sampling] ring_buffer`), so each worker keeps the last days of its readings, whether or
+not the leader got them. Other processes open it read-only, and read windows as NumPy arrays backed by the file.
+
+The file is a header, the channel labels, then the three arrays:
+
+    magic b"MBRING02" | n channels (uint32) | capacity (uint32) | count (uint64) | created (float64)
+    labels     n channels x 32 bytes, utf-8, zero padded
+    timestamps capacity x float64, unix time
+    keys       capacity x float64, the largest timestamp up to and including the row's
+    values     capacity x n channels x float32
+
+The timestamps are the wall clock's, which can be stepped back (ex: NTP, or a Pi without a real time clock
+catching up after boot), so they aren't always in order. The keys never decrease, and searches bisect them:
+a reading at or after a time is never before the reading `search` returns for it, though readings from before
+a step back may come after it too.
+
+Reading number `i` (from 0, the first ever written) is in row `i % capacity`. `count`, the number of readings ever
+written, is updated after the row is, so a reader never sees a half written reading. There is one writer. A reader's
+arrays are views of the file: rows older than `count - capacity` are overwritten under them, and `is_current` says
+if that has happened since.
+"""
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b"MBRING02"
+HEADER = struct.Struct("<8sIIQd")
+LABEL_BYTES = 32
+_COUNT_OFFSET = 16
+
+
+class ReadingRingBuffer:
+    def __init__(self, path, mode="r"):
+        """
+        Open the ring buffer at `path`, read-only (mode "r") or to append to it ("r+"). See also `create`.
+        """
+        self.path = path
+        self.writable = mode == "r+"
+        with open(path, "r+b" if self.writable else "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+
+        magic, n_channels, self.capacity, _, self.created = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a ring buffer of readings.")
+        labels = self._mmap[HEADER.size : HEADER.size + n_channels * LABEL_BYTES]
+        self.channels = tuple(labels[i * LABEL_BYTES : (i + 1) * LABEL_BYTES].rstrip(b"\0").decode() for i in range(n_channels))
+
+        offset = _data_offset(n_channels)
+        self._count = np.ndarray((1,), dtype="<u8", buffer=self._mmap, offset=_COUNT_OFFSET)
+        self.timestamps = np.ndarray((self.capacity,), dtype="<f8", buffer=self._mmap, offset=offset)
+        self.keys = np.ndarray((self.capacity,), dtype="<f8", buffer=self._mmap, offset=offset + 8 * self.capacity)
+        self.values = np.ndarray((self.capacity, n_channels), dtype="<f4", buffer=self._mmap, offset=offset + 16 * self.capacity)
+
+    @classmethod
+    def create(cls, path, channels, capacity):
+        """
+        Create an empty ring buffer of `capacity` readings of `channels` at `path`, replacing any file there.
+        """
+        channels = [str(channel) for channel in channels]
+        if any(len(channel.encode()) > LABEL_BYTES for channel in channels):
+            raise ValueError(f"channel labels can be at most {LABEL_BYTES} bytes.")
+
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(channels), capacity, 0, time.time()))
+            for channel in channels:
+                f.write(channel.encode().ljust(LABEL_BYTES, b"\0"))
+            # sparse: the disk is used as the buffer fills.
+            f.truncate(_data_offset(len(channels)) + (16 + 4 * len(channels)) * capacity)
+        os.replace(tmp, path)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def open_or_create(cls, path, channels, capacity):
+        """
+        Open the ring buffer at `path` to append to it, or start a new one if there's none, or if the one there has
+        other channels or another capacity.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            buffer = cls(path, mode="r+")
+            if buffer.channels == tuple(channels) and buffer.capacity == capacity:
+                return buffer
+            buffer.close()
+        except (FileNotFoundError, ValueError, struct.error):
+            pass
+        return cls.create(path, channels, capacity)
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    @property
+    def first(self):
+        """
+        The number of the oldest reading still in the buffer.
+        """
+        return max(0, self.count - self.capacity)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values):
+        """
+        `values` must be in the order of `channels`.
+        """
+        count = self.count
+        row = count % self.capacity
+        self.keys[row] = timestamp if count == 0 else max(timestamp, self.keys[(count - 1) % self.capacity])
+        self.timestamps[row] = timestamp
+        self.values[row] = values
+        self._count[0] = count + 1
+
+    def read(self, start=None, stop=None):
+        """
+        Returns (timestamps, values) of readings number `start` (default: the oldest) up to `stop` (default: the
+        latest), clipped to those still in the buffer. They're views of the file, unless the range wraps around
+        the end of the buffer, when they're copies.
+        """
+        count, first = self.count, self.first
+        start = first if start is None else min(max(start, first), count)
+        stop = count if stop is None else min(max(stop, start), count)
+
+        row_start, row_stop = start % self.capacity, (stop - 1) % self.capacity + 1
+        if start == stop:
+            return self.timestamps[:0], self.values[:0]
+        if row_start < row_stop:
+            return self.timestamps[row_start:row_stop], self.values[row_start:row_stop]
+        return (
+            np.concatenate([self.timestamps[row_start:], self.timestamps[:row_stop]]),
+            np.concatenate([self.values[row_start:], self.values[:row_stop]]),
+        )
+
+    def latest(self, n=1):
+        return self.read(self.count - n)
+
+    def search(self, timestamp):
+        """
+        The number of the first reading whose key is at or after `timestamp`. Every reading taken at or after
+        `timestamp` is this one or a later one.
+        """
+        count, first = self.count, self.first
+        if count == 0:
+            return 0
+        row_first, rows = first % self.capacity, len(self)
+        # the readings are in two sorted runs: the rows from the oldest to the end, then from the start.
+        older = self.keys[row_first : row_first + rows]
+        newer = self.keys[: rows - len(older)]
+        i = np.searchsorted(older, timestamp)
+        if i == len(older):
+            i += np.searchsorted(newer, timestamp)
+        return first + int(i)
+
+    def window(self, start_time, end_time=None):
+        """
+        Returns (timestamps, values) of the readings from `start_time` up to (not including) `end_time`.
+        """
+        stop = self.count if end_time is None else self.search(end_time)
+        return self.read(self.search(start_time), stop)
+
+    def is_current(self, start):
+        """
+        False if reading `start` has been overwritten, ex: since a `read` of it returned views.
+        """
+        return start >= self.first
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        # the mmap can't be closed while there are views of it: then it's closed when the last one goes.
+        del self._count, self.timestamps, self.keys, self.values
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _data_offset(n_channels):
+    # aligned for the float64 timestamps
+    offset = HEADER.size + n_channels * LABEL_BYTES
+    return (offset + 7) // 8 * 8
+
+
+def capacity_for(days, samples_per_second):
+    return max(1024, int(days * 24 * 60 * 60 * samples_per_second))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+A statistical profiler: a thread that, `samples_per_second` times a second, records the stack of every other thread
+in the process. The result is in the "collapsed stack" format that flamegraph.pl (and speedscope, etc.) read: one
+line per distinct stack, the thread name then the frames from the root, separated by `;`, and the number of samples.
+
+    profiler = SamplingProfiler(samples_per_second=100)
+    profiler.run(30)   # or start() ... stop()
+    print(profiler.collapsed())
+
+    MainThread;<module> (od_reading.py:1);od_reading (od_reading.py:191);take_reading (od_reading.py:64) 12
+
+Nothing is instrumented, so the profiled code runs at full speed between samples; the cost is the sampling thread
+holding the GIL while it walks the stacks.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def frame_label(code):
+    path = code.co_filename.split(os.sep)
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({'/'.join(path[-2:]) if path[-1] == '__init__.py' else path[-1]}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, samples_per_second=100):
+        self.interval = 1 / samples_per_second
+        self.stacks = Counter()  # (thread name, code objects from the root) -> samples
+        self.samples = 0
+        self.cpu_time = 0.0  # spent sampling
+        self.duration = 0.0
+        self.finished = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, seconds=None):
+        self._thread = threading.Thread(target=self.run, args=(seconds,), name="sampling_profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        return self
+
+    def run(self, seconds=None):
+        """
+        Sample until `stop` is called, or for `seconds`. Sets `finished` when done.
+        """
+        start, cpu_start = time.monotonic(), time.thread_time()
+        deadline = None if seconds is None else start + seconds
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        self.duration += time.monotonic() - start
+        self.cpu_time += time.thread_time() - cpu_start
+        self.finished.set()
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            self.stacks[(names.get(ident, str(ident)), tuple(codes))] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        labels = {}
+
+        def label(code):
+            if code not in labels:
+                labels[code] = frame_label(code)
+            return labels[code]
+
+        lines = Counter()
+        for ((thread_name, codes), count) in self.stacks.items():
+            lines[";".join([thread_name.replace(" ", "_")] + [label(code) for code in codes])] += count
+        return "\n".join(f"{stack} {count}" for (stack, count) in sorted(lines.items()))
+
+    @property
+    def overhead(self):
+        # the share of one CPU spent sampling.
+        return self.cpu_time / self.duration if self.duration else 0.0
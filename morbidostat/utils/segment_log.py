@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+An append-only, on-disk log of publishes that couldn't be delivered. Used by `pubsub` to store-and-forward
+messages while the leader is unreachable.
+
+The log is a directory of segment files, `00000000.log`, `00000001.log`, ..., plus a `cursor` file that records
+how far the log has been replayed. Segments that have been fully replayed are deleted.
+
+Each record is a fixed header followed by the topic and payload:
+
+    timestamp (float64) | qos (uint8) | retain (uint8) | topic length (uint16) | payload length (uint32) | topic | payload
+
+"""
+import os
+import struct
+from collections import namedtuple
+
+PublishRecord = namedtuple("PublishRecord", ["timestamp", "topic", "payload", "qos", "retain"])
+
+HEADER = struct.Struct("<dBBHI")
+
+
+def encode_payload(payload):
+    # mirrors how paho converts payloads to bytes
+    if payload is None:
+        return b""
+    elif isinstance(payload, bytes):
+        return payload
+    elif isinstance(payload, str):
+        return payload.encode("utf-8")
+    elif isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    else:
+        raise TypeError("payload must be a string, bytes, int, float or None.")
+
+
+class SegmentLog:
+    def __init__(self, directory, segment_bytes=1_000_000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        segments = self._list_segments()
+        self._read_segment, self._read_offset = self._read_cursor(segments)
+        self._write_segment = segments[-1] if segments else self._read_segment
+        self._write_offset = self._repair(self._write_segment)
+        self._file = None
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.log")
+
+    def _list_segments(self):
+        return sorted(int(f[:-4]) for f in os.listdir(self.directory) if f.endswith(".log"))
+
+    def _read_cursor(self, segments):
+        try:
+            with open(os.path.join(self.directory, "cursor")) as f:
+                segment, offset = map(int, f.read().split())
+            return segment, offset
+        except (FileNotFoundError, ValueError):
+            return (segments[0] if segments else 0), 0
+
+    def _write_cursor(self):
+        tmp = os.path.join(self.directory, "cursor.tmp")
+        with open(tmp, "w") as f:
+            f.write(f"{self._read_segment} {self._read_offset}")
+        os.replace(tmp, os.path.join(self.directory, "cursor"))
+
+    def _repair(self, segment):
+        """
+        A crash mid-append can leave a partial record at the end of the newest segment. Truncate it.
+        """
+        path = self._path(segment)
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            _, _, _, topic_length, payload_length = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + topic_length + payload_length
+            if end > len(data):
+                break
+            offset = end
+
+        if offset != len(data):
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        return offset
+
+    def has_pending(self):
+        return (self._read_segment, self._read_offset) != (self._write_segment, self._write_offset)
+
+    def append(self, record):
+        if self._write_offset >= self.segment_bytes:
+            self._rotate()
+        if self._file is None:
+            self._file = open(self._path(self._write_segment), "ab")
+
+        topic = record.topic.encode("utf-8")
+        payload = encode_payload(record.payload)
+        self._file.write(
+            HEADER.pack(record.timestamp, record.qos, int(record.retain), len(topic), len(payload)) + topic + payload
+        )
+        self._file.flush()
+        self._write_offset += HEADER.size + len(topic) + len(payload)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def _rotate(self):
+        self.close()
+        self._write_segment += 1
+        self._write_offset = 0
+
+    def read(self, max_records=100):
+        """
+        Returns up to `max_records` unreplayed records, in the order they were appended, along with the position
+        to `commit` once they have been delivered.
+        """
+        records = []
+        segment, offset = self._read_segment, self._read_offset
+
+        while len(records) < max_records and (segment, offset) != (self._write_segment, self._write_offset):
+            end_of_segment = self._write_offset if segment == self._write_segment else os.path.getsize(self._path(segment))
+            if offset >= end_of_segment:
+                segment, offset = segment + 1, 0
+                continue
+
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                while len(records) < max_records and offset < end_of_segment:
+                    timestamp, qos, retain, topic_length, payload_length = HEADER.unpack(f.read(HEADER.size))
+                    topic = f.read(topic_length).decode("utf-8")
+                    payload = f.read(payload_length)
+                    offset += HEADER.size + topic_length + payload_length
+                    records.append(((segment, offset), PublishRecord(timestamp, topic, payload, qos, bool(retain))))
+
+        if not records and (segment, offset) != (self._read_segment, self._read_offset):
+            # only skipped over the ends of segments, so move the cursor along.
+            self.commit((segment, offset))
+        return records
+
+    def commit(self, position):
+        """
+        Mark everything up to `position` (from `read`) as replayed, and delete segments that are no longer needed.
+        """
+        segment, offset = position
+        for old_segment in range(self._read_segment, segment):
+            try:
+                os.remove(self._path(old_segment))
+            except FileNotFoundError:
+                pass
+
+        self._read_segment, self._read_offset = segment, offset
+        self._write_cursor()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
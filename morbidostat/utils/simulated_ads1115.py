@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+An ADS1115 simulated at the register level, for running `InterleavedScanner` (and ODReader) without the hardware.
+It has the attributes of an adafruit_ads1x15 ADS1115 that the scanner uses: `gain`, `data_rate` and `i2c_device`.
+
+A conversion takes 1/data_rate after the config register is written, and each I2C transaction takes `i2c_time`,
+holding the bus, which the simulated chips share when given the same `bus` lock.
+
+    bus = threading.Lock()
+    adc = SimulatedADS1115({0: 0.3, 1: lambda: 0.2 + random.gauss(0, 0.001)}, bus=bus)
+"""
+import threading
+import time
+
+from morbidostat.utils.adc_scanner import _GAINS, _OS_SINGLE, _MODE_SINGLE, _CONFIG_REGISTER, _CONVERSION_REGISTER
+
+_DATA_RATE_BITS = {0x0000: 8, 0x0020: 16, 0x0040: 32, 0x0060: 64, 0x0080: 128, 0x00A0: 250, 0x00C0: 475, 0x00E0: 860}
+_GAIN_BITS = {bits: gain for (gain, (bits, _)) in _GAINS.items()}
+
+
+class SimulatedADS1115:
+    def __init__(self, voltages, gain=8, data_rate=128, address=0x48, bus=None, i2c_time=0.0002):
+        self.voltages = voltages  # input -> voltage, or a function returning one
+        self.gain = gain
+        self.data_rate = data_rate
+        self.address = address
+        self.i2c_device = _SimulatedI2CDevice(self, bus or threading.Lock(), i2c_time)
+        self.config = 0x8583  # power-on default: idle, single-shot
+        self.conversion_started = None
+        self.conversions = 0
+
+    def voltage(self, pin):
+        voltage = self.voltages[pin]
+        return voltage() if callable(voltage) else voltage
+
+    def write_config(self, config):
+        self.config = config
+        self.conversion_started = time.perf_counter()
+
+    def conversion_done(self):
+        period = 1 / _DATA_RATE_BITS[self.config & 0x00E0]
+        return self.conversion_started is None or time.perf_counter() - self.conversion_started >= period
+
+    def read_config(self):
+        if self.config & _MODE_SINGLE and self.conversion_done():
+            return self.config | _OS_SINGLE
+        return self.config & ~_OS_SINGLE
+
+    def read_conversion(self):
+        pin = (self.config >> 12) & 0x03
+        gain = _GAIN_BITS[self.config & 0x0E00]
+        full_scale = _GAINS[gain][1]
+        self.conversions += 1
+        raw = round(max(-full_scale, min(full_scale, self.voltage(pin))) / full_scale * 32768)
+        return max(-32768, min(32767, raw)) & 0xFFFF
+
+
+class _SimulatedI2CDevice:
+    def __init__(self, chip, bus, i2c_time):
+        self.chip = chip
+        self.bus = bus
+        self.i2c_time = i2c_time
+
+    def __enter__(self):
+        self.bus.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.bus.release()
+
+    def _transfer(self):
+        end = time.perf_counter() + self.i2c_time
+        while time.perf_counter() < end:
+            pass
+
+    def write(self, buffer):
+        self._transfer()
+        register, value = buffer[0], buffer[1] << 8 | buffer[2]
+        if register == _CONFIG_REGISTER:
+            self.chip.write_config(value)
+
+    def write_then_readinto(self, out_buffer, in_buffer):
+        self._transfer()
+        if out_buffer[0] not in (_CONFIG_REGISTER, _CONVERSION_REGISTER):
+            raise ValueError(f"Unknown register {out_buffer[0]}.")
+        value = self.chip.read_config() if out_buffer[0] == _CONFIG_REGISTER else self.chip.read_conversion()
+        in_buffer[0], in_buffer[1] = value >> 8, value & 0xFF
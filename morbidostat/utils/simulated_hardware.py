@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+A simulated worker: a growing culture, the OD sensors looking at it through simulated ADS1115s, and GPIO whose pumps
+dilute it. Selected with `[hardware] backend=simulated` (see morbidostat/hardware.py), it lets od_reading,
+growth_rate_calculating and io_controlling run, and be load tested, on any Linux box.
+
+- `Culture` grows logistically, at a rate that alt media (the morbidostat's drug) slows down.
+- Running a pump's PWM (`[rpi_pins]` media, alt_media, waste) for some seconds moves the volume of the pump's
+  calibration (`[pump_calibration]`): media and alt media dilute the culture, waste brings the volume back down.
+- `Sensor` turns the OD into the photodiode's voltage: backscatter (45, 90, 135) grows with OD, and flattens as
+  the culture gets dense; transmission (180) decays. Both have Gaussian noise, and are clipped to the op-amp's rails.
+
+The model lives in the process: pumps run by another process don't reach it. Run the jobs in one
+`mb worker_host` (ex: --job od_reading --job growth_rate_calculating --job io_controlling) to close the loop.
+Parameters are in `[simulation]`. `speedup` runs the culture faster than the wall clock.
+"""
+import math
+import random
+import threading
+import time
+from json import loads
+
+from morbidostat.config import config
+from morbidostat.utils import pump_duration_to_ml
+from morbidostat.utils.simulated_ads1115 import SimulatedADS1115
+
+VIAL_VOLUME = 14
+
+
+class Culture:
+    """
+    Parameters
+    -----------
+
+    initial_od: float
+    growth_rate: float
+        per hour, without alt media.
+    carrying_capacity: float
+        the OD the culture stops growing at.
+    alt_media_ic50: float
+        the fraction of alt media in the vial that halves the growth rate.
+    clock: function returning seconds, time.monotonic by default.
+    speedup: float
+        culture hours per wall clock hour.
+
+    """
+
+    def __init__(
+        self, initial_od=0.05, growth_rate=0.4, carrying_capacity=2.5, alt_media_ic50=0.1, clock=time.monotonic, speedup=1.0
+    ):
+        self.carrying_capacity = carrying_capacity
+        self.max_growth_rate = growth_rate
+        self.alt_media_ic50 = alt_media_ic50
+        self.clock = clock
+        self.speedup = speedup
+
+        self._lock = threading.Lock()
+        self._od = initial_od
+        self.volume = VIAL_VOLUME
+        self.alt_media_fraction = 0.0
+        self._last_time = clock()
+
+    @property
+    def growth_rate(self):
+        return self.max_growth_rate / (1 + self.alt_media_fraction / self.alt_media_ic50)
+
+    @property
+    def od(self):
+        with self._lock:
+            self._advance()
+            return self._od
+
+    def _advance(self):
+        now = self.clock()
+        hours = (now - self._last_time) * self.speedup / 3600
+        self._last_time = now
+        if hours <= 0:
+            return
+        # the logistic equation, solved over the interval.
+        K, growth = self.carrying_capacity, math.exp(self.growth_rate * hours)
+        self._od = K * self._od * growth / (K + self._od * (growth - 1))
+
+    def add(self, ml, alt_media=False):
+        with self._lock:
+            self._advance()
+            self._od *= self.volume / (self.volume + ml)
+            alt_media_ml = self.alt_media_fraction * self.volume + (ml if alt_media else 0)
+            self.volume += ml
+            self.alt_media_fraction = alt_media_ml / self.volume
+
+    def remove(self, ml):
+        # the waste tube can't draw the vial below its own height.
+        with self._lock:
+            self._advance()
+            self.volume = max(VIAL_VOLUME, self.volume - ml)
+
+
+class Sensor:
+    """
+    The voltage of an OD sensor at `angle` looking at `culture`.
+    """
+
+    # volts per unit OD of a dilute culture. Sensors closer to the LED see more light.
+    RESPONSES = {"45": 0.15, "90": 0.25, "135": 0.5}
+
+    def __init__(self, culture, angle, noise=0.002, saturation_od=3.0, blank=0.01, max_voltage=3.3, rng=random):
+        self.culture = culture
+        self.angle = angle
+        self.noise = noise
+        self.saturation_od = saturation_od
+        self.blank = blank
+        self.max_voltage = max_voltage
+        self.rng = rng
+
+    def __call__(self):
+        od = self.culture.od
+        if self.angle == "180":
+            voltage = 2.0 * math.exp(-od)
+        else:
+            voltage = self.blank + self.RESPONSES.get(self.angle, 0.5) * od / (1 + od / self.saturation_od)
+        return min(self.max_voltage, max(0.0, voltage + self.rng.gauss(0, self.noise)))
+
+
+class SimulatedPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+        self._started = None
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self._started = time.monotonic()
+
+    def ChangeDutyCycle(self, duty_cycle):
+        if self._started is not None:
+            self._ran()
+            self._started = time.monotonic()
+        self.duty_cycle = duty_cycle
+
+    def stop(self):
+        if self._started is not None:
+            self._ran()
+        self._started = None
+
+    def _ran(self):
+        self.gpio.pin_ran(self.pin, time.monotonic() - self._started, self.duty_cycle)
+
+
+class SimulatedGPIO:
+    """
+    The parts of RPi.GPIO the jobs use. PWM runs on the pump pins are passed to `culture`.
+    """
+
+    BCM, BOARD = 11, 10
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+
+    def __init__(self, culture, unit):
+        self.culture = culture
+        self.unit = unit
+        self.mode = None
+        self.outputs = {}  # pin -> level
+        self.pumps = {int(config["rpi_pins"][pump]): pump for pump in ["media", "alt_media", "waste"]}
+        self.pumped_ml = {pump: 0.0 for pump in self.pumps.values()}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, **kwargs):
+        self.outputs.setdefault(pin, self.LOW)
+
+    def output(self, pin, level):
+        self.outputs[pin] = level
+
+    def PWM(self, pin, frequency):
+        return SimulatedPWM(self, pin, frequency)
+
+    def cleanup(self, pin=None):
+        pass
+
+    def pin_ran(self, pin, duration, duty_cycle):
+        if pin not in self.pumps:
+            return
+        pump = self.pumps[pin]
+        calibration = config["pump_calibration"].get(f"{pump}{self.unit}_ml_calibration", '{"duration_": 1}')
+        ml = pump_duration_to_ml(duration, duty_cycle, **loads(calibration))
+        self.pumped_ml[pump] += ml
+        if pump == "waste":
+            self.culture.remove(ml)
+        else:
+            self.culture.add(ml, alt_media=pump == "alt_media")
+
+
+def create_culture(section=None):
+    section = section or config["simulation"]
+    return Culture(
+        initial_od=float(section.get("initial_od", 0.05)),
+        growth_rate=float(section.get("growth_rate", 0.4)),
+        carrying_capacity=float(section.get("carrying_capacity", 2.5)),
+        alt_media_ic50=float(section.get("alt_media_ic50", 0.1)),
+        speedup=float(section.get("speedup", 1.0)),
+    )
+
+
+def create_adcs(culture, channels, gain=8, noise=0.002):
+    """
+    {i2c address: SimulatedADS1115} for `channels`, {label: (i2c address, input)}, the labels starting with the
+    angle of the sensor on that input (ex: "135/A"). The ADCs share a bus.
+    """
+    bus = threading.Lock()
+    voltages = {}
+    for (label, (address, pin)) in channels.items():
+        voltages.setdefault(address, {})[pin] = Sensor(culture, label.split("/")[0], noise=noise)
+    return {address: SimulatedADS1115(inputs, gain=gain, address=address, bus=bus) for (address, inputs) in voltages.items()}
@@ -1,34 +1,272 @@
 # -*- coding: utf-8 -*-
 from statistics import *
+from collections import deque
 import json
 
 import numpy as np
 from simple_pid import PID as simple_PID
 
+try:
+    from scipy.linalg.lapack import dpotrf, dpotrs
+except ImportError:
+    # scipy is optional on workers: solve by LU instead of Cholesky.
+    dpotrf = dpotrs = None
+
 
 class MovingStats:
+    """
+    Mean, std, max and min of the last `lookback` values, each updated in constant time: the sums are kept
+    running, and the max and min in monotonic queues. The statistics are None until `lookback` values were seen.
+    For many channels at once, or quantiles, see RollingWindow's subclasses.
+    """
+
     def __init__(self, lookback=5):
-        self.values = [None] * lookback
+        self.values = deque(maxlen=lookback)
         self._lookback = lookback
+        self._shift = None  # the sums are of values minus the first value, so the variance doesn't lose precision.
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self._maxes = deque()  # (index, value), values decreasing
+        self._mins = deque()  # (index, value), values increasing
+        self._count = 0
 
     def update(self, new_value):
-        self.values.pop(0)
+        if self._shift is None:
+            self._shift = new_value
+        if len(self.values) == self._lookback:
+            old = self.values[0] - self._shift
+            self._sum -= old
+            self._sum_sq -= old * old
         self.values.append(new_value)
-        assert len(self.values) == self._lookback
+        new = new_value - self._shift
+        self._sum += new
+        self._sum_sq += new * new
+
+        # a value can't be the max (min) while a larger (smaller) value newer than it is in the window.
+        oldest = self._count - self._lookback
+        while self._maxes and self._maxes[-1][1] <= new_value:
+            self._maxes.pop()
+        self._maxes.append((self._count, new_value))
+        if self._maxes[0][0] <= oldest:
+            self._maxes.popleft()
+        while self._mins and self._mins[-1][1] >= new_value:
+            self._mins.pop()
+        self._mins.append((self._count, new_value))
+        if self._mins[0][0] <= oldest:
+            self._mins.popleft()
+        self._count += 1
+
+    @property
+    def full(self):
+        return len(self.values) == self._lookback
+
+    @property
+    def mean(self):
+        if self.full:
+            return self._shift + self._sum / self._lookback
+
+    @property
+    def std(self):
+        if self.full and self._lookback > 1:
+            n = self._lookback
+            return max(0.0, (self._sum_sq - self._sum * self._sum / n) / (n - 1)) ** 0.5
+
+    @property
+    def max(self):
+        if self.full:
+            return self._maxes[0][1]
+
+    @property
+    def min(self):
+        if self.full:
+            return self._mins[0][1]
+
+
+class RollingWindow:
+    """
+    The last `window` values of one channel, or of `channels` channels at once, in a preallocated NumPy ring buffer.
+    With `channels=None`, `update` takes a number and the statistics are numbers; otherwise `update` takes a sequence
+    of `channels` values and the statistics are arrays. The statistics are None until `min_periods` (by default,
+    `window`) values were seen, and are then of the values seen so far, up to `window` of them.
+    """
+
+    def __init__(self, window, channels=None, min_periods=None):
+        self.window = window
+        self.scalar = channels is None
+        self.channels = 1 if channels is None else channels
+        self.min_periods = window if min_periods is None else min_periods
+        if not 1 <= self.min_periods <= window:
+            raise ValueError("min_periods must be between 1 and window.")
+        self.buffer = np.zeros((window, self.channels))
+        self.count = 0
+
+    @property
+    def n(self):
+        # the number of values in the window
+        return min(self.count, self.window)
+
+    @property
+    def ready(self):
+        return self.count >= self.min_periods
+
+    @property
+    def full(self):
+        return self.count >= self.window
+
+    def update(self, values):
+        new = np.asarray(values, dtype=float).reshape(self.channels)
+        row = self.count % self.window
+        old = self.buffer[row].copy() if self.full else None
+        self.buffer[row] = new
+        self.count += 1
+        self._update(new, old)
+
+    def _update(self, new, old):
+        pass
+
+    @property
+    def values(self):
+        """
+        The values in the window, oldest first: (n,) for one channel, (n, channels) for several.
+        """
+        row = self.count % self.window
+        values = np.concatenate([self.buffer[row:], self.buffer[:row]]) if self.full else self.buffer[: self.count]
+        return values[:, 0] if self.scalar else values
+
+    def _result(self, array):
+        if not self.ready:
+            return None
+        return float(array[0]) if self.scalar else array.copy()
+
+
+class RollingMeanVar(RollingWindow):
+    """
+    Rolling mean and (sample) variance, by Welford's algorithm, which also removes the value leaving the window:
+    constant time per update, and without the cancellation of running sums of squares.
+    """
+
+    def __init__(self, window, channels=None, min_periods=None):
+        super(RollingMeanVar, self).__init__(window, channels, min_periods)
+        self._mean = np.zeros(self.channels)
+        self._m2 = np.zeros(self.channels)  # the sum of squared deviations from the mean
+
+    def _update(self, new, old):
+        if old is None:
+            delta = new - self._mean
+            self._mean += delta / self.n
+            self._m2 += delta * (new - self._mean)
+        else:
+            mean = self._mean + (new - old) / self.window
+            self._m2 += (new - old) * (new - mean + old - self._mean)
+            self._mean = mean
 
     @property
     def mean(self):
-        try:
-            return mean(self.values)
-        except:
-            pass
+        return self._result(self._mean)
+
+    @property
+    def variance(self):
+        # rounding can take the sum of squares a hair below 0 when the window is constant.
+        if self.n > 1:
+            return self._result(np.maximum(self._m2, 0.0) / (self.n - 1))
 
     @property
     def std(self):
-        try:
-            return stdev(self.values)
-        except:
-            pass
+        if self.n > 1:
+            return self._result(np.sqrt(np.maximum(self._m2, 0.0) / (self.n - 1)))
+
+
+class RollingQuantiles(RollingWindow):
+    """
+    Rolling median, quantiles, max and min, from each channel's window kept sorted. An update finds the old value
+    and the place of the new one by binary search, and shifts the values between them in place: O(log window) to
+    search, and a memmove of at most the window. Quantiles interpolate linearly, like `numpy.quantile`.
+    """
+
+    def __init__(self, window, channels=None, min_periods=None):
+        super(RollingQuantiles, self).__init__(window, channels, min_periods)
+        # a row per channel. Empty slots are +inf, so they stay at the end.
+        self._sorted = np.full((self.channels, window), np.inf)
+
+    def _update(self, new, old):
+        for (c, column) in enumerate(self._sorted):
+            # the old value's slot, or while the window fills, the first empty one
+            removed = column.searchsorted(old[c]) if old is not None else self.n - 1
+            inserted = column.searchsorted(new[c])
+            if inserted <= removed:
+                column[inserted + 1 : removed + 1] = column[inserted:removed]
+            else:
+                inserted -= 1
+                column[removed:inserted] = column[removed + 1 : inserted + 1]
+            column[inserted] = new[c]
+
+    def quantile(self, q):
+        n = self.n
+        position = q * (n - 1)
+        low = int(position)
+        high = min(low + 1, n - 1)
+        S = self._sorted
+        return self._result(S[:, low] + (S[:, high] - S[:, low]) * (position - low))
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    @property
+    def max(self):
+        return self._result(self._sorted[:, self.n - 1])
+
+    @property
+    def min(self):
+        return self._result(self._sorted[:, 0])
+
+
+class EWMA:
+    """
+    Exponentially weighted mean and variance, of one channel or `channels` at once (like RollingWindow). Give
+    `alpha`, the weight of a new value, or `halflife`, the number of updates after which a value's weight has
+    halved. The first value starts the mean; the statistics are None until `min_periods` values were seen.
+    """
+
+    def __init__(self, alpha=None, halflife=None, channels=None, min_periods=1):
+        if (alpha is None) == (halflife is None):
+            raise ValueError("give one of alpha or halflife.")
+        self.alpha = alpha if alpha is not None else 1 - 0.5 ** (1 / halflife)
+        self.scalar = channels is None
+        self.channels = 1 if channels is None else channels
+        self.min_periods = min_periods
+        self.count = 0
+        self._mean = np.zeros(self.channels)
+        self._variance = np.zeros(self.channels)
+
+    @property
+    def ready(self):
+        return self.count >= self.min_periods
+
+    def update(self, values):
+        new = np.asarray(values, dtype=float).reshape(self.channels)
+        if self.count == 0:
+            self._mean[:] = new
+        else:
+            delta = new - self._mean
+            increment = self.alpha * delta
+            self._mean += increment
+            self._variance = (1 - self.alpha) * (self._variance + delta * increment)
+        self.count += 1
+
+    _result = RollingWindow._result
+
+    @property
+    def mean(self):
+        return self._result(self._mean)
+
+    @property
+    def variance(self):
+        return self._result(self._variance)
+
+    @property
+    def std(self):
+        return self._result(np.sqrt(self._variance))
 
 
 class LowPassFilter:
@@ -85,8 +323,9 @@ class ExtendedKalmanFilter:
 
         self.process_noise_covariance = process_noise_covariance
         self.observation_noise_covariance = observation_noise_covariance
-        self.state_ = initial_state
-        self.covariance_ = initial_covariance
+        # updated in place
+        self.state_ = np.array(initial_state, dtype=float)
+        self.covariance_ = np.array(initial_covariance, dtype=float)
         self.dim = self.state_.shape[0]
 
         self._OD_scale_counter = -1
@@ -97,21 +336,99 @@ class ExtendedKalmanFilter:
         self._original_rate_noise_variance = self.process_noise_covariance[-1, -1]
         self._original_observation_noise_covariance = self.observation_noise_covariance.copy()
 
+        # work arrays, so an update doesn't allocate. LAPACK works in place on Fortran ordered arrays.
+        d, m = self.dim, self.dim - 1
+        self._identity = np.eye(d)
+        self._F = np.eye(d)  # the process's Jacobian
+        self._F_diagonal = self._F.reshape(-1)[:: d + 1]
+        self._I_KH = np.eye(d)  # its last column stays [0, ..., 0, 1]
+        self._state_prediction = np.empty(d)
+        self._covariance_prediction = np.empty((d, d))
+        self._residual = np.empty(m)
+        self._residual_covariance = np.empty((m, m), order="F")
+        self._gain_T = np.empty((m, d), order="F")  # the Kalman gain, transposed
+        self._KR = np.empty((d, m))
+        self._dd = np.empty((d, d))
+
     def predict(self):
+        """
+        The dense prediction: (state, covariance). `update` computes the same from the structure of the Jacobian.
+        """
         return (self._predict_state(self.state_, self.covariance_), self._predict_covariance(self.state_, self.covariance_))
 
     def update(self, observation):
+        """
+        The Jacobian of the process is F = [[r I, ODs], [0, 1]], and the ODs are observed directly, H = [I | 0], so:
+
+        - F is kept between updates, and only its diagonal and last column change.
+        - H P' H^T is the ODs' block of P', and P' H^T its first columns: no products with H.
+        - the gain K = P' H^T S^-1 is solved for with the Cholesky factor of S = H P' H^T + R, not an inverse.
+        - the covariance is updated in Joseph form, (I - K H) P' (I - K H)^T + K R K^T, which stays symmetric
+          and positive definite despite rounding.
+
+        The products are written to arrays allocated once, in __init__.
+        """
         observation = np.asarray(observation)
         self.update_counters()
         assert observation.shape[0] + 1 == self.state_.shape[0]
-        state_prediction, covariance_prediction = self.predict()
-        residual_state = observation - state_prediction[:-1]
-        H = self._jacobian_observation()
-        residual_covariance = H @ covariance_prediction @ H.T + self.observation_noise_covariance
-        kalman_gain = covariance_prediction @ H.T @ np.linalg.inv(residual_covariance)
-        self.state_ = state_prediction + kalman_gain @ residual_state
-        self.covariance_ = (np.eye(self.dim) - kalman_gain @ H) @ covariance_prediction
-        return
+
+        m = self.dim - 1
+        x, P, R = self.state_, self.covariance_, self.observation_noise_covariance
+        F, P_, x_ = self._F, self._covariance_prediction, self._state_prediction
+
+        self._F_diagonal[:m] = x[m]
+        F[:m, m] = x[:m]
+        np.multiply(x, x[m], out=x_)
+        x_[m] = x[m]
+        np.matmul(F, P, out=self._dd)
+        np.matmul(self._dd, F.T, out=P_)
+        P_ += self.process_noise_covariance
+
+        np.add(P_[:m, :m], R, out=self._residual_covariance)
+        self._gain_T[...] = P_[:m]
+        self._solve_residual_covariance(self._residual_covariance, self._gain_T)
+        K = self._gain_T.T
+
+        np.subtract(observation, x_[:m], out=self._residual)
+        np.matmul(self._residual, self._gain_T, out=x)
+        x += x_
+
+        I_KH = self._I_KH
+        np.subtract(self._identity[:, :m], K, out=I_KH[:, :m])
+        np.matmul(I_KH, P_, out=self._dd)
+        np.matmul(self._dd, I_KH.T, out=P)
+        np.matmul(K, R, out=self._KR)
+        np.matmul(self._KR, self._gain_T, out=self._dd)
+        P += self._dd
+
+    @property
+    def predicted_state_(self):
+        # the last update's prediction, before its observation. Overwritten by the next update.
+        return self._state_prediction
+
+    @property
+    def predicted_covariance_(self):
+        return self._covariance_prediction
+
+    @property
+    def jacobian_(self):
+        # the Jacobian of the last update's prediction.
+        return self._F
+
+    @staticmethod
+    def _solve_residual_covariance(S, B):
+        """
+        B <- S^-1 B, in place, for S symmetric positive definite. Overwrites S.
+        """
+        if dpotrf is None:
+            B[...] = np.linalg.solve(S, B)
+            return
+        factor, info = dpotrf(S, lower=1, clean=0, overwrite_a=1)
+        if info != 0:
+            raise np.linalg.LinAlgError("the residual covariance isn't positive definite.")
+        solution, info = dpotrs(factor, B, lower=1, overwrite_b=1)
+        if solution is not B:
+            B[...] = solution
 
     def scale_OD_variance_for_next_n_steps(self, factor, n):
         d = self.dim
@@ -165,7 +482,7 @@ class ExtendedKalmanFilter:
         ODs = state[:-1]
 
         J[np.arange(d - 1), np.arange(d - 1)] = rate
-        J[np.arange(d - 1), np.arange(1, d)] = ODs
+        J[:-1, -1] = ODs
         J[-1, -1] = 1.0
 
         return J
@@ -188,17 +505,182 @@ class ExtendedKalmanFilter:
             return False
 
 
+class ExtendedKalmanFilterBank:
+    """
+    The `ExtendedKalmanFilter`s of many units with the same number of sensors, held as stacked arrays: states (N, d),
+    covariances (N, d, d), and their noise covariances. `update` updates any subset of the units in one set of
+    batched NumPy calls, so the cost per observation doesn't grow with N (it shrinks, as more units share a call).
+
+    Units are added and removed by key (ex: the unit's name). Rows are kept dense: removing a unit moves the last one
+    into its row, and the arrays double when they're full.
+
+        bank = ExtendedKalmanFilterBank(n_sensors=2)
+        bank.add("morbidostat1", initial_state, initial_covariance, process_noise_covariance, observation_noise_covariance)
+        ...
+        bank.update(["morbidostat1", "morbidostat3"], observations)  # an (2, n_sensors) array
+        bank.state("morbidostat1")
+
+    """
+
+    def __init__(self, n_sensors, capacity=8):
+        self.n_sensors = n_sensors
+        self.dim = n_sensors + 1
+        self.keys = []  # the unit in each row
+        self._rows = {}
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        d, m, n = self.dim, self.n_sensors, len(self.keys)
+        arrays = {
+            "_states": np.empty((capacity, d)),
+            "_covariances": np.empty((capacity, d, d)),
+            "_process_noise": np.empty((capacity, d, d)),
+            "_observation_noise": np.empty((capacity, m, m)),
+            "_original_OD_variance": np.empty((capacity, m)),
+            "_OD_scale_counter": np.empty(capacity, dtype=int),
+        }
+        for (name, array) in arrays.items():
+            if n:
+                array[:n] = getattr(self, name)[:n]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    @property
+    def states(self):
+        """
+        The states of all the units, in the order of `keys`. A view.
+        """
+        return self._states[: len(self.keys)]
+
+    def state(self, key):
+        return self._states[self._rows[key]].copy()
+
+    def covariance(self, key):
+        return self._covariances[self._rows[key]].copy()
+
+    def add(self, key, initial_state, initial_covariance, process_noise_covariance, observation_noise_covariance):
+        """
+        Start filtering `key`, with the arguments of `ExtendedKalmanFilter`.
+        """
+        d, m = self.dim, self.n_sensors
+        if key in self._rows:
+            raise ValueError(f"{key} is already in the bank.")
+        assert np.shape(initial_state) == (d,) and np.shape(initial_covariance) == np.shape(process_noise_covariance) == (d, d)
+        assert np.shape(observation_noise_covariance) == (m, m)
+        assert ExtendedKalmanFilter._is_positive_definite(process_noise_covariance)
+        assert ExtendedKalmanFilter._is_positive_definite(initial_covariance)
+        assert ExtendedKalmanFilter._is_positive_definite(observation_noise_covariance)
+
+        if len(self.keys) == self.capacity:
+            self._allocate(2 * self.capacity)
+
+        row = len(self.keys)
+        self._states[row] = initial_state
+        self._covariances[row] = initial_covariance
+        self._process_noise[row] = process_noise_covariance
+        self._observation_noise[row] = observation_noise_covariance
+        self._original_OD_variance[row] = np.diag(process_noise_covariance)[:m]
+        self._OD_scale_counter[row] = -1
+        self.keys.append(key)
+        self._rows[key] = row
+
+    def remove(self, key):
+        row, last = self._rows.pop(key), len(self.keys) - 1
+        if row != last:
+            for array in (
+                self._states,
+                self._covariances,
+                self._process_noise,
+                self._observation_noise,
+                self._original_OD_variance,
+                self._OD_scale_counter,
+            ):
+                array[row] = array[last]
+            self.keys[row] = self.keys[last]
+            self._rows[self.keys[row]] = row
+        self.keys.pop()
+
+    def scale_OD_variance_for_next_n_steps(self, key, factor, n):
+        row, diagonal = self._rows[key], np.arange(self.n_sensors)
+        self._OD_scale_counter[row] = n
+        self._process_noise[row, diagonal, diagonal] = factor * self._original_OD_variance[row]
+
+    def _update_counters(self, rows):
+        # as ExtendedKalmanFilter.update_counters, for the units being updated.
+        restore = rows[self._OD_scale_counter[rows] == 0]
+        if restore.size:
+            diagonal = np.arange(self.n_sensors)
+            self._process_noise[restore[:, None], diagonal, diagonal] = self._original_OD_variance[restore]
+        self._OD_scale_counter[rows] -= 1
+
+    def update(self, keys, observations):
+        """
+        One step of the filters of `keys` (distinct), given their `observations`, an array (len(keys), n_sensors).
+
+        The same structured update as `ExtendedKalmanFilter.update`, over a batch of units: (k, d, d) products with
+        np.matmul, and the gain from a batched LU solve (NumPy has no batched triangular solve, and at these sizes
+        the two cost the same). The units' rows are gathered into contiguous arrays, and written back.
+        """
+        rows = np.fromiter((self._rows[key] for key in keys), dtype=int, count=len(keys))
+        k, d, m = rows.shape[0], self.dim, self.n_sensors
+        observations = np.asarray(observations, dtype=float).reshape(k, m)
+        self._update_counters(rows)
+
+        x, P = self._states[rows], self._covariances[rows]
+        rate = x[:, m:]
+
+        F = np.zeros((k, d, d))
+        F_diagonal = F.reshape(k, -1)[:, :: d + 1]
+        F_diagonal[...] = rate
+        F_diagonal[:, m] = 1.0
+        F[:, :m, m] = x[:, :m]
+
+        x_ = x * rate
+        x_[:, m] = rate[:, 0]
+        P_ = F @ P @ F.transpose(0, 2, 1)
+        P_ += self._process_noise[rows]
+
+        R = self._observation_noise[rows]
+        gain_T = np.linalg.solve(P_[:, :m, :m] + R, P_[:, :m])  # (k, m, d), the gains transposed
+        K = gain_T.transpose(0, 2, 1)
+
+        residual = observations - x_[:, :m]
+        self._states[rows] = x_ + (residual[:, None, :] @ gain_T)[:, 0]
+
+        I_KH = np.zeros((k, d, d))
+        I_KH[...] = np.eye(d)
+        I_KH[:, :, :m] -= K
+        P = I_KH @ P_ @ I_KH.transpose(0, 2, 1)
+        P += K @ R @ gain_T
+        self._covariances[rows] = P
+
+
 class PID:
     # used in io_controlling classes
 
     def __init__(self, *args, unit=None, experiment=None, verbose=0, **kwargs):
 
-        from morbidostat.whoami import unit, experiment
+        from morbidostat import whoami
 
         self.pid = simple_PID(*args, **kwargs)
-        self.unit = unit
-        self.experiment = experiment
+        self.unit = unit or whoami.unit
         self.verbose = verbose
+        self.set_experiment(experiment or whoami.experiment)
+
+    def set_experiment(self, experiment):
+        from morbidostat.config import config
+        from morbidostat.pubsub import set_publish_policy
+
+        self.experiment = experiment
+        set_publish_policy(
+            f"morbidostat/{self.unit}/{self.experiment}/pid_log", max_rate=float(config["pubsub"]["max_stream_rate"])
+        )
 
     def set_setpoint(self, new_setpoint):
         self.pid.setpoint = new_setpoint
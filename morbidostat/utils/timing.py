@@ -1,29 +1,400 @@
 # -*- coding: utf-8 -*-
-import time, traceback, sys
+"""
+Periodic tasks, on a clock that NTP doesn't move: a Pi without an RTC jumps its wall clock when it syncs.
 
+    scheduler = Scheduler()
+    scheduler.add(reader.take_reading, 5, pass_counter=True, stats=reader.stats)
+    scheduler.add(publish_summary, 60, offset=2.5, priority=1)
+    scheduler.start()  # or scheduler.run() to run them in this thread
 
-def every(delay, task, *args, **kwargs):
+A task's runs are due at `start + offset + k * period`, so a late or slow run doesn't push back the ones after it.
+Runs more than a period behind schedule are skipped, not run back to back. Due runs start in order of due time, then
+priority (lower first). Each task's TaskStats has its jitter (how late runs started), its overruns (runs that took
+longer than the period) and its skipped runs.
+
+The clock is `MonotonicClock` by default. A `VirtualClock` moves forward at once when the scheduler waits on it, so
+tests and simulations run as fast as their tasks do. `AsyncBackgroundJob.every` keeps the same schedule (`catch_up`),
+on the same clocks, on an asyncio loop.
+"""
+import asyncio
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+
+class TaskStats:
     """
-    Executing `task` once initially, and then every `delay` seconds later.
+    The runs of a periodic task: how late they started (jitter), how long they took, the runs that took longer
+    than the period (overruns), and the runs skipped because the task was behind schedule.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.jitter_last = 0.0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+
+    def record(self, jitter, duration, overrun=False, skipped=0):
+        """
+        A run started `jitter` seconds late that took `duration` seconds, or that didn't start (duration None)
+        because the previous one was still going.
+        """
+        with self._lock:
+            self.skipped += skipped
+            self.overruns += overrun
+            if duration is None:
+                return
+            self.runs += 1
+            self.jitter_total += jitter
+            self.jitter_last = jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+            self.duration_total += duration
+            self.duration_max = max(self.duration_max, duration)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "count": self.runs,
+                "skipped": self.skipped,
+                "overruns": self.overruns,
+                "jitter_mean_ms": round(self.jitter_total / self.runs * 1000, 3) if self.runs else None,
+                "jitter_max_ms": round(self.jitter_max * 1000, 3),
+                "jitter_last_ms": round(self.jitter_last * 1000, 3),
+                "duration_mean_ms": round(self.duration_total / self.runs * 1000, 3) if self.runs else None,
+                "duration_max_ms": round(self.duration_max * 1000, 3),
+            }
+
+
+class MonotonicClock:
+    def now(self):
+        return time.monotonic()
 
-    Yields the result back to the caller.
+    def wait(self, event, timeout):
+        """
+        Wait until `event` is set, or `timeout` seconds (None: forever) have passed. Returns whether it was set.
+        """
+        return event.wait(timeout)
 
-    from https://stackoverflow.com/questions/474528/what-is-the-best-way-to-repeatedly-execute-a-function-every-x-seconds
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def __call__(self):
+        return self.now()
+
+
+class VirtualClock(MonotonicClock):
     """
-    next_time = time.time() + delay
-    counter = 0
-    while True:
+    A clock that only moves when told to, or when waited on. `clock()` is its time, so it can drive other
+    models, ex: `simulated_hardware.Culture(clock=clock)`.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += max(0.0, seconds)
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        if timeout is None:
+            return event.wait()
+        # nothing can happen in the meantime: skip to the end of the wait.
+        self.advance(timeout)
+        return event.is_set()
+
+    async def sleep(self, seconds):
+        # let the loop's other tasks run, but don't wait.
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+
+def catch_up(due, start, period):
+    """
+    For a run due at `due` that starts at `start`: the runs more than a period behind are skipped. Returns the time
+    the run is due at after skipping, how late it starts (the jitter, under a period), and how many were skipped.
+    """
+    skipped = int((start - due) // period)
+    due += skipped * period
+    return due, start - due, skipped
+
+
+class Task:
+    def __init__(self, function, period, offset, priority, name, args, kwargs, pass_counter, stats, job_stats, thread, on_error):
+        self.function = function
+        self.period = period
+        self.offset = offset
+        self.priority = priority
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.pass_counter = pass_counter
+        self.stats = stats
+        self.job_stats = job_stats
+        self.thread = thread
+        self.on_error = on_error
+
+        self.counter = 0
+        self.next_time = None
+        self.cancelled = False
+        self._running = None  # the thread of a `thread=True` run that hasn't finished
+
+    def __repr__(self):
+        return f"Task({self.name!r}, period={self.period})"
+
+    def call(self):
+        self.counter += 1
+        if self.pass_counter:
+            return self.function(*self.args, counter=self.counter, **self.kwargs)
+        return self.function(*self.args, **self.kwargs)
+
+    @property
+    def is_running(self):
+        return self._running is not None and self._running.is_alive()
+
+    def join(self, timeout=None):
+        """
+        Wait for a run in a thread of its own (`thread=True`) to finish.
+        """
+        running = self._running
+        if running is not None and running is not threading.current_thread():
+            running.join(timeout)
+
+
+class Scheduler:
+    """
+    Runs periodic tasks in one thread (`run` or `start`), or one run at a time (`run_next`, `run_pending`).
+
+    Parameters
+    -----------
+    clock: MonotonicClock (default) or VirtualClock
+    name: the name of the thread `start` runs the tasks in.
+    """
+
+    def __init__(self, clock=None, name="scheduler"):
+        self.clock = clock or MonotonicClock()
+        self.name = name
+        self.tasks = []
+        self._queue = []  # (due time, priority, sequence, task)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(
+        self,
+        function,
+        period,
+        offset=0.0,
+        priority=0,
+        name=None,
+        args=(),
+        kwargs=None,
+        pass_counter=False,
+        stats=None,
+        thread=False,
+        on_error=None,
+    ):
+        """
+        Run `function(*args, **kwargs)` every `period` seconds, the first time `offset` seconds from now.
+
+        pass_counter: also pass `counter`, the number of the run (from 1).
+        stats: a job's JobStats: runs are recorded in its ticks, and in its task `name`.
+        thread: run in a thread of its own, for tasks that wait (ex: on a pump), so that they don't delay the
+            others. A run due while the previous one is still going is skipped, as an overrun.
+        on_error: called with (task, exception) when a run raises, instead of logging the traceback.
+
+        Returns the Task, whose `stats` is its TaskStats.
+        """
+        name = name or getattr(function, "__name__", type(function).__name__)
+        task = Task(
+            function,
+            period,
+            offset,
+            priority,
+            name,
+            tuple(args),
+            dict(kwargs or {}),
+            pass_counter,
+            stats.task(name) if stats is not None else TaskStats(),
+            stats,
+            thread,
+            on_error,
+        )
+        with self._lock:
+            self.tasks.append(task)
+            self._push(task, self.clock.now() + offset)
+        self._wakeup.set()
+        return task
+
+    def cancel(self, task):
+        with self._lock:
+            task.cancelled = True
+            if task in self.tasks:
+                self.tasks.remove(task)
+        self._wakeup.set()
+
+    def _push(self, task, due):
+        task.next_time = due
+        heapq.heappush(self._queue, (due, task.priority, next(self._sequence), task))
+
+    def time_to_next(self):
+        """
+        Seconds until the next run is due (0 if one is late), or None if there are no tasks.
+        """
+        with self._lock:
+            while self._queue and self._queue[0][3].cancelled:
+                heapq.heappop(self._queue)
+            if not self._queue:
+                return None
+            return max(0.0, self._queue[0][0] - self.clock.now())
+
+    def _pop_due(self, now):
+        with self._lock:
+            while self._queue:
+                due, _, _, task = self._queue[0]
+                if task.cancelled:
+                    heapq.heappop(self._queue)
+                elif due <= now:
+                    heapq.heappop(self._queue)
+                    return (due, task)
+                else:
+                    return None
+            return None
+
+    def run_pending(self):
+        """
+        Run the tasks that are due. Errors go to the tasks' `on_error`, or are logged.
+        """
+        now = self.clock.now()
+        while not self._stopped.is_set():
+            due_task = self._pop_due(now)
+            if due_task is None:
+                return
+            self._run_handling_errors(*due_task)
+
+    def run_next(self):
+        """
+        Wait for the next run that is due, and run it. Returns (task, what it returned), or None if there are no
+        tasks or the scheduler was stopped. Errors are raised.
+        """
+        while not self._stopped.is_set():
+            # cleared before looking at the queue, so a task added meanwhile still cuts the wait short.
+            self._wakeup.clear()
+            wait = self.time_to_next()
+            if wait is None:
+                return None
+            if wait > 0 and self.clock.wait(self._wakeup, wait):
+                # a task was added or cancelled, or we were stopped
+                continue
+            due_task = self._pop_due(self.clock.now())
+            if due_task is not None:
+                return (due_task[1], self._run(*due_task))
+        return None
+
+    def run(self, until=None):
+        """
+        Run the tasks in this thread until `stop` is called (or the clock reaches `until`).
+        """
+        while not self._stopped.is_set():
+            if until is not None and self.clock.now() >= until:
+                return
+            self._wakeup.clear()
+            wait = self.time_to_next()
+            if until is not None:
+                wait = min(wait, until - self.clock.now()) if wait is not None else until - self.clock.now()
+            if wait is None or wait > 0:
+                # add, cancel and stop set _wakeup, which cuts the wait short.
+                self.clock.wait(self._wakeup, wait)
+                continue
+            self.run_pending()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _run_handling_errors(self, due, task):
         try:
-            counter += 1
-            kwargs["counter"] = counter
-            yield task(*args, **kwargs)
+            self._run(due, task)
         except Exception as e:
-            raise e
-            # in production code you might want to have this instead of course:
-            # logger.exception("Problem while executing repetitive task.")
-        if "pytest" in sys.modules:
-            time.sleep(0)
+            self._on_error(task, e)
+
+    def _on_error(self, task, e):
+        if task.on_error is not None:
+            task.on_error(task, e)
         else:
-            time.sleep(max(0, next_time - time.time()))
-        # skip tasks if we are behind schedule:
-        next_time += (time.time() - next_time) // delay * delay + delay
+            traceback.print_exc()
+
+    def _run(self, due, task):
+        start = self.clock.now()
+        due, jitter, skipped = catch_up(due, start, task.period)
+
+        with self._lock:
+            if not task.cancelled:
+                self._push(task, due + task.period)
+
+        if task.thread and task.is_running:
+            task.stats.record(jitter, None, overrun=True, skipped=skipped + 1)
+            return None
+
+        if task.job_stats is not None:
+            task.job_stats.record_tick(jitter, skipped)
+
+        if task.thread:
+            task._running = threading.Thread(target=self._run_in_thread, args=(task, start, jitter, skipped), daemon=True)
+            task._running.start()
+            return None
+
+        try:
+            return task.call()
+        finally:
+            duration = self.clock.now() - start
+            task.stats.record(jitter, duration, overrun=duration > task.period, skipped=skipped)
+
+    def _run_in_thread(self, task, start, jitter, skipped):
+        try:
+            task.call()
+        except Exception as e:
+            self._on_error(task, e)
+        finally:
+            duration = self.clock.now() - start
+            task.stats.record(jitter, duration, overrun=duration > task.period, skipped=skipped)
+
+
+def every(delay, task, *args, stats=None, clock=None, **kwargs):
+    """
+    Executing `task` once initially, and then every `delay` seconds later, passing it `counter`, the number of
+    the run.
+
+    Yields the result back to the caller. If given `stats` (a job's JobStats), each run records how late it
+    started, and how many runs were skipped to catch up. Under pytest, the clock is virtual: the generator
+    doesn't wait between runs.
+    """
+    if clock is None:
+        clock = VirtualClock() if "pytest" in sys.modules else MonotonicClock()
+    scheduler = Scheduler(clock)
+    scheduler.add(task, delay, args=args, kwargs=kwargs, pass_counter=True, stats=stats)
+    while True:
+        _, result = scheduler.run_next()
+        yield result
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary encoding for batched readings (ex: `od_raw_batched`), as an alternative to JSON.
+
+A message is a fixed header followed by the packed values:
+
+    magic b"MB" | version (uint8) | dtype (b"f" float32, b"d" float64) | schema id (uint32) | timestamp (float64) | n values (uint16) | values
+
+The channel order isn't in the message. It's described by a schema, published retained (as JSON) on `<topic>/$schema`:
+
+    {"channels": ["135/A", "90/A"], "dtype": "float32"}
+
+and the schema id is a checksum of that JSON, so a consumer can tell if the layout has changed. JSON payloads
+start with "{", so consumers can accept both encodings on the same topic.
+"""
+import json
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b"MB"
+VERSION = 1
+HEADER = struct.Struct("<2sBcIdH")
+DTYPE_CODES = {"float32": b"f", "float64": b"d"}
+DTYPES = {b"f": np.dtype("<f4"), b"d": np.dtype("<f8")}
+
+Schema = namedtuple("Schema", ["id", "channels", "dtype"])
+
+
+def schema_topic(topic):
+    return f"{topic}/$schema"
+
+
+def create_schema(channels, dtype="float32"):
+    """
+    Returns the schema, and its payload to publish (retained) to the schema topic.
+    """
+    payload = json.dumps({"channels": list(channels), "dtype": dtype})
+    return Schema(zlib.crc32(payload.encode()), tuple(channels), DTYPE_CODES[dtype]), payload
+
+
+def parse_schema(payload):
+    d = json.loads(payload)
+    return create_schema(d["channels"], d["dtype"])[0]
+
+
+def is_binary(payload):
+    return payload[:2] == MAGIC
+
+
+def encode(schema, values, timestamp=None):
+    """
+    `values` must be in the order of `schema.channels`.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    header = HEADER.pack(MAGIC, VERSION, schema.dtype, schema.id, timestamp, len(schema.channels))
+    return header + np.asarray(values, dtype=DTYPES[schema.dtype]).tobytes()
+
+
+class Decoder:
+    """
+    Keeps the schemas seen so far (by id), and decodes binary payloads straight into numpy arrays.
+    """
+
+    def __init__(self):
+        self.schemas = {}
+
+    def add_schema(self, payload):
+        schema = parse_schema(payload)
+        self.schemas[schema.id] = schema
+        return schema
+
+    def decode(self, payload):
+        """
+        Returns (schema, timestamp, values). Raises KeyError if the schema hasn't been seen yet.
+        """
+        magic, version, dtype, schema_id, timestamp, n = HEADER.unpack_from(payload)
+        if version != VERSION:
+            raise ValueError(f"Unknown wire format version {version}.")
+        schema = self.schemas[schema_id]
+        return schema, timestamp, np.frombuffer(payload, dtype=DTYPES[dtype], count=n, offset=HEADER.size)
+
+    def decode_to_dict(self, payload):
+        """
+        Either encoding, as {channel: float}.
+        """
+        if is_binary(payload):
+            schema, _, values = self.decode(payload)
+            return dict(zip(schema.channels, values.tolist()))
+        return {k: float(v) for k, v in json.loads(payload).items()}
@@ -3,18 +3,126 @@ import re
 import sys
 import os
 import socket
-from morbidostat.config import leader_hostname
+import threading
+import traceback
+from morbidostat.config import leader_hostname, config
 
 UNIVERSAL_IDENTIFIER = "$broadcast"
+LATEST_EXPERIMENT_TOPIC = "morbidostat/latest_experiment"
 
 
-def get_latest_experiment_name():
-    if "pytest" in sys.modules or os.environ.get("TESTING"):
-        return "_testing_experiment"
+def is_testing():
+    return "pytest" in sys.modules or bool(os.environ.get("TESTING"))
+
+
+class LatestExperiment:
+    """
+    The name of the latest experiment, kept up to date by a subscription to `morbidostat/latest_experiment`.
+
+    The last name seen is cached on disk (`[network] experiment_cache`), so `get` returns immediately after the
+    first run, even if the leader is unreachable. The subscription then corrects a stale cached name, and callbacks
+    added with `add_callback` are called with each new name.
+    """
+
+    def __init__(self, cache_path=None, hostname=leader_hostname, default=None):
+        self.cache_path = cache_path
+        self.hostname = hostname
+        self._value = default
+        self._known = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._subscription = None
+
+        if self._value is None:
+            self._value = self._read_cache()
+        if self._value is not None:
+            self._known.set()
+
+    @property
+    def value(self):
+        # None if not known yet. Doesn't block.
+        return self._value
+
+    def get(self, timeout=10.0):
+        self.watch()
+        if not self._known.wait(timeout):
+            raise TimeoutError(f"No experiment name cached, and none received from {self.hostname} within {timeout}s.")
+        return self._value
+
+    def watch(self):
+        with self._lock:
+            if self._subscription is None:
+                from morbidostat.pubsub import subscribe_and_callback, QOS
+
+                self._subscription = subscribe_and_callback(
+                    self.on_message, LATEST_EXPERIMENT_TOPIC, hostname=self.hostname, qos=QOS.AT_LEAST_ONCE
+                )
+
+    def add_callback(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
 
-    from morbidostat.pubsub import subscribe
+    def on_message(self, message):
+        name = message.payload.decode()
+        if not name:
+            return
 
-    return subscribe("morbidostat/latest_experiment").payload.decode()
+        with self._lock:
+            previous, self._value = self._value, name
+            callbacks = list(self._callbacks)
+        if name != previous:
+            self._write_cache(name)
+        self._known.set()
+
+        if name != previous:
+            # callbacks may wait on messages (ex: get_retained), which are delivered on the thread calling us.
+            threading.Thread(target=self._run_callbacks, args=(callbacks, name), daemon=True).start()
+
+    def _run_callbacks(self, callbacks, name):
+        for callback in callbacks:
+            try:
+                callback(name)
+            except Exception:
+                traceback.print_exc()
+
+    def _read_cache(self):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _write_cache(self, name):
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + ".tmp", "w") as f:
+                f.write(name)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError:
+            pass
+
+
+if is_testing():
+    latest_experiment = LatestExperiment(default="_testing_experiment")
+else:
+    latest_experiment = LatestExperiment(
+        cache_path=os.path.expanduser(config["network"].get("experiment_cache", "~/.morbidostat/latest_experiment"))
+    )
+
+
+def get_latest_experiment_name():
+    if is_testing():
+        return latest_experiment.value
+    return latest_experiment.get()
 
 
 def get_hostname():
@@ -49,6 +157,17 @@ def am_I_leader():
     return get_hostname() == leader_hostname
 
 
+def __getattr__(name):
+    # `whoami.experiment` is looked up each time it's used, not when whoami is imported, and is the latest value. Use it
+    # at call time: `from morbidostat.whoami import experiment` at the top of a module would block the import on the
+    # lookup, and keep a stale name. Jobs follow changes with `latest_experiment.add_callback`.
+    if name == "experiment":
+        return get_latest_experiment_name()
+    # likewise `unit`, which raises on a host that isn't a unit: modules that don't use it (ex: the offline tools, and
+    # their spawned worker processes) can import whoami anywhere.
+    if name == "unit":
+        return get_unit_from_hostname()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 hostname = get_hostname()
-unit = get_unit_from_hostname()
-experiment = get_latest_experiment_name()
@@ -1,4 +1,4 @@
-# create_tables.sql
+-- create_tables.sql
 
 CREATE TABLE IF NOT EXISTS od_readings_raw (
     timestamp              TEXT  NOT NULL,
@@ -72,3 +72,20 @@ CREATE TABLE IF NOT EXISTS pid_logs (
     latest_input           REAL  NOT NULL,
     latest_output          REAL  NOT NULL
 );
+
+
+-- written by `mb replay_growth_rates`
+CREATE TABLE IF NOT EXISTS od_readings_smoothed (
+    timestamp              TEXT  NOT NULL,
+    morbidostat_unit       TEXT  NOT NULL,
+    od_reading_v           REAL  NOT NULL,
+    experiment             TEXT  NOT NULL,
+    angle                  TEXT  NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS growth_rates_smoothed (
+    timestamp              TEXT  NOT NULL,
+    experiment             TEXT  NOT NULL,
+    rate                   REAL  NOT NULL,
+    morbidostat_unit       TEXT  NOT NULL
+);